@@ -0,0 +1,45 @@
+"""Mark imported IGDB games
+
+Revision ID: 55d31ec6fa6f
+Revises: 83cefedc5e82
+Create Date: 2026-10-18 23:14:22.903762
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '55d31ec6fa6f'
+down_revision = '83cefedc5e82'
+branch_labels = None
+depends_on = None
+
+
+def _restore_search_index():
+    """
+    Batch mode rebuilds igbd_game on SQLite, which drops the triggers keeping the full text index in sync. Recreate
+    them, as in f22d59d0cc43, and reindex.
+    """
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE TRIGGER IF NOT EXISTS igbd_game_fts_insert AFTER INSERT ON igbd_game BEGIN "
+               "INSERT INTO igbd_game_fts(rowid, name) VALUES (new.id, new.name); END")
+    op.execute("CREATE TRIGGER IF NOT EXISTS igbd_game_fts_delete AFTER DELETE ON igbd_game BEGIN "
+               "INSERT INTO igbd_game_fts(igbd_game_fts, rowid, name) VALUES ('delete', old.id, old.name); END")
+    op.execute("CREATE TRIGGER IF NOT EXISTS igbd_game_fts_update AFTER UPDATE OF name ON igbd_game BEGIN "
+               "INSERT INTO igbd_game_fts(igbd_game_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+               "INSERT INTO igbd_game_fts(rowid, name) VALUES (new.id, new.name); END")
+    op.execute("INSERT INTO igbd_game_fts(igbd_game_fts) VALUES ('rebuild')")
+
+
+def upgrade():
+    # Added in place rather than in batch mode, so the search index triggers are kept
+    op.add_column('igbd_game', sa.Column('imported', sa.Boolean(), server_default=sa.false(), nullable=False))
+    # Imported games can't be told apart from cached ones, so searches go to IGDB until the catalog is imported again
+
+
+def downgrade():
+    with op.batch_alter_table('igbd_game', schema=None) as batch_op:
+        batch_op.drop_column('imported')
+    _restore_search_index()
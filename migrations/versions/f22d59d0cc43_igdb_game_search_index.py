@@ -0,0 +1,41 @@
+"""IGDB game search index
+
+Revision ID: f22d59d0cc43
+Revises: 9ea1bdbd96a7
+Create Date: 2026-10-18 22:43:51.129497
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'f22d59d0cc43'
+down_revision = '9ea1bdbd96a7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Full text search is SQLite only, other databases search with LIKE
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("CREATE VIRTUAL TABLE igbd_game_fts "
+               "USING fts5(name, content='igbd_game', content_rowid='id', prefix='2 3')")
+    op.execute("CREATE TRIGGER igbd_game_fts_insert AFTER INSERT ON igbd_game BEGIN "
+               "INSERT INTO igbd_game_fts(rowid, name) VALUES (new.id, new.name); END")
+    op.execute("CREATE TRIGGER igbd_game_fts_delete AFTER DELETE ON igbd_game BEGIN "
+               "INSERT INTO igbd_game_fts(igbd_game_fts, rowid, name) VALUES ('delete', old.id, old.name); END")
+    op.execute("CREATE TRIGGER igbd_game_fts_update AFTER UPDATE OF name ON igbd_game BEGIN "
+               "INSERT INTO igbd_game_fts(igbd_game_fts, rowid, name) VALUES ('delete', old.id, old.name); "
+               "INSERT INTO igbd_game_fts(rowid, name) VALUES (new.id, new.name); END")
+    # Index the games that are already stored
+    op.execute("INSERT INTO igbd_game_fts(igbd_game_fts) VALUES ('rebuild')")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'sqlite':
+        return
+    op.execute("DROP TRIGGER igbd_game_fts_update")
+    op.execute("DROP TRIGGER igbd_game_fts_delete")
+    op.execute("DROP TRIGGER igbd_game_fts_insert")
+    op.execute("DROP TABLE igbd_game_fts")
@@ -35,11 +35,15 @@ def create_app(config=None):
 
     app.register_blueprint(api)
 
+    from server.commands import media_cli, igdb_cli, discord_cli, ratings_cli
+
+    app.cli.add_command(media_cli)
+    app.cli.add_command(igdb_cli)
+    app.cli.add_command(discord_cli)
+    app.cli.add_command(ratings_cli)
+
     if os.getenv('FLASK_ENV') == 'development':
         from server.development import dev
 
         app.register_blueprint(dev)
     return app
-
-
-app = create_app()
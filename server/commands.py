@@ -0,0 +1,68 @@
+import click
+from flask.cli import AppGroup
+
+from server.services.discord_services import refresh_due_discord_accounts
+from server.services.games_service import import_catalog
+from server.services.media_processing import collect_unreferenced_images, image_processor, \
+    migrate_upload_layout, recover_staged_uploads, sweep_orphaned_files
+from server.services.rating_service import rebuild_rating_summaries
+
+media_cli = AppGroup('media', help='Manage uploaded images.')
+igdb_cli = AppGroup('igdb', help='Manage the local IGDB game catalog.')
+discord_cli = AppGroup('discord', help='Manage connected Discord accounts.')
+ratings_cli = AppGroup('ratings', help='Manage user ratings.')
+
+
+@media_cli.command('gc')
+def collect_images():
+    """Delete stored images that no post or profile references any more."""
+    deleted = collect_unreferenced_images()
+    click.echo(f'Deleted {deleted} unreferenced images.')
+
+
+@media_cli.command('sweep')
+def sweep_files():
+    """Delete image files that nothing in the database references. Suitable for running from cron."""
+    deleted = sweep_orphaned_files()
+    click.echo(f'Deleted {deleted} orphaned files.')
+
+
+@media_cli.command('recover')
+def recover_uploads():
+    """Requeue uploads whose processing worker died, e.g. in a restart. Suitable for running from cron."""
+    try:
+        requeued, failed, deleted = recover_staged_uploads()
+    finally:
+        # Wait for the requeued uploads before the command exits
+        image_processor.shutdown()
+    click.echo(f'Requeued {requeued} uploads, marked {failed} as failed and deleted {deleted} staged files.')
+
+
+@media_cli.command('migrate-layout')
+def migrate_layout():
+    """Move images stored in the flat upload directory into the sharded layout. Safe to re-run if interrupted."""
+    moved = migrate_upload_layout()
+    click.echo(f'Moved {moved} files.')
+
+
+@igdb_cli.command('import-catalog')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+def import_igdb_catalog(path):
+    """Import games from an IGDB catalog dump in CSV, JSON or JSON lines format."""
+    imported = import_catalog(path)
+    click.echo(f'Imported {imported} games.')
+
+
+@discord_cli.command('refresh')
+@click.option('--batch-size', type=int, default=None, help='Accounts refreshed concurrently.')
+def refresh_discord(batch_size):
+    """Renew Discord tokens nearing expiry and refresh usernames and avatars. Suitable for running from cron."""
+    refreshed = refresh_due_discord_accounts(batch_size)
+    click.echo(f'Refreshed {refreshed} Discord accounts.')
+
+
+@ratings_cli.command('rebuild-summaries')
+def rebuild_summaries():
+    """Recompute every user's rating summary from their ratings."""
+    rebuilt = rebuild_rating_summaries()
+    click.echo(f'Rebuilt rating summaries for {rebuilt} users.')
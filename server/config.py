@@ -15,9 +15,113 @@ STEAM_CLIENT_SECRET = os.getenv('STEAM_CLIENT_SECRET')
 SECRET_KEY = os.getenv('SECRET_KEY')
 IGDB_CLIENT_ID = os.getenv('IGDB_CLIENT_ID')
 IGDB_CLIENT_SECRET = os.getenv('IGDB_CLIENT_SECRET')
+# File the IGDB access token is shared through by all worker processes. Defaults to igdb_token.json in the instance
+# folder.
+IGDB_TOKEN_FILE = None
+# Seconds before the IGDB access token expires that it's refreshed
+IGDB_TOKEN_REFRESH_MARGIN = 3600
+# IGDB requests per second and burst size, shared by all worker processes. IGDB allows 4 per second.
+IGDB_RATE_LIMIT = 4
+IGDB_RATE_LIMIT_BURST = 4
+# Seconds a search may wait for a request slot before failing with a 503
+IGDB_RATE_LIMIT_MAX_WAIT = 2
+# Seconds background refreshes may wait for a request slot, and how much of the burst they leave to searches
+IGDB_RATE_LIMIT_BACKGROUND_MAX_WAIT = 30
+IGDB_RATE_LIMIT_RESERVE = 2
+# State file of the shared rate limiter. Defaults to igdb_rate_limit.json in the instance folder.
+IGDB_RATE_LIMIT_FILE = None
+# Most games fetched by a single IGDB request. IGDB returns at most 500 results per query.
+IGDB_BATCH_LIMIT = 100
+# Most games looked up by a single /api/games request. Games that aren't stored yet are fetched in concurrent batches
+# of IGDB_BATCH_LIMIT, so the default fits within IGDB_RATE_LIMIT_BURST requests.
+IGDB_LOOKUP_LIMIT = 400
+# Answer game searches from the games imported with `flask igdb import-catalog` when any match, only searching IGDB
+# otherwise
+IGDB_CATALOG_SEARCH = True
+# Seconds to cache IGDB search results, 0 to disable. Each worker caches independently.
+IGDB_SEARCH_CACHE_TTL = 300
+# Timeouts in seconds for outbound API calls
+HTTP_CONNECT_TIMEOUT = 3.05
+HTTP_READ_TIMEOUT = 10
+# Retries for idempotent outbound calls that failed to connect, timed out or got a 429/502/503/504
+HTTP_MAX_RETRIES = 2
+# Base and maximum delay in seconds before a retry. Each delay is random up to base * 2^attempt.
+HTTP_RETRY_BACKOFF = 0.25
+HTTP_RETRY_MAX_BACKOFF = 5
+# Keep-alive connections kept per upstream host, per app process
+HTTP_POOL_SIZE = 10
+# Bearer token required to read /api/metrics. The endpoint answers 404 when this isn't set.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+# Discord tokens expiring within this are renewed by `flask discord refresh`
+DISCORD_TOKEN_RENEWAL_MARGIN = datetime.timedelta(days=2)
+# Discord usernames and avatars older than this are fetched again by `flask discord refresh`
+DISCORD_PROFILE_REFRESH_INTERVAL = datetime.timedelta(days=1)
+# Accounts refreshed concurrently by `flask discord refresh`
+DISCORD_REFRESH_BATCH_SIZE = 50
+# Threads fetching newly connected Discord profiles, per app process. 0 to fetch in the request worker.
+DISCORD_REFRESH_WORKERS = 1
+# Stored IGDB games older than this are refreshed in the background the next time they are looked up
+IGDB_GAME_CACHE_TTL = datetime.timedelta(days=7)
+# Threads refreshing stale games, per app process. 0 to refresh in the request worker.
+IGDB_REFRESH_WORKERS = 2
 JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
 JWT_TOKEN_LOCATION = ['cookies', 'headers']
 JWT_COOKIE_SECURE = False
 JWT_COOKIE_CSRF_PROTECT = False
 JWT_ACCESS_TOKEN_EXPIRES = datetime.timedelta(days=1)
+# Largest request body accepted, in bytes. Bigger requests are rejected with a 413 before they are read. Uploaded
+# files above 500 KB are streamed to a temporary file rather than held in memory.
+MAX_CONTENT_LENGTH = 16 * 1024 * 1024
 UPLOAD_DIRECTORY = 'uploads'
+# Raw uploads wait here until the image processing workers have encoded them
+UPLOAD_STAGING_DIRECTORY = 'uploads/staging'
+# Images encoded at once across every app process on this machine. 0 to process uploads in the request worker.
+IMAGE_PROCESSING_WORKERS = os.cpu_count() or 1
+# Directory holding the lock files the limit above and stored image collection are coordinated through, defaults to
+# the instance folder
+IMAGE_PROCESSING_LOCK_DIRECTORY = None
+# Staged uploads untouched for this long are assumed lost with their worker, and are requeued by `flask media recover`
+IMAGE_PROCESSING_TIMEOUT = datetime.timedelta(minutes=10)
+# Seconds clients may cache images fetched by ID
+IMAGE_CACHE_MAX_AGE = 31536000
+# How image files are delivered once a request is authorized. None streams them from the app, using the WSGI server's
+# sendfile support where it has one. 'x-accel-redirect' (nginx) and 'x-sendfile' (Apache, lighttpd) hand the file to
+# the front proxy instead, which must be configured to serve UPLOAD_DIRECTORY.
+IMAGE_DELIVERY = None
+# Internal nginx location mapped to UPLOAD_DIRECTORY, used when IMAGE_DELIVERY is 'x-accel-redirect'
+IMAGE_ACCEL_REDIRECT_PREFIX = '/protected-uploads/'
+# Largest image upload accepted, in bytes
+IMAGE_MAX_BYTES = 15 * 1024 * 1024
+# Largest image upload accepted, in width * height. Checked from the image header before anything is decoded.
+IMAGE_MAX_PIXELS = 50_000_000
+# How long an image must have been unreferenced before `flask media gc` deletes it. `flask media sweep` also only deletes
+# files at least this old.
+IMAGE_GC_GRACE_PERIOD = datetime.timedelta(hours=1)
+# Image IDs checked against the database per query by `flask media sweep`
+IMAGE_SWEEP_BATCH_SIZE = 500
+# Variants stored for every uploaded image, mapped to their maximum width/height in pixels
+IMAGE_SIZES = {
+    'thumb': 256,
+    'medium': 640,
+    'full': 1024,
+}
+# Encodings stored for every variant, most preferred first, mapped to Pillow save options. Formats the installed Pillow
+# can't encode (e.g. AVIF before Pillow 11.2) are skipped. JPEG is always stored as the fallback.
+IMAGE_FORMATS = {
+    'avif': {'quality': 55},
+    'webp': {'quality': 80, 'method': 4},
+    'jpeg': {'quality': 82, 'progressive': True, 'optimize': True},
+}
+# werkzeug hash method including its parameters. Hashes made with other parameters are upgraded on the next login.
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+# Password hashes computed at once on this machine, shared by all app processes. 0 to hash in the request worker.
+PASSWORD_HASH_WORKERS = min(4, os.cpu_count() or 1)
+# Requests waiting for or running a password hash on this machine, shared by all app processes. Requests past this
+# are rejected with a 503. Only reachable when the app processes handle requests on several threads each.
+PASSWORD_HASH_MAX_PENDING = 32
+# Directory holding the lock files the limits above are shared through, defaults to the instance folder
+PASSWORD_HASH_LOCK_DIRECTORY = None
+PASSWORD_HASH_TIMEOUT = 10
+# Seconds to cache authenticated users between requests, 0 to disable. Each worker caches independently, so profile
+# changes can take up to this long to show up on other workers.
+CURRENT_USER_CACHE_TTL = 0
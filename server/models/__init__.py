@@ -1,3 +1,4 @@
 from .user import User, UserProfile, ConnectedAccount, ConnectedService, InvalidatedToken
 from .post import Post, Comment, Community, IgdbGame, comment_likes
-from .rating import Rating, RatingField, RatingFieldName
+from .rating import Rating, RatingField, RatingFieldName, RatingSummary, RatingSummaryField
+from .media import ImageStatus, ImageBlob
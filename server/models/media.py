@@ -0,0 +1,25 @@
+from datetime import datetime, timezone
+from enum import Enum
+
+from server import db
+
+
+class ImageStatus(Enum):
+    """Processing state of an uploaded image"""
+    PROCESSING = 'processing'
+    READY = 'ready'
+    FAILED = 'failed'
+
+
+class ImageBlob(db.Model):
+    """
+    A stored image, identified by the hash of its content. Posts and profiles share blobs when the same image is
+    uploaded more than once, and `ref_count` tracks how many of them use it.
+    """
+    __tablename__ = 'image_blob'
+
+    id = db.Column(db.String(64), primary_key=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc))
+    updated_at = db.Column(db.DateTime, default=lambda: datetime.now(timezone.utc),
+                           onupdate=lambda: datetime.now(timezone.utc))
@@ -1,6 +1,9 @@
 from datetime import datetime, timezone
 
+from sqlalchemy import DDL, event
+
 from server import db
+from server.models.media import ImageStatus
 
 
 post_likes = db.Table('post_likes',
@@ -55,6 +58,11 @@ class IgdbGame(db.Model):
     artwork = db.Column(db.String(100))
     summary = db.Column(db.String(1000))
     first_release_date = db.Column(db.DateTime)
+    # When the row was last fetched from IGDB, None for games stored before caching
+    fetched_at = db.Column(db.DateTime, nullable=True)
+    # Whether the game came from a catalog dump, rather than only being cached after a lookup. Searches are only
+    # answered locally from imported games, since cached ones are a small, arbitrary part of IGDB.
+    imported = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
 
     community = db.relationship('Community', back_populates='game', uselist=False)
 
@@ -69,6 +77,28 @@ class IgdbGame(db.Model):
         }
 
 
+# Full text index of game names for searching the local catalog. SQLite only, other databases search with LIKE.
+# The triggers keep it in sync with igbd_game, including rows imported with `flask igdb import-catalog`.
+IGDB_GAME_FTS_TABLE = 'igbd_game_fts'
+IGDB_GAME_FTS_DDL = [
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {IGDB_GAME_FTS_TABLE} "
+    f"USING fts5(name, content='igbd_game', content_rowid='id', prefix='2 3')",
+    f"CREATE TRIGGER IF NOT EXISTS {IGDB_GAME_FTS_TABLE}_insert AFTER INSERT ON igbd_game BEGIN "
+    f"INSERT INTO {IGDB_GAME_FTS_TABLE}(rowid, name) VALUES (new.id, new.name); END",
+    f"CREATE TRIGGER IF NOT EXISTS {IGDB_GAME_FTS_TABLE}_delete AFTER DELETE ON igbd_game BEGIN "
+    f"INSERT INTO {IGDB_GAME_FTS_TABLE}({IGDB_GAME_FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); END",
+    f"CREATE TRIGGER IF NOT EXISTS {IGDB_GAME_FTS_TABLE}_update AFTER UPDATE OF name ON igbd_game BEGIN "
+    f"INSERT INTO {IGDB_GAME_FTS_TABLE}({IGDB_GAME_FTS_TABLE}, rowid, name) VALUES ('delete', old.id, old.name); "
+    f"INSERT INTO {IGDB_GAME_FTS_TABLE}(rowid, name) VALUES (new.id, new.name); END",
+]
+
+for statement in IGDB_GAME_FTS_DDL:
+    event.listen(IgdbGame.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+# The triggers are dropped along with the table
+event.listen(IgdbGame.__table__, 'before_drop',
+             DDL(f'DROP TABLE IF EXISTS {IGDB_GAME_FTS_TABLE}').execute_if(dialect='sqlite'))
+
+
 class Post(db.Model):
     """
     Represents a post within a game community.
@@ -78,7 +108,12 @@ class Post(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    image_id = db.Column(db.String(36), nullable=True)
+    image_id = db.Column(db.String(64), nullable=True)
+    image_status = db.Column(db.Enum(ImageStatus), nullable=True)
+    image_width = db.Column(db.Integer, nullable=True)
+    image_height = db.Column(db.Integer, nullable=True)
+    # Tiny data URI clients show while the image loads
+    image_placeholder = db.Column(db.Text, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.now(timezone.utc))
     updated_at = db.Column(db.DateTime, default=datetime.now(timezone.utc), onupdate=datetime.now(timezone.utc))
     community_id = db.Column(db.Integer, db.ForeignKey('community.id'), nullable=False)
@@ -101,8 +136,13 @@ class Post(db.Model):
             'author': self.author.serialize(),
             'comments': [comment.serialize() for comment in self.comments],
             'num_likes': len(self.likes),
-            'media': 'image' if self.image_id else None
-            
+            'media': 'image' if self.image_id else None,
+            'media_status': self.image_status.value if self.image_status else None,
+            # Clients can fetch /api/images/<image_id>, which is cacheable forever
+            'image_id': self.image_id if self.image_status in (None, ImageStatus.READY) else None,
+            'image_width': self.image_width,
+            'image_height': self.image_height,
+            'image_placeholder': self.image_placeholder,
         }
     
     def __repr__(self):
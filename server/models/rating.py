@@ -56,3 +56,23 @@ class RatingField(db.Model):
             'name': self.name.name,
             'value': self.value
         }
+
+
+class RatingSummary(db.Model):
+    """Running totals of the ratings a user has received, kept up to date by `rating_service`"""
+    __tablename__ = 'rating_summary'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    rating_count = db.Column(db.Integer, nullable=False, default=0)
+
+    fields = db.relationship('RatingSummaryField', cascade='all, delete-orphan', lazy='joined')
+
+
+class RatingSummaryField(db.Model):
+    """Sum and count of the values a user has received for one rating field"""
+    __tablename__ = 'rating_summary_field'
+
+    user_id = db.Column(db.Integer, db.ForeignKey('rating_summary.user_id'), primary_key=True)
+    name = db.Column(db.Enum(RatingFieldName), primary_key=True)
+    value_sum = db.Column(db.Integer, nullable=False, default=0)
+    value_count = db.Column(db.Integer, nullable=False, default=0)
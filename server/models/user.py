@@ -1,8 +1,9 @@
 from enum import Enum
 
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import url_for
 
 from server import db
+from server.models.media import ImageStatus
 
 user_following = db.Table('user_following',
                           db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
@@ -49,15 +50,23 @@ class User(db.Model):
 
     def __init__(self, username, password):
         self.username = username
-        self.password_hash = generate_password_hash(password)
+        self.set_password(password)
         self.profile = UserProfile()
         self.profile.bio = 'This is a default bio.'
 
     def set_password(self, password) -> None:
-        self.password_hash = generate_password_hash(password)
+        # Imported here since the services package imports the models
+        from server.services.security import hash_password
+        self.password_hash = hash_password(password)
 
     def check_password(self, password) -> bool:
-        return check_password_hash(self.password_hash, password)
+        from server.services.security import verify_password
+        return verify_password(self.password_hash, password)
+
+    def password_needs_rehash(self) -> bool:
+        """Whether the password hash was created with outdated hashing parameters"""
+        from server.services.security import password_needs_rehash
+        return password_needs_rehash(self.password_hash)
 
     def serialize(self):
         """Return object data in JSON format"""
@@ -82,7 +91,12 @@ class UserProfile(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     bio = db.Column(db.String(1024), nullable=False)
-    profile_picture_id = db.Column(db.String(36), nullable=True)
+    profile_picture_id = db.Column(db.String(64), nullable=True)
+    profile_picture_status = db.Column(db.Enum(ImageStatus), nullable=True)
+    profile_picture_width = db.Column(db.Integer, nullable=True)
+    profile_picture_height = db.Column(db.Integer, nullable=True)
+    # Tiny data URI clients show while the profile picture loads
+    profile_picture_placeholder = db.Column(db.Text, nullable=True)
     # TODO other profile information
 
     user = db.relationship('User', uselist=False, back_populates='profile')
@@ -90,7 +104,13 @@ class UserProfile(db.Model):
     def serialize(self):
         """Return object data in JSON format"""
         return {
-            'bio': self.bio
+            'bio': self.bio,
+            'profile_picture_status': self.profile_picture_status.value if self.profile_picture_status else None,
+            'profile_picture_id': self.profile_picture_id
+            if self.profile_picture_status in (None, ImageStatus.READY) else None,
+            'profile_picture_width': self.profile_picture_width,
+            'profile_picture_height': self.profile_picture_height,
+            'profile_picture_placeholder': self.profile_picture_placeholder,
         }
 
 
@@ -124,6 +144,11 @@ class ConnectedAccount(db.Model):
     access_token = db.Column(db.Text, nullable=True)
     refresh_token = db.Column(db.Text, nullable=True)
     expires_at = db.Column(db.DateTime, nullable=True)
+    # When the username and avatar were last fetched from the provider
+    refreshed_at = db.Column(db.DateTime, nullable=True)
+    # Stored copy of the avatar, and the avatar hash it was fetched for
+    avatar_image_id = db.Column(db.String(64), nullable=True)
+    avatar_hash = db.Column(db.String(), nullable=True)
 
     user = db.relationship('User', uselist=False, back_populates='connected_accounts')
 
@@ -132,7 +157,11 @@ class ConnectedAccount(db.Model):
         return {
             'username': self.username,
             'discord_user_id': self.discord_user_id,
-            'profile_picture_url': f'https://cdn.discordapp.com/avatars/{self.discord_user_id}/{self.profile_picture}.png',  # TODO see if this breaks for .gif pfps
+            # Proxied through our own storage, and changes with the avatar so clients can cache it indefinitely. Absolute,
+            # since the frontend is served from another origin.
+            'profile_picture_url': url_for('api.get_user_discord_avatar', user_id=self.user_id,
+                                           avatar_hash=self.profile_picture, _external=True)
+            if self.profile_picture else None,
             'provider': self.provider.value
         }
 
@@ -1,25 +1,51 @@
+import hmac
 import os
+import posixpath
+import re
 from datetime import datetime, timedelta
 from operator import or_
 
-import requests
-from flask import jsonify, request, redirect, send_file, render_template, Blueprint, current_app
+import httpx
+from flask import jsonify, request, redirect, send_file, render_template, Blueprint, current_app, url_for
 from flask_jwt_extended import create_access_token, jwt_required, \
-    get_jwt_identity, set_access_cookies, get_jwt, unset_access_cookies
+    get_jwt_identity, set_access_cookies, get_jwt, unset_access_cookies, get_current_user
 from sqlalchemy.exc import IntegrityError
+from werkzeug.exceptions import RequestEntityTooLarge
 
 from server import db, jwt
 from server.models import User, Post, Comment, InvalidatedToken, Community, ConnectedService, ConnectedAccount, \
-    IgdbGame, Rating, RatingField, RatingFieldName
-from server.services import fetch_discord_account_data, validate_password
+    IgdbGame, Rating, RatingField, RatingFieldName, ImageStatus
+from server.services import validate_password
+from server.services.async_http_client import run_async
+from server.services.discord_services import exchange_discord_code, discord_refresher, cache_discord_avatar, \
+    DiscordError
 from server.services.feed_service import get_feed_posts, SortType
-from server.services.games_service import search_igdb_games, get_game, IGDBError, api_response_to_model
-from server.services.media_processing import save_image, delete_image
+from server.services.games_service import search_igdb_games, get_cached_game, get_cached_games, IGDBError, \
+    IGDBRateLimitError, api_response_to_model, search_cache_stats
+from server.services.media_processing import resolve_image, validate_image_size, ImageSizeError, stage_upload, \
+    discard_staged_upload, image_processor, InvalidImageError, ImageTooLargeError, release_image, \
+    negotiate_image_formats
 from server.services.comment_service import get_comment_tree
+from server.services.http_client import http_client
+from server.services.rating_service import get_rating_summary, add_to_rating_summary, remove_from_rating_summary, \
+    get_rating, get_ratings_page
+from server.services.security import PasswordHasherBusyError
+from server.services.user_service import load_user, invalidate_cached_user
 
 api = Blueprint('api', __name__, url_prefix='/api')
 
 
+@api.errorhandler(PasswordHasherBusyError)
+def password_hasher_busy(error):
+    """Sheds login and registration bursts instead of letting them queue behind each other."""
+    return jsonify(success=False, msg='Server busy, try again shortly'), 503, {'Retry-After': '1'}
+
+
+@api.errorhandler(RequestEntityTooLarge)
+def request_too_large(error):
+    return jsonify(success=False, msg='Request too large'), 413
+
+
 @api.route('/register', methods=['POST'])
 def register():
     """
@@ -66,6 +92,11 @@ def login():
     if not user or not user.check_password(password):
         return jsonify(success=False, msg='Invalid username or password'), 401
 
+    if user.password_needs_rehash():
+        user.set_password(password)
+        db.session.commit()
+        invalidate_cached_user(user.id)
+
     access_token = create_access_token(identity=str(user.id), fresh=True)
     response = jsonify(success=True, msg='Logged in successfully')
     set_access_cookies(response, access_token)
@@ -80,6 +111,17 @@ def is_token_revoked(jwt_headers, jwt_payload):
     return token is not None
 
 
+@jwt.user_lookup_loader
+def lookup_current_user(jwt_headers, jwt_payload):
+    """Loads the user for the token's identity once per request, exposed through `get_current_user()`."""
+    return load_user(jwt_payload['sub'])
+
+
+@jwt.user_lookup_error_loader
+def current_user_not_found(jwt_headers, jwt_payload):
+    return jsonify(msg='User not found'), 401
+
+
 @api.route('/logout', methods=['POST'])
 @jwt_required()
 def logout():
@@ -98,33 +140,41 @@ def me():
     """
     :return: Information about the current user
     """
-    identity = get_jwt_identity()
-    user = User.query.filter_by(id=identity).first()
-    if not user:
-        return jsonify(msg='User not found'), 404
-    return jsonify(user=user.serialize())
+    return jsonify(user=get_current_user().serialize())
 
 
 @api.route('/me', methods=['PUT'])
 @jwt_required()
 def edit_profile():
     """Takes username, bio, password, and profile_picture as form data"""
-    user_id = get_jwt_identity()
-    user = db.session.get(User, user_id)
-    if not user:
-        return jsonify(msg='User not found'), 404
+    user = get_current_user()
 
     username = request.form.get('username', None)
     bio = request.form.get('bio', None)
     profile_picture = request.files.get('profile_picture', None)
     newPassword = request.form.get('password')
 
+    old_pfp_uuid = None
+    pfp_uuid = None
     if bio:
         user.profile.bio = bio
     if profile_picture and profile_picture.filename != '':
-        pfp_uuid = save_image(profile_picture)
-        delete_image(user.profile.profile_picture_id)
+        try:
+            pfp_uuid = stage_upload(profile_picture)
+        except ImageTooLargeError as e:
+            return jsonify(msg=str(e)), 413
+        except InvalidImageError:
+            return jsonify(msg='Invalid image'), 400
+        # The current user may be a cached snapshot from before their last picture was processed, which replaced
+        # the staged upload's ID
+        db.session.refresh(user.profile, ['profile_picture_id'])
+        old_pfp_uuid = user.profile.profile_picture_id
         user.profile.profile_picture_id = pfp_uuid
+        user.profile.profile_picture_status = ImageStatus.PROCESSING
+        # Filled in again once the new picture has been processed
+        user.profile.profile_picture_width = None
+        user.profile.profile_picture_height = None
+        user.profile.profile_picture_placeholder = None
     if username:
         user.username = username
     if newPassword:
@@ -135,17 +185,21 @@ def edit_profile():
         db.session.add(user)
         db.session.commit()
     except IntegrityError:
+        if pfp_uuid:
+            discard_staged_upload(pfp_uuid)
         return jsonify(msg='Username already taken'), 409
 
+    invalidate_cached_user(user.id)
+    if pfp_uuid:
+        release_image(old_pfp_uuid)
+        db.session.commit()
+        image_processor.submit(pfp_uuid)
     return jsonify(user=user.serialize())
 
 @api.route('/me', methods=['PUT'])
 @jwt_required()
 def update_password():
-    user_id = get_jwt_identity()
-    user = db.session.get(User, user_id)
-    if not user:
-        return jsonify(msg='User not found'), 404
+    user = get_current_user()
 
     current_password = request.form.get('current_password')
     new_password = request.form.get('new_password')
@@ -158,6 +212,7 @@ def update_password():
 
     user.set_password(new_password)
     db.session.commit()
+    invalidate_cached_user(user.id)
 
     return jsonify(msg='Password updated successfully'), 200
 
@@ -177,17 +232,120 @@ def get_user(user_id):
     return jsonify(user=user.serialize())
 
 
+def send_stored_file(filepath: str, mimetype: str, etag: str = None):
+    """
+    Deliver a file from UPLOAD_DIRECTORY according to `IMAGE_DELIVERY`. With a front proxy configured, the response
+    only carries the header telling the proxy which file to serve, and the proxy handles Range and conditional
+    requests. Otherwise the file is sent from here, which lets the WSGI server use sendfile for full responses.
+    """
+    delivery = current_app.config.get('IMAGE_DELIVERY')
+    if delivery is None:
+        return send_file(os.path.abspath(filepath), mimetype=mimetype, etag=etag if etag is not None else True,
+                         conditional=True)
+
+    response = current_app.response_class(mimetype=mimetype)
+    if delivery == 'x-accel-redirect':
+        relative_path = os.path.relpath(filepath, current_app.config['UPLOAD_DIRECTORY'])
+        response.headers['X-Accel-Redirect'] = posixpath.join(current_app.config['IMAGE_ACCEL_REDIRECT_PREFIX'],
+                                                              relative_path.replace(os.sep, '/'))
+    elif delivery == 'x-sendfile':
+        response.headers['X-Sendfile'] = os.path.abspath(filepath)
+    else:
+        raise ValueError(f'Unknown IMAGE_DELIVERY: {delivery}')
+    if etag is not None:
+        response.set_etag(etag)
+    return response
+
+
+def send_image(image_id: str, size: str, immutable: bool = False):
+    """
+    Send a stored image with a strong ETag, honouring conditional and Range requests. A stored image never changes, so
+    an If-None-Match for any format the client accepts is answered with a 304 without touching the disk.
+    :param immutable: Whether the URL always refers to this image, so clients can cache it indefinitely. Otherwise
+    clients have to revalidate on every use.
+    :return: The response, or None if the image has no stored files
+    """
+    def add_cache_headers(response):
+        response.vary.add('Accept')
+        if immutable:
+            response.cache_control.public = True
+            response.cache_control.max_age = current_app.config['IMAGE_CACHE_MAX_AGE']
+            response.cache_control.immutable = True
+        else:
+            response.cache_control.no_cache = True
+        return response
+
+    for image_format in negotiate_image_formats(request.accept_mimetypes):
+        etag = f'{image_id}-{size}-{image_format.extension}'
+        if request.if_none_match.contains(etag):
+            response = current_app.response_class(status=304)
+            response.set_etag(etag)
+            return add_cache_headers(response)
+
+    image = resolve_image(image_id, size, request.accept_mimetypes)
+    if image is None:
+        return None
+    filepath, image_format = image
+    response = send_stored_file(filepath, image_format.mimetype, etag=f'{image_id}-{size}-{image_format.extension}')
+    return add_cache_headers(response)
+
+
 @api.route('/users/<int:user_id>/profile-picture', methods=['GET'])
 def get_user_profile_picture(user_id):
+    """Takes an optional `size` query parameter, one of the configured `IMAGE_SIZES`"""
+    try:
+        size = validate_image_size(request.args.get('size'))
+    except ImageSizeError as e:
+        return jsonify(msg=str(e)), 400
+
     user = db.session.get(User, user_id)
     if not user:
         return jsonify(msg='User not found'), 404
-    filepath = os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'], f'{user.profile.profile_picture_id}.jpg'))
-    if os.path.exists(filepath):
-        return send_file(filepath, mimetype='image/jpeg')
+    response = None
+    if user.profile.profile_picture_id and user.profile.profile_picture_status != ImageStatus.PROCESSING:
+        response = send_image(user.profile.profile_picture_id, size)
+    if response:
+        return response
     else:
-        default_profile_filepath = os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'], 'default-profile.png'))
-        return send_file(default_profile_filepath, mimetype='image/png')
+        default_profile_filepath = os.path.join(current_app.config['UPLOAD_DIRECTORY'], 'default-profile.png')
+        return send_stored_file(default_profile_filepath, 'image/png')
+
+
+@api.route('/users/<int:user_id>/discord-avatar/<string:avatar_hash>', methods=['GET'])
+def get_user_discord_avatar(user_id, avatar_hash):
+    """
+    Get the avatar of a user's connected Discord account. It is fetched from Discord once per avatar hash and stored
+    with the uploaded images, so the URL changes with the avatar and responses may be cached indefinitely.
+    Takes an optional `size` query parameter, one of the configured `IMAGE_SIZES`
+    """
+    try:
+        size = validate_image_size(request.args.get('size'))
+    except ImageSizeError as e:
+        return jsonify(msg=str(e)), 400
+
+    account = ConnectedAccount.query.filter_by(user_id=user_id, provider=ConnectedService.DISCORD).first()
+    if not account or not account.profile_picture:
+        return jsonify(msg='Avatar not found'), 404
+    if avatar_hash != account.profile_picture:
+        # Links to an old avatar are sent to the current one
+        return redirect(url_for('api.get_user_discord_avatar', user_id=user_id, avatar_hash=account.profile_picture,
+                                **request.args))
+
+    immutable = True
+    try:
+        image_id = cache_discord_avatar(account)
+    except (DiscordError, httpx.HTTPError, InvalidImageError) as e:
+        current_app.logger.warning(f'Failed to fetch Discord avatar {avatar_hash}: {e}')
+        # Serve the previous avatar for now, without letting clients cache it as the new one
+        db.session.rollback()
+        image_id, immutable = account.avatar_image_id, False
+
+    response = send_image(image_id, size, immutable=immutable) if image_id else None
+    if response:
+        return response
+    else:
+        default_profile_filepath = os.path.join(current_app.config['UPLOAD_DIRECTORY'], 'default-profile.png')
+        return send_stored_file(default_profile_filepath, 'image/png')
 
 
 @api.route('/users/<int:user_id>/followers', methods=['GET'])
@@ -209,9 +367,7 @@ def get_following(user_id):
 @api.route('/users/<int:target_user_id>/follow', methods=['POST'])
 @jwt_required()
 def follow(target_user_id):
-    current_user = User.query.filter_by(id=get_jwt_identity()).first()
-    if not current_user:
-        return jsonify(msg='Logged in user not found'), 404
+    current_user = get_current_user()
 
     target_user = User.query.filter_by(id=target_user_id).first()
     if not target_user:
@@ -232,9 +388,7 @@ def follow(target_user_id):
 @api.route('/users/<int:target_user_id>/follow', methods=['DELETE'])
 @jwt_required()
 def unfollow(target_user_id):
-    current_user = User.query.filter_by(id=get_jwt_identity()).first()
-    if not current_user:
-        return jsonify(msg='Logged in user not found'), 404
+    current_user = get_current_user()
 
     target_user = User.query.filter_by(id=target_user_id).first()
     if not target_user:
@@ -256,9 +410,7 @@ def unfollow(target_user_id):
 @jwt_required()
 def get_relationship(target_user_id):
     """Get the following/followed-by relationship between the current and target users"""
-    current_user = User.query.filter_by(id=get_jwt_identity()).first()
-    if not current_user:
-        return jsonify(msg='Logged in user not found'), 404
+    current_user = get_current_user()
 
     target_user = User.query.filter_by(id=target_user_id).first()
     if not target_user:
@@ -291,9 +443,7 @@ def get_community_users(community_id):
 @api.route('/communities/<int:community_id>/follow', methods=['POST'])
 @jwt_required()
 def follow_community(community_id):
-    current_user = User.query.filter_by(id=get_jwt_identity()).first()
-    if not current_user:
-        return jsonify(msg='Logged in user not found'), 404
+    current_user = get_current_user()
 
     community = Community.query.filter_by(id=community_id).first()
     if not community:
@@ -311,9 +461,7 @@ def follow_community(community_id):
 @api.route('/communities/<int:community_id>/follow', methods=['DELETE'])
 @jwt_required()
 def unfollow_community(community_id):
-    current_user = User.query.filter_by(id=get_jwt_identity()).first()
-    if not current_user:
-        return jsonify(msg='Logged in user not found'), 404
+    current_user = get_current_user()
 
     community = Community.query.filter_by(id=community_id).first()
     if not community:
@@ -335,6 +483,7 @@ def delete_post(post_id):
     post = Post.query.filter_by(id=post_id, author_id=user_id).first()
     if not post:
         return jsonify(msg='Post not found or not authorized'), 404
+    release_image(post.image_id)
     db.session.delete(post)
     db.session.commit()
     return jsonify(msg='Post deleted successfully'), 200
@@ -350,19 +499,39 @@ def edit_profile_test():
 @api.route('/game-info/<int:game_id>', methods=['GET'])
 def game_info(game_id):
     try:
-        game = get_game(game_id)
-        igdb_game = api_response_to_model(game)
+        igdb_game = get_cached_game(game_id)
         return jsonify(game=igdb_game.serialize())
+    except IGDBRateLimitError:
+        return jsonify(msg='Too many game lookups, try again shortly'), 503, {'Retry-After': '1'}
     except IGDBError:
         return jsonify(msg='Game not found'), 404
 
 
+@api.route('/games', methods=['GET'])
+def get_games_info():
+    """Takes an `ids` query parameter with a comma separated list of IGDB game IDs"""
+    try:
+        game_ids = [int(game_id) for game_id in request.args.get('ids', '').split(',') if game_id.strip()]
+    except ValueError:
+        return jsonify(msg='ids must be a comma separated list of game IDs'), 400
+    if not game_ids:
+        return jsonify(msg='No game IDs provided'), 400
+    if len(game_ids) > current_app.config['IGDB_LOOKUP_LIMIT']:
+        return jsonify(msg=f'At most {current_app.config["IGDB_LOOKUP_LIMIT"]} games can be requested at once'), 400
+
+    try:
+        igdb_games = get_cached_games(game_ids)
+    except IGDBRateLimitError:
+        return jsonify(msg='Too many game lookups, try again shortly'), 503, {'Retry-After': '1'}
+    except IGDBError:
+        return jsonify(msg='IGDB API Error'), 404
+    return jsonify(games=[igdb_game.serialize() for igdb_game in igdb_games])
+
+
 @api.route('/communities', methods=['POST'])
 @jwt_required()
 def create_community():
-    current_user = User.query.filter_by(id=get_jwt_identity()).first()
-    if not current_user:
-        return jsonify(msg='Logged in user not found'), 404
+    current_user = get_current_user()
 
     game_id = request.json.get('game_id', None)
     community_name = request.json.get('community_name', None)
@@ -373,9 +542,12 @@ def create_community():
     if not community_name:
         return jsonify(msg='Community name not provided'), 400
 
-    game = get_game(game_id)
-
-    igdb_game = api_response_to_model(game)
+    try:
+        igdb_game = get_cached_game(game_id)
+    except IGDBRateLimitError:
+        return jsonify(msg='Too many game lookups, try again shortly'), 503, {'Retry-After': '1'}
+    except IGDBError:
+        return jsonify(msg='Game not found'), 404
 
     community = Community(name=community_name, game=igdb_game, owner=current_user)
 
@@ -446,7 +618,7 @@ def homepage():
     """
     :return: Posts for this user's homepage
     """
-    user = User.query.filter_by(id=get_jwt_identity()).first()
+    user = get_current_user()
     sort_type, valid = validate_sort_type(request.args.get('sort'))
     if not valid:
         return jsonify(msg=f'Invalid sort type: {sort_type}'), 400
@@ -486,31 +658,69 @@ def create_post():
     )
 
     if image:
-        image_uuid = save_image(image)
-        post.image_id = image_uuid
+        try:
+            post.image_id = stage_upload(image)
+        except ImageTooLargeError as e:
+            return jsonify(success=False, msg=str(e)), 413
+        except InvalidImageError:
+            return jsonify(success=False, msg='Invalid image'), 400
+        post.image_status = ImageStatus.PROCESSING
 
     current_app.logger.info(post)
     db.session.add(post)
     db.session.commit()
 
+    # The upload is acknowledged right away, and the post's media_status is updated once it has been processed
+    if post.image_id:
+        image_processor.submit(post.image_id)
+
     response = jsonify(post=post.serialize())
     return response, 201
 
 
 @api.route('/posts/<int:post_id>/image', methods=['GET'])
 def get_post_image(post_id):
+    """Takes an optional `size` query parameter, one of the configured `IMAGE_SIZES`"""
+    try:
+        size = validate_image_size(request.args.get('size'))
+    except ImageSizeError as e:
+        return jsonify(msg=str(e)), 400
+
     post = db.session.get(Post, post_id)
     if not post:
         return jsonify(msg='Post not found'), 404
     if post.image_id is None:
         return jsonify(msg='Post has no associated image'), 404
-    filepath = os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'], post.image_id + '.jpg'))
-    if os.path.exists(filepath):
-        return send_file(filepath, mimetype='image/jpeg')
+    if post.image_status == ImageStatus.PROCESSING:
+        return jsonify(msg='Image is still processing'), 202, {'Retry-After': '1'}
+    response = send_image(post.image_id, size)
+    if response:
+        return response
     else:
         return jsonify(msg=f'Image for post with ID "{post_id}" not found'), 404
 
 
+@api.route('/images/<string:image_id>', methods=['GET'])
+def get_image(image_id):
+    """
+    Get an image by its ID. The image behind an ID never changes, so responses may be cached indefinitely.
+    Takes an optional `size` query parameter, one of the configured `IMAGE_SIZES`
+    """
+    try:
+        size = validate_image_size(request.args.get('size'))
+    except ImageSizeError as e:
+        return jsonify(msg=str(e)), 400
+
+    if not re.fullmatch(r'[\w-]+', image_id):
+        return jsonify(msg='Image not found'), 404
+
+    response = send_image(image_id, size, immutable=True)
+    if response:
+        return response
+    else:
+        return jsonify(msg='Image not found'), 404
+
+
 @api.route('/posts/<int:post_id>/comments', methods=['GET'])
 @jwt_required()
 def get_comments(post_id):
@@ -542,19 +752,14 @@ def create_comment():
     if content is None or author_id is None or post_id is None:
         return jsonify(success=False, msgg='Incomplete comment'), 400
 
-    current_user = db.session.get(User, author_id)
-    if not current_user:
-        return jsonify(success=False, msg='User not found'), 400
-
-    else:
-        comment = Comment(
-            content=content,
-            parent_id=parent_id,
-            author=current_user,
-            post_id=post_id
-        )
-        db.session.add(comment)
-        db.session.commit()
+    comment = Comment(
+        content=content,
+        parent_id=parent_id,
+        author=get_current_user(),
+        post_id=post_id
+    )
+    db.session.add(comment)
+    db.session.commit()
 
     response = jsonify(comment=comment.serialize())
     return response, 201
@@ -577,11 +782,12 @@ def delete_comment(comment_id):
 @jwt_required()
 def get_linked_accounts(user_id):
     if user_id is None:
-        # TODO use session to get current user ID
-        pass
+        user_id = get_jwt_identity()
 
+    # Served as stored, `flask discord refresh` keeps the profile up to date
+    discord_account = ConnectedAccount.query.filter_by(user_id=user_id, provider=ConnectedService.DISCORD).first()
     return jsonify({
-        'discord': fetch_discord_account_data(user_id),
+        'discord': discord_account.serialize() if discord_account else None,
         'steam': None
     })
 
@@ -621,6 +827,8 @@ def search_games():
 
     try:
         games = search_igdb_games(search_term)
+    except IGDBRateLimitError:
+        return jsonify(msg='Too many searches, try again shortly'), 503, {'Retry-After': '1'}
     except IGDBError:
         return jsonify(msg='IGDB API Error'), 404
     igdb_games = []
@@ -647,20 +855,7 @@ def discord_connect():
 @jwt_required()
 def discord_callback():
     code = request.args.get('code')
-    data = {
-        'client_id': current_app.config['DISCORD_CLIENT_ID'],
-        'client_secret': current_app.config['DISCORD_CLIENT_SECRET'],
-        'grant_type': 'authorization_code',
-        'code': code,
-        'redirect_uri': current_app.config['DISCORD_REDIRECT_URI']
-    }
-    headers = {
-        'Content-Type': 'application/x-www-form-urlencoded'
-    }
-    response = requests.post(current_app.config['DISCORD_TOKEN_URL'], data=data, headers=headers)
-    token_data = response.json()
-
-    # TODO save token to database & fetch initial info
+    token_data = run_async(exchange_discord_code(code))
 
     access_token = token_data.get('access_token', None)
     refresh_token = token_data.get('refresh_token', None)
@@ -669,9 +864,7 @@ def discord_callback():
         return jsonify(success=False, msg='Invalid authorization code'), 400
     expires_at = datetime.now() + timedelta(seconds=expires_in)
 
-    user = db.session.get(User, get_jwt_identity())
-    if not user:
-        return jsonify(msg='User not found'), 401
+    user = get_current_user()
 
     connected_discord_account = next(
         (account for account in user.connected_accounts if account.provider == ConnectedService.DISCORD), None)
@@ -680,18 +873,20 @@ def discord_callback():
         connected_discord_account.refresh_token = refresh_token
         connected_discord_account.expires_at = expires_at
     else:
-        user.connected_accounts.append(ConnectedAccount(
+        connected_discord_account = ConnectedAccount(
             access_token=access_token,
             refresh_token=refresh_token,
             expires_at=expires_at,
             username='',
             provider=ConnectedService.DISCORD
-        ))
+        )
+        user.connected_accounts.append(connected_discord_account)
 
     db.session.add(user)
     db.session.commit()
 
-    fetch_discord_account_data(user.id)
+    # The username and avatar are fetched in the background instead of holding up the redirect
+    discord_refresher.submit(connected_discord_account.id)
 
     # redirect to user's account page
     return redirect(f'{current_app.config["REACT_APP_URL"]}/users/{get_jwt_identity()}')
@@ -700,13 +895,12 @@ def discord_callback():
 @api.route('/discord/disconnect', methods=['POST'])
 @jwt_required()
 def discord_disconnect():
-    user = db.session.get(User, get_jwt_identity())
-    if not user:
-        return jsonify(msg='User not found'), 401
+    user = get_current_user()
 
     connected_discord_account = next(
         (account for account in user.connected_accounts if account.provider == ConnectedService.DISCORD), None)
     if connected_discord_account:
+        release_image(connected_discord_account.avatar_image_id)
         user.connected_accounts.remove(connected_discord_account)
         db.session.delete(connected_discord_account)
 
@@ -722,28 +916,31 @@ def get_ratings_fields():
 
 @api.route('/ratings', methods=['GET'])
 def get_user_ratings():
-    giver_user_id = request.args.get('giver', None)
-    receiver_user_id = request.args.get('receiver', None)
+    """
+    Get the rating `giver` gave `receiver`, or a page of the ratings one of them gave or received, newest first.
+    Pages take optional `cursor` and `limit` query parameters, and return the `next_cursor` to request the next page
+    with, or null on the last page.
+    """
+    giver_user_id = request.args.get('giver', None, type=int)
+    receiver_user_id = request.args.get('receiver', None, type=int)
     if giver_user_id is not None and receiver_user_id is not None:
-        rating = Rating.query.filter_by(rating_user_id=giver_user_id, rated_user_id=receiver_user_id).first()
+        rating = get_rating(giver_user_id, receiver_user_id)
         if rating is None:
             return jsonify(msg='Rating not found'), 404
         return jsonify(rating=rating.serialize())
-    elif giver_user_id is not None:
-        user = db.session.get(User, giver_user_id)
-        if not user:
-            return jsonify(msg='User not found'), 404
-
-        return jsonify(ratings=[rating.serialize() for rating in user.given_ratings])
-    elif receiver_user_id is not None:
-        user = db.session.get(User, receiver_user_id)
-        if not user:
-            return jsonify(msg='User not found'), 404
-
-        return jsonify(ratings=[rating.serialize() for rating in user.received_ratings])
-    else:
+    elif giver_user_id is None and receiver_user_id is None:
         return jsonify(msg="Either 'giver' or 'receiver' must be provided"), 400
 
+    user = db.session.get(User, giver_user_id if giver_user_id is not None else receiver_user_id)
+    if not user:
+        return jsonify(msg='User not found'), 404
+
+    cursor = request.args.get('cursor', default=None, type=int)
+    limit = request.args.get('limit', default=20, type=int)
+    ratings, next_cursor = get_ratings_page(giver_id=giver_user_id, receiver_id=receiver_user_id, cursor=cursor,
+                                            limit=limit)
+    return jsonify(ratings=[rating.serialize() for rating in ratings], next_cursor=next_cursor)
+
 
 @api.route('/ratings/<int:user_id>', methods=['POST'])
 @jwt_required()
@@ -754,9 +951,7 @@ def create_user_rating(user_id):
     if not user:
         return jsonify(msg=f'User not found: {user_id}'), 404
 
-    current_user = db.session.get(User, get_jwt_identity())
-    if not current_user:
-        return jsonify(msg=f'User not found: {get_jwt_identity()}'), 404
+    current_user = get_current_user()
 
     if current_user.id == user_id:
         return jsonify(msg='You cannot rate yourself'), 400
@@ -768,7 +963,10 @@ def create_user_rating(user_id):
 
     # Use existing rating if it exists
     rating = Rating.query.filter_by(rated_user_id=user.id, rating_user_id=current_user.id).first()
-    if not rating:
+    if rating:
+        # Overwriting a rating replaces its values in the summary
+        remove_from_rating_summary(rating)
+    else:
         # No existing rating, so create a new instance
         rating = Rating(
             rating_user=current_user,
@@ -784,11 +982,14 @@ def create_user_rating(user_id):
     rating.fields.extend([RatingField(rating=rating, name=field['name'], value=field['value']) for field in fields])
     try:
         db.session.add(rating)
+        db.session.flush()
+        add_to_rating_summary(rating)
         db.session.commit()
     except IntegrityError:
+        db.session.rollback()
         return jsonify(msg='Error creating rating'), 400
 
-    return jsonify(ratings=[rating.serialize() for rating in user.received_ratings])
+    return jsonify(rating=get_rating(current_user.id, user.id).serialize())
 
 
 @api.route('ratings/<int:user_id>', methods=['DELETE'])
@@ -798,15 +999,15 @@ def delete_user_rating(user_id):
     if not user:
         return jsonify(msg=f'User not found: {user_id}'), 404
 
-    current_user = db.session.get(User, get_jwt_identity())
-    if not current_user:
-        return jsonify(msg=f'User not found: {get_jwt_identity()}'), 404
+    current_user = get_current_user()
 
     existing_rating = Rating.query.filter_by(rated_user_id=user.id, rating_user_id=current_user.id).first()
     if existing_rating:
+        remove_from_rating_summary(existing_rating)
         db.session.delete(existing_rating)
         db.session.commit()
         return jsonify(msg='Deleted rating'), 200
+    return jsonify(msg='Rating not found'), 404
 
 
 @api.route('ratings/<int:user_id>/summary', methods=['GET'])
@@ -815,26 +1016,7 @@ def get_user_ratings_summary(user_id):
     if not user:
         return jsonify(msg=f'User not found: {user_id}'), 404
 
-    summary = {field.name: {'value': 0, 'count': 0} for field in RatingFieldName}
-    for rating in user.received_ratings:
-        for field in rating.fields:
-            summary[field.name.name]['value'] += field.value
-            summary[field.name.name]['count'] += 1
-
-    has_ratings = False
-    for field in summary.keys():
-        if summary[field]['count'] > 0:
-            has_ratings = True
-            summary[field]['value'] /= summary[field]['count']
-
-    if not has_ratings:
-        return jsonify(summary=None)
-
-    fields = [{'name': field_name, 'value': summary[field_name]['value']} for field_name in summary.keys()]
-
-    total_rating_count = user.received_ratings.count()
-
-    return jsonify(summary={'fields': fields, 'count': total_rating_count})
+    return jsonify(summary=get_rating_summary(user.id))
 
 @api.route('/comments/<int:comment_id>/like', methods=['POST'])
 @jwt_required()
@@ -851,9 +1033,7 @@ def like_comment(comment_id):
     if not comment:
         return jsonify({'error': 'Comment not found'}), 404
 
-    user = db.session.get(User, user_id)
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    user = get_current_user()
 
     # Check if the user already liked the comment
     if user in comment.likes:
@@ -882,9 +1062,7 @@ def dislike_comment(comment_id):
     if not comment:
         return jsonify({'error': 'Comment not found'}), 404
 
-    user = db.session.get(User, user_id)
-    if not user:
-        return jsonify({'error': 'User not found'}), 404
+    user = get_current_user()
 
     if user not in comment.likes:
         return jsonify({'message': 'Not liked'}), 200
@@ -896,3 +1074,17 @@ def dislike_comment(comment_id):
     except SQLAlchemyError as e:
         db.session.rollback()
         return jsonify({'error': str(e)}), 500
+
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Latency, error and retry metrics of each upstream API and the IGDB search cache's hit rates, as recorded by the
+    worker process serving the request. Each process keeps its own, so the `pid` tells scrapers which one answered.
+    Requires the `METRICS_TOKEN` as a bearer token.
+    """
+    metrics_token = current_app.config.get('METRICS_TOKEN')
+    provided_token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not metrics_token or not hmac.compare_digest(provided_token.encode(), metrics_token.encode()):
+        return jsonify(msg='Not found'), 404
+    return jsonify(pid=os.getpid(), upstreams=http_client.stats(), search_cache=search_cache_stats())
@@ -1,2 +1,2 @@
-from .discord_services import fetch_discord_account_data
+from .discord_services import refresh_due_discord_accounts
 from .security import validate_password
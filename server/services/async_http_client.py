@@ -0,0 +1,118 @@
+import asyncio
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import httpx
+from flask import current_app
+
+from server.services.http_client import IDEMPOTENT_METHODS, RETRY_STATUS_CODES, backoff_delay, http_client
+
+
+class EventLoopThread:
+    """
+    An asyncio event loop running on a daemon thread, shared by every request thread of a worker process. Sync code
+    hands it coroutines with `run_async` and waits for the result, so the calling thread is still held for the whole
+    call. What it gains is fan-out: the requests a coroutine gathers, like the batches of `get_games_async`, are in
+    flight together instead of one after another.
+    """
+
+    def __init__(self):
+        self._loop = None
+        self._loop_pid = None
+        self._lock = threading.Lock()
+
+    def get_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            # The loop's thread doesn't survive a fork, so each worker process starts its own
+            if self._loop is None or self._loop_pid != os.getpid():
+                self._loop = asyncio.new_event_loop()
+                self._loop_pid = os.getpid()
+                threading.Thread(target=self._loop.run_forever, name='async-http', daemon=True).start()
+            return self._loop
+
+
+event_loop_thread = EventLoopThread()
+
+
+def run_async(coroutine, timeout: float = None):
+    """
+    Run a coroutine on the worker's event loop thread and wait for its result. The coroutine runs inside the current
+    app context, so it can read the config, but it shouldn't use the database session.
+    :param timeout: Seconds to wait at most, defaults to waiting as long as the coroutine runs
+    """
+    app = current_app._get_current_object()
+
+    async def run_in_app_context():
+        with app.app_context():
+            return await coroutine
+
+    return asyncio.run_coroutine_threadsafe(run_in_app_context(), event_loop_thread.get_loop()).result(timeout)
+
+
+class AsyncHttpClient:
+    """
+    Async counterpart of `http_client.HttpClient` built on httpx, with the same timeouts, retries and per-upstream
+    metrics. Each event loop gets one `httpx.AsyncClient`, whose pool keeps up to `HTTP_POOL_SIZE` keep-alive
+    connections per host and many more requests in flight.
+    """
+
+    def __init__(self):
+        self._clients = {}
+        self._lock = threading.Lock()
+
+    def _get_client(self) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None:
+                config = current_app.config
+                client = httpx.AsyncClient(
+                    timeout=httpx.Timeout(config['HTTP_READ_TIMEOUT'], connect=config['HTTP_CONNECT_TIMEOUT']),
+                    limits=httpx.Limits(max_keepalive_connections=config['HTTP_POOL_SIZE']))
+                self._clients[loop] = client
+            return client
+
+    async def request(self, method: str, url: str, upstream: str = None, idempotent: bool = None,
+                      **kwargs) -> httpx.Response:
+        """
+        Send a request with the current event loop's client.
+        :param upstream: Name to record metrics under, defaults to the host
+        :param idempotent: Whether the request may be retried, defaults to whether the method is idempotent
+        :param kwargs: Passed to `httpx.AsyncClient.request`
+        :raises httpx.HTTPError: If the request failed on every attempt
+        """
+        upstream = upstream or urlsplit(url).netloc
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        retries = current_app.config['HTTP_MAX_RETRIES'] if idempotent else 0
+        client = self._get_client()
+
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                response = await client.request(method, url, **kwargs)
+            except (httpx.TransportError, httpx.TimeoutException):
+                http_client.record(upstream, time.monotonic() - start, error=True, retried=attempt > 0)
+                if attempt == retries:
+                    raise
+                await asyncio.sleep(backoff_delay(attempt))
+                continue
+
+            failed = response.status_code >= 500 or response.status_code == 429
+            http_client.record(upstream, time.monotonic() - start, error=failed, retried=attempt > 0)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            await asyncio.sleep(backoff_delay(attempt, response.headers.get('Retry-After')))
+
+
+async_http_client = AsyncHttpClient()
+
+
+async def get(url: str, **kwargs) -> httpx.Response:
+    return await async_http_client.request('GET', url, **kwargs)
+
+
+async def post(url: str, **kwargs) -> httpx.Response:
+    return await async_http_client.request('POST', url, **kwargs)
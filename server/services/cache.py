@@ -0,0 +1,119 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+_MISSING = object()
+
+
+class _Flight:
+    """A load in progress that concurrent misses for the same key wait on"""
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._value = None
+        self._error = None
+
+    def finish(self, value=None, error: BaseException = None) -> None:
+        self._value = value
+        self._error = error
+        self._done.set()
+
+    def wait(self):
+        self._done.wait()
+        if self._error is not None:
+            raise self._error
+        return self._value
+
+
+class TTLCache:
+    """
+    Thread-safe in-process cache. Entries expire `ttl` seconds after they are set, and the least recently used entry
+    is evicted once `maxsize` entries are stored. Lookups are counted in `hits` and `misses`.
+    """
+
+    def __init__(self, ttl: float, maxsize: int = 1024):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        # Misses that waited for another caller's load instead of loading themselves
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key):
+        """Must be called with the lock held"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return _MISSING
+        value, expires = entry
+        if time.monotonic() >= expires:
+            del self._entries[key]
+            self.misses += 1
+            return _MISSING
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def get_or_load(self, key, load, ttl: float = None):
+        """
+        Get a value, calling `load()` to compute and store it on a miss. Concurrent misses for the same key share a
+        single call to `load`, and all of them raise its exception if it fails. Failures aren't cached.
+        """
+        with self._lock:
+            value = self._lookup(key)
+            if value is not _MISSING:
+                return value
+            flight = self._flights.get(key)
+            is_loader = flight is None
+            if is_loader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        if not is_loader:
+            return flight.wait()
+
+        try:
+            value = load()
+        except BaseException as e:
+            flight.finish(error=e)
+            raise
+        else:
+            self.set(key, value, ttl=ttl)
+            flight.finish(value)
+            return value
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+
+    def set(self, key, value, ttl: float = None) -> None:
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key) -> None:
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
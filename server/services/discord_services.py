@@ -1,22 +1,296 @@
-import requests
+import asyncio
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import httpx
+from flask import current_app
 
 from server import db
 from server.models import ConnectedService, ConnectedAccount
+from server.services import async_http_client
+from server.services.async_http_client import run_async
+from server.services.media_processing import save_image, retain_image, release_image
+
+DISCORD_USER_URL = 'https://discord.com/api/users/@me'
+DISCORD_CDN_URL = 'https://cdn.discordapp.com'
+# Avatars are fetched at this size, a power of two no smaller than the largest of the `IMAGE_SIZES`
+DISCORD_AVATAR_FETCH_SIZE = 1024
+# Fields of a token response that `update_discord_tokens` stores
+DISCORD_TOKEN_FIELDS = {'access_token', 'refresh_token', 'expires_in'}
+
+
+class DiscordError(Exception):
+    def __init__(self, value):
+        super(DiscordError, self).__init__(value)
+
+
+async def _request_token(data: dict) -> httpx.Response:
+    data = {
+        'client_id': current_app.config['DISCORD_CLIENT_ID'],
+        'client_secret': current_app.config['DISCORD_CLIENT_SECRET'],
+        **data
+    }
+    headers = {
+        'Content-Type': 'application/x-www-form-urlencoded'
+    }
+    # Authorization codes and refresh tokens are single use, so this isn't retried
+    return await async_http_client.post(current_app.config['DISCORD_TOKEN_URL'], data=data, headers=headers,
+                                        upstream='discord')
+
+
+async def exchange_discord_code(code: str) -> dict:
+    """
+    Exchange an OAuth authorization code for Discord tokens.
+    :return: Discord's token response, without `access_token` if the code was invalid
+    """
+    response = await _request_token({
+        'grant_type': 'authorization_code',
+        'code': code,
+        'redirect_uri': current_app.config['DISCORD_REDIRECT_URI']
+    })
+    return response.json()
+
 
+async def renew_discord_token(refresh_token: str) -> dict:
+    """
+    Trade a refresh token for new tokens. Discord revokes the refresh token, so the response must be stored.
+    :return: Discord's token response
+    :raises DiscordError: If the refresh token was rejected
+    """
+    response = await _request_token({
+        'grant_type': 'refresh_token',
+        'refresh_token': refresh_token
+    })
+    token_data = response.json()
+    if response.status_code != 200 or not DISCORD_TOKEN_FIELDS <= token_data.keys():
+        raise DiscordError(response.text)
+    return token_data
 
-def fetch_discord_account_data(user_id: int) -> None:
-    # TODO error handling like refreshing n stuff
-    connected_discord_account = ConnectedAccount.query.filter_by(user_id=user_id, provider=ConnectedService.DISCORD).first()
 
+async def fetch_discord_user(access_token: str) -> dict:
+    """
+    :return: The Discord profile of the account the token belongs to
+    :raises DiscordError: If Discord rejected the token
+    """
     headers = {
-        'Authorization': f'Bearer {connected_discord_account.access_token}'
+        'Authorization': f'Bearer {access_token}'
     }
-    user_response = requests.get('https://discord.com/api/users/@me', headers=headers)
-    user_data = user_response.json()
+    response = await async_http_client.get(DISCORD_USER_URL, headers=headers, upstream='discord')
+    if response.status_code != 200:
+        raise DiscordError(response.text)
+    return response.json()
+
+
+async def fetch_discord_avatar(discord_user_id: str, avatar_hash: str) -> bytes:
+    """
+    Download an avatar from Discord's CDN. Animated avatars are fetched as a still PNG of their first frame.
+    :raises DiscordError: If the CDN doesn't have the avatar
+    """
+    response = await async_http_client.get(f'{DISCORD_CDN_URL}/avatars/{discord_user_id}/{avatar_hash}.png',
+                                           params={'size': DISCORD_AVATAR_FETCH_SIZE}, upstream='discord-cdn')
+    if response.status_code != 200:
+        raise DiscordError(f'Avatar {avatar_hash} unavailable: {response.status_code}')
+    return response.content
+
+
+def cache_discord_avatar(connected_discord_account: ConnectedAccount) -> str:
+    """
+    Store the account's current avatar alongside the uploaded images, in every configured size and format. Discord is
+    only called when the avatar hash has changed since the stored copy was fetched. When concurrent requests fetch the
+    same avatar, only the first to store it references it.
+    :return: ID of the stored image
+    :raises DiscordError: If the CDN doesn't have the avatar
+    :raises httpx.HTTPError: If the CDN couldn't be reached
+    :raises InvalidImageError: If the CDN didn't return an image
+    """
+    avatar_hash = connected_discord_account.profile_picture
+    if connected_discord_account.avatar_image_id is not None and connected_discord_account.avatar_hash == avatar_hash:
+        return connected_discord_account.avatar_image_id
+
+    previous_image_id = connected_discord_account.avatar_image_id
+    previous_hash = connected_discord_account.avatar_hash
+    content = run_async(fetch_discord_avatar(connected_discord_account.discord_user_id, avatar_hash))
+    stored_image = save_image(io.BytesIO(content))
+
+    # Only replace the avatar this request started from, so a concurrent request that stored it first isn't counted
+    # twice. The image is left unreferenced for the collector otherwise.
+    updated = db.session.execute(db.update(ConnectedAccount)
+                                 .where(ConnectedAccount.id == connected_discord_account.id,
+                                        ConnectedAccount.avatar_image_id == previous_image_id,
+                                        ConnectedAccount.avatar_hash == previous_hash)
+                                 .values(avatar_image_id=stored_image.id, avatar_hash=avatar_hash)).rowcount
+    if updated:
+        retain_image(stored_image.id)
+        release_image(previous_image_id)
+    db.session.commit()
+    return connected_discord_account.avatar_image_id
+
+
+def update_discord_tokens(connected_discord_account: ConnectedAccount, token_data: dict) -> None:
+    connected_discord_account.access_token = token_data['access_token']
+    connected_discord_account.refresh_token = token_data['refresh_token']
+    connected_discord_account.expires_at = datetime.now() + timedelta(seconds=token_data['expires_in'])
+
+
+def update_discord_account(connected_discord_account: ConnectedAccount, user_data: dict) -> None:
+    # Read before anything is assigned, so a profile missing a field leaves the account as it was
+    username, discord_user_id, avatar = user_data['username'], user_data['id'], user_data['avatar']
+    connected_discord_account.username = username
+    connected_discord_account.discord_user_id = discord_user_id
+    connected_discord_account.profile_picture = avatar
 
-    connected_discord_account.username = user_data['username']
-    connected_discord_account.discord_user_id = user_data['id']
-    connected_discord_account.profile_picture = user_data['avatar']
 
-    db.session.add(connected_discord_account)
+def _needs_renewal(connected_discord_account: ConnectedAccount, now: datetime) -> bool:
+    return (connected_discord_account.expires_at is not None
+            and connected_discord_account.expires_at < now + current_app.config['DISCORD_TOKEN_RENEWAL_MARGIN'])
+
+
+async def _refresh_account(access_token: str, refresh_token: str, renew: bool) -> tuple[dict | None, dict | Exception]:
+    """
+    Renew the account's tokens if needed, then fetch its profile.
+    :return: The renewed tokens or None, and the profile or the error fetching it. Renewed tokens are returned even if
+    the profile couldn't be fetched, since the old refresh token no longer works.
+    """
+    token_data = None
+    if renew:
+        token_data = await renew_discord_token(refresh_token)
+        access_token = token_data['access_token']
+    try:
+        return token_data, await fetch_discord_user(access_token)
+    except Exception as e:
+        return token_data, e
+
+
+async def _refresh_accounts(accounts: list[tuple[str, str, bool]]) -> list:
+    return await asyncio.gather(*(_refresh_account(*account) for account in accounts), return_exceptions=True)
+
+
+def refresh_discord_accounts(accounts: list[ConnectedAccount]) -> int:
+    """
+    Renew the tokens of accounts nearing expiry and refresh the usernames and avatars of a batch of Discord accounts,
+    with the Discord calls made concurrently. Accounts that fail are logged and left as they were. Discord revokes the
+    old refresh tokens, so the renewed ones are always stored, whatever happens to the other accounts of the batch.
+    :return: Number of accounts refreshed
+    """
+    now = datetime.now()
+    results = run_async(_refresh_accounts([(account.access_token, account.refresh_token, _needs_renewal(account, now))
+                                           for account in accounts]))
+
+    refreshed = 0
+    interrupted = None
+    for account, result in zip(accounts, results):
+        if isinstance(result, Exception):
+            current_app.logger.warning(f'Failed to renew Discord token of connected account {account.id}: {result}')
+            continue
+        if isinstance(result, BaseException):
+            # e.g. cancelled, raised once the tokens renewed for the other accounts are stored
+            interrupted = result
+            continue
+
+        token_data, user_data = result
+        if token_data is not None:
+            update_discord_tokens(account, token_data)
+        if isinstance(user_data, Exception):
+            current_app.logger.warning(f'Failed to fetch Discord profile of connected account {account.id}: '
+                                       f'{user_data}')
+            continue
+        try:
+            update_discord_account(account, user_data)
+        except KeyError as e:
+            current_app.logger.warning(f'Discord profile of connected account {account.id} is missing {e}')
+            continue
+        account.refreshed_at = now
+        refreshed += 1
+
     db.session.commit()
+    if interrupted is not None:
+        raise interrupted
+    return refreshed
+
+
+def refresh_due_discord_accounts(batch_size: int = None) -> int:
+    """
+    Refresh every Discord account whose token expires within `DISCORD_TOKEN_RENEWAL_MARGIN` or whose profile was
+    fetched more than `DISCORD_PROFILE_REFRESH_INTERVAL` ago. Meant to be run periodically from cron.
+    :param batch_size: Accounts refreshed concurrently, defaults to `DISCORD_REFRESH_BATCH_SIZE`
+    :return: Number of accounts refreshed
+    """
+    config = current_app.config
+    batch_size = batch_size or config['DISCORD_REFRESH_BATCH_SIZE']
+    now = datetime.now()
+    due = db.or_(ConnectedAccount.expires_at < now + config['DISCORD_TOKEN_RENEWAL_MARGIN'],
+                 ConnectedAccount.refreshed_at.is_(None),
+                 ConnectedAccount.refreshed_at < now - config['DISCORD_PROFILE_REFRESH_INTERVAL'])
+
+    refreshed = 0
+    last_id = 0
+    while True:
+        accounts = db.session.execute(
+            db.select(ConnectedAccount)
+            .where(ConnectedAccount.provider == ConnectedService.DISCORD,
+                   ConnectedAccount.access_token.is_not(None),
+                   ConnectedAccount.id > last_id,
+                   due)
+            .order_by(ConnectedAccount.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not accounts:
+            return refreshed
+        last_id = accounts[-1].id
+        refreshed += refresh_discord_accounts(accounts)
+
+
+class DiscordRefresher:
+    """
+    Fetches the profiles of newly connected Discord accounts on `DISCORD_REFRESH_WORKERS` background threads, so the
+    OAuth callback can redirect without waiting on Discord.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self, workers: int) -> ThreadPoolExecutor:
+        # Threads don't survive a fork, so each worker process creates its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='discord-refresh')
+            self._executor_pid = os.getpid()
+        return self._executor
+
+    def submit(self, account_id: int) -> None:
+        workers = current_app.config['DISCORD_REFRESH_WORKERS']
+        if workers <= 0:
+            self._refresh(account_id)
+            return
+
+        with self._lock:
+            executor = self._get_executor(workers)
+        app = current_app._get_current_object()
+        executor.submit(self._refresh_in_context, app, account_id)
+
+    @staticmethod
+    def _refresh(account_id: int) -> None:
+        account = db.session.get(ConnectedAccount, account_id)
+        if account is not None:
+            refresh_discord_accounts([account])
+
+    def _refresh_in_context(self, app, account_id: int) -> None:
+        # Runs on the executor's threads, where exceptions would be silently dropped with the future
+        with app.app_context():
+            try:
+                self._refresh(account_id)
+            except Exception:
+                db.session.rollback()
+                app.logger.exception(f'Failed to refresh connected account {account_id}')
+
+    def shutdown(self) -> None:
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+discord_refresher = DiscordRefresher()
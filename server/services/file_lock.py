@@ -0,0 +1,76 @@
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+
+# Seconds between attempts to find a free slot in `slot_lock`
+SLOT_POLL_INTERVAL = 0.01
+
+# Used instead of file locks where fcntl isn't available, which only coordinates threads of the same process
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def _thread_lock(path: str) -> threading.Lock:
+    with _thread_locks_lock:
+        return _thread_locks.setdefault(os.path.abspath(path), threading.Lock())
+
+
+@contextmanager
+def file_lock(path: str, blocking: bool = True):
+    """
+    Hold an exclusive lock shared by every process on this machine, using `flock` on the file at `path`.
+    :param blocking: Whether to wait for the lock, or give up right away if another process holds it
+    :return: Context manager yielding whether the lock was acquired
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if fcntl is None:
+        lock = _thread_lock(path)
+        acquired = lock.acquire(blocking=blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                lock.release()
+        return
+
+    with open(path, 'a') as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+@contextmanager
+def slot_lock(directory: str, slots: int, timeout: float = 0):
+    """
+    Hold one of `slots` file locks in `directory`, a semaphore shared by every process on this machine. Locks are
+    released by the OS when their process dies, so a crashed worker never leaks a slot.
+    :param timeout: Seconds to wait for a free slot, 0 to give up right away
+    :return: Context manager yielding whether a slot was acquired
+    """
+    deadline = time.monotonic() + timeout
+    # Start at a random slot so concurrent callers don't all contend for the first one
+    start = random.randrange(slots) if slots > 0 else 0
+    while True:
+        for i in range(slots):
+            with file_lock(os.path.join(directory, f'slot-{(start + i) % slots}.lock'), blocking=False) as acquired:
+                if acquired:
+                    yield True
+                    return
+        if time.monotonic() >= deadline:
+            yield False
+            return
+        time.sleep(SLOT_POLL_INTERVAL)
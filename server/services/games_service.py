@@ -1,10 +1,29 @@
+import asyncio
+import csv
+import json
+import os
+import re
+import threading
 import time
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from enum import Enum
 
+import httpx
 import requests
 from flask import current_app
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError, OperationalError
 
+from server import db
 from server.models import IgdbGame
+from server.models.post import IGDB_GAME_FTS_TABLE
+from server.services import async_http_client, http_client
+from server.services.async_http_client import run_async
+from server.services.cache import TTLCache
+from server.services.file_lock import file_lock
+from server.services.rate_limiter import RateLimiter, RateLimitExceededError
 
 
 class IGDBError(Exception):
@@ -12,19 +31,88 @@ class IGDBError(Exception):
         super(IGDBError, self).__init__(value)
 
 
+class IGDBRateLimitError(IGDBError):
+    """Raised when a request to IGDB would have to wait too long to stay under the rate limit"""
+    def __init__(self, value):
+        super(IGDBRateLimitError, self).__init__(value)
+
+
+class IGDBPriority(Enum):
+    """Requests made for a user waiting on the response go before background work"""
+    INTERACTIVE = 'interactive'
+    BACKGROUND = 'background'
+
+
+# Priority of IGDB requests made in the current context
+_igdb_priority = ContextVar('igdb_priority', default=IGDBPriority.INTERACTIVE)
+
+
 class IGDBTokenHandler:
+    """
+    Keeps the Twitch OAuth token for IGDB in a file shared by all worker processes, so they don't each fetch their own.
+    The token is refreshed `IGDB_TOKEN_REFRESH_MARGIN` seconds before it expires, by one process at a time while the
+    others keep using the current token. Processes only wait for a refresh when they have no valid token at all.
+    """
+
     def __init__(self):
         self._token = None
         self._expires = None
 
+    @staticmethod
+    def _token_path() -> str:
+        return current_app.config.get('IGDB_TOKEN_FILE') or os.path.join(current_app.instance_path, 'igdb_token.json')
+
+    @staticmethod
+    def _read_token_file(path: str) -> tuple[str | None, float | None]:
+        try:
+            with open(path) as token_file:
+                stored = json.load(token_file)
+            return stored['access_token'], stored['expires_at']
+        except (OSError, ValueError, KeyError):
+            return None, None
+
+    @staticmethod
+    def _write_token_file(path: str, token: str, expires: float) -> None:
+        # Written then renamed, so other processes never read a partial file
+        temp_path = f'{path}.{os.getpid()}.tmp'
+        with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as token_file:
+            json.dump({'access_token': token, 'expires_at': expires}, token_file)
+        os.replace(temp_path, path)
+
+    def _needs_refresh(self) -> bool:
+        return (not self._token or not self._expires
+                or time.time() > self._expires - current_app.config['IGDB_TOKEN_REFRESH_MARGIN'])
+
+    def _fetch_token(self) -> tuple[str, float]:
+        # Requesting another client credentials token is harmless, so it can be retried
+        response = http_client.post(f'https://id.twitch.tv/oauth2/token?'
+                                    f'client_id={current_app.config["IGDB_CLIENT_ID"]}&'
+                                    f'client_secret={current_app.config["IGDB_CLIENT_SECRET"]}&'
+                                    f'grant_type=client_credentials',
+                                    upstream='twitch', idempotent=True)
+        if response.status_code != 200:
+            raise IGDBError(response.text)
+        return response.json()['access_token'], time.time() + response.json()['expires_in']
+
     def get_token(self):
-        if not self._token or not self._expires or time.time() > self._expires:
-            response = requests.post(f'https://id.twitch.tv/oauth2/token?'
-                                     f'client_id={current_app.config["IGDB_CLIENT_ID"]}&'
-                                     f'client_secret={current_app.config["IGDB_CLIENT_SECRET"]}&'
-                                     f'grant_type=client_credentials')
-            self._token = response.json()['access_token']
-            self._expires = time.time() + response.json()['expires_in']
+        if not self._needs_refresh():
+            return self._token
+
+        path = self._token_path()
+        self._token, self._expires = self._read_token_file(path)
+        if not self._needs_refresh():
+            return self._token
+
+        have_valid_token = self._token is not None and time.time() < self._expires
+        with file_lock(f'{path}.lock', blocking=not have_valid_token) as acquired:
+            if not acquired:
+                # Another process is refreshing, the current token is still good until then
+                return self._token
+            # The process that held the lock may have just refreshed it
+            self._token, self._expires = self._read_token_file(path)
+            if self._needs_refresh():
+                self._token, self._expires = self._fetch_token()
+                self._write_token_file(path, self._token, self._expires)
         return self._token
 
     def get_headers(self):
@@ -36,6 +124,9 @@ class IGDBTokenHandler:
 
 igdb_token_handler = IGDBTokenHandler()
 
+# Search results keyed by normalized search term. Only used when IGDB_SEARCH_CACHE_TTL > 0.
+_search_cache = TTLCache(ttl=0, maxsize=1024)
+
 
 def _update_image_urls(game, artwork=True, cover=True):
     # Increase image resolution and add protocol
@@ -49,10 +140,56 @@ def _update_image_urls(game, artwork=True, cover=True):
     return game
 
 
-def search_igdb_games(game_name):
+def _igdb_rate_limiter() -> RateLimiter:
+    path = current_app.config.get('IGDB_RATE_LIMIT_FILE') or os.path.join(current_app.instance_path,
+                                                                          'igdb_rate_limit.json')
+    return RateLimiter(path)
+
+
+def _wait_for_igdb_slot() -> None:
+    """
+    Wait until a request fits under `IGDB_RATE_LIMIT`, shared by all worker processes. Background requests leave
+    `IGDB_RATE_LIMIT_RESERVE` requests of the burst to interactive ones and may wait longer.
+    :raises IGDBRateLimitError: If the request would have to wait too long
+    """
+    config = current_app.config
+    if _igdb_priority.get() == IGDBPriority.BACKGROUND:
+        max_wait, reserve = config['IGDB_RATE_LIMIT_BACKGROUND_MAX_WAIT'], config['IGDB_RATE_LIMIT_RESERVE']
+    else:
+        max_wait, reserve = config['IGDB_RATE_LIMIT_MAX_WAIT'], 0
+    try:
+        _igdb_rate_limiter().acquire(config['IGDB_RATE_LIMIT'], config['IGDB_RATE_LIMIT_BURST'], max_wait, reserve)
+    except RateLimitExceededError as e:
+        raise IGDBRateLimitError(str(e))
+
+
+def _query_igdb(url: str, data: str) -> requests.Response:
+    """IGDB queries are POSTs that only read, so they are retried like GETs"""
+    _wait_for_igdb_slot()
+    try:
+        return http_client.post(url, headers=igdb_token_handler.get_headers(), data=data, upstream='igdb',
+                                idempotent=True)
+    except requests.RequestException as e:
+        raise IGDBError(str(e))
+
+
+async def _query_igdb_async(url: str, data: str) -> httpx.Response:
+    """
+    Like `_query_igdb`, but awaited on the event loop so several queries can be in flight at once. The token and the
+    rate limit slot only need file locks, and are awaited together on worker threads.
+    """
+    headers, _ = await asyncio.gather(asyncio.to_thread(igdb_token_handler.get_headers),
+                                      asyncio.to_thread(_wait_for_igdb_slot))
+    try:
+        return await async_http_client.post(url, headers=headers, data=data, upstream='igdb', idempotent=True)
+    except httpx.HTTPError as e:
+        raise IGDBError(str(e))
+
+
+def _fetch_search_results(game_name):
     url = "https://api.igdb.com/v4/games"
     data = f'search "{game_name}"; fields name, cover.url, first_release_date, artworks.url, summary; limit 20;'
-    response = requests.post(url, headers=igdb_token_handler.get_headers(), data=data)
+    response = _query_igdb(url, data)
     if response.status_code != 200:
         raise IGDBError(response.text)
 
@@ -63,16 +200,130 @@ def search_igdb_games(game_name):
     return games
 
 
+def _normalize_search_term(game_name: str) -> str:
+    return ' '.join(game_name.lower().split())
+
+
+def search_local_catalog(game_name: str, limit: int = 20) -> list[IgdbGame]:
+    """
+    Search the games imported into the `igbd_game` table by name, matching the start of each word. Uses the full text
+    index on SQLite.
+    :return: At most `limit` games, best matches first
+    """
+    words = re.findall(r'\w+', game_name)
+    if not words:
+        return []
+
+    if db.engine.dialect.name == 'sqlite':
+        match = ' '.join(f'"{word}"*' for word in words)
+        try:
+            return list(db.session.execute(
+                db.select(IgdbGame).from_statement(db.text(
+                    f'SELECT igbd_game.* FROM {IGDB_GAME_FTS_TABLE} '
+                    f'JOIN igbd_game ON igbd_game.id = {IGDB_GAME_FTS_TABLE}.rowid '
+                    f'WHERE {IGDB_GAME_FTS_TABLE} MATCH :match AND igbd_game.imported '
+                    f'ORDER BY {IGDB_GAME_FTS_TABLE}.rank LIMIT :limit'
+                ).bindparams(match=match, limit=limit))
+            ).scalars())
+        except OperationalError:
+            # The index doesn't exist until the database has been upgraded
+            pass
+
+    query = db.select(IgdbGame).where(IgdbGame.imported)
+    for word in words:
+        query = query.where(IgdbGame.name.ilike(f'%{word}%'))
+    return list(db.session.execute(query.order_by(IgdbGame.name).limit(limit)).scalars())
+
+
+def _model_to_api_response(igdb_game: IgdbGame) -> dict:
+    """The inverse of `api_response_to_model`, so local results look like IGDB's"""
+    game = {'id': igdb_game.id, 'name': igdb_game.name, 'summary': igdb_game.summary or ''}
+    if igdb_game.cover:
+        game['cover'] = {'url': igdb_game.cover}
+    if igdb_game.artwork:
+        game['artworks'] = [{'url': igdb_game.artwork}]
+    if igdb_game.first_release_date:
+        game['first_release_date'] = int(igdb_game.first_release_date.timestamp())
+    return game
+
+
+def search_igdb_games(game_name):
+    """
+    Search for games by name. When `IGDB_CATALOG_SEARCH` is set, games imported with `import_catalog` are returned
+    without calling IGDB, which is only searched when no imported game matches. IGDB results are cached for
+    `IGDB_SEARCH_CACHE_TTL` seconds by normalized search term, and concurrent identical searches share a single IGDB
+    request.
+    :return: Games in the shape of IGDB's API responses
+    :raises IGDBError: If IGDB returned an error
+    """
+    ttl = current_app.config.get('IGDB_SEARCH_CACHE_TTL', 0)
+    search_term = _normalize_search_term(game_name)
+    if current_app.config.get('IGDB_CATALOG_SEARCH', False):
+        local_games = search_local_catalog(search_term)
+        if local_games:
+            return [_model_to_api_response(igdb_game) for igdb_game in local_games]
+    if ttl <= 0:
+        return _fetch_search_results(search_term)
+    return _search_cache.get_or_load(search_term, lambda: _fetch_search_results(search_term), ttl=ttl)
+
+
+def search_cache_stats() -> dict:
+    """Size, hits, misses and coalesced misses of this process's search cache"""
+    return _search_cache.stats()
+
+
+def clear_search_cache() -> None:
+    _search_cache.clear()
+
+
 def get_game(game_id):
     url = 'https://api.igdb.com/v4/games/'
     data = f'fields name, summary, cover.url, first_release_date, artworks.url; where id = {game_id};'
-    response = requests.post(url, headers=igdb_token_handler.get_headers(), data=data)
+    response = _query_igdb(url, data)
     if response.status_code != 200:
         raise IGDBError(response.text)
     game = _update_image_urls(response.json()[0])
     return game
 
 
+def get_games(game_ids: list[int]) -> list:
+    """
+    Fetch several games from IGDB in a single request.
+    :param game_ids: At most `IGDB_BATCH_LIMIT` IGDB IDs
+    :return: The games IGDB knows about, in no particular order
+    """
+    url = 'https://api.igdb.com/v4/games/'
+    ids = ','.join(str(int(game_id)) for game_id in game_ids)
+    data = (f'fields name, summary, cover.url, first_release_date, artworks.url; where id = ({ids}); '
+            f'limit {len(game_ids)};')
+    response = _query_igdb(url, data)
+    if response.status_code != 200:
+        raise IGDBError(response.text)
+    return [_update_image_urls(game) for game in response.json()]
+
+
+async def get_games_async(game_ids: list[int]) -> list:
+    """
+    Fetch any number of games from IGDB, with batches of `IGDB_BATCH_LIMIT` requested concurrently.
+    :return: The games IGDB knows about, in no particular order
+    """
+    url = 'https://api.igdb.com/v4/games/'
+    batch_limit = current_app.config['IGDB_BATCH_LIMIT']
+
+    async def get_batch(batch):
+        ids = ','.join(str(int(game_id)) for game_id in batch)
+        data = (f'fields name, summary, cover.url, first_release_date, artworks.url; where id = ({ids}); '
+                f'limit {len(batch)};')
+        response = await _query_igdb_async(url, data)
+        if response.status_code != 200:
+            raise IGDBError(response.text)
+        return [_update_image_urls(game) for game in response.json()]
+
+    batches = await asyncio.gather(*(get_batch(game_ids[i:i + batch_limit])
+                                     for i in range(0, len(game_ids), batch_limit)))
+    return [game for batch in batches for game in batch]
+
+
 def api_response_to_model(game):
     return IgdbGame(id=game['id'],
                     name=game['name'],
@@ -80,3 +331,251 @@ def api_response_to_model(game):
                     artwork=game['artworks'][0]['url'] if 'artworks' in game else None,
                     summary=game['summary'] if 'summary' in game else '',
                     first_release_date=datetime.fromtimestamp(game['first_release_date']) if 'first_release_date' in game else None,)
+
+
+def _update_from_response(igdb_game: IgdbGame, game) -> None:
+    fresh_game = api_response_to_model(game)
+    for column in ('name', 'cover', 'artwork', 'summary', 'first_release_date'):
+        setattr(igdb_game, column, getattr(fresh_game, column))
+    igdb_game.fetched_at = datetime.now(timezone.utc)
+
+
+def _is_stale(igdb_game: IgdbGame) -> bool:
+    if igdb_game.fetched_at is None:
+        return True
+    fetched_at = igdb_game.fetched_at
+    if fetched_at.tzinfo is None:
+        # SQLite doesn't keep the timezone
+        fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - fetched_at > current_app.config['IGDB_GAME_CACHE_TTL']
+
+
+def refresh_game(game_id: int) -> None:
+    """Fetch a game from IGDB and update its `igbd_game` row"""
+    game = get_game(game_id)
+    igdb_game = db.session.get(IgdbGame, game_id)
+    if igdb_game is None:
+        return
+    _update_from_response(igdb_game, game)
+    db.session.commit()
+
+
+class GameRefresher:
+    """
+    Refreshes stale `igbd_game` rows from IGDB on `IGDB_REFRESH_WORKERS` background threads, so requests never wait on
+    IGDB for a game that is already stored. Each game is only refreshed once at a time.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._executor_pid = None
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def _get_executor(self, workers: int) -> ThreadPoolExecutor:
+        # Threads don't survive a fork, so each worker process creates its own
+        if self._executor is None or self._executor_pid != os.getpid():
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='igdb-refresh')
+            self._executor_pid = os.getpid()
+            self._in_flight = set()
+        return self._executor
+
+    def submit(self, game_id: int) -> None:
+        workers = current_app.config['IGDB_REFRESH_WORKERS']
+        if workers <= 0:
+            self._refresh(game_id)
+            return
+
+        with self._lock:
+            executor = self._get_executor(workers)
+            if game_id in self._in_flight:
+                return
+            self._in_flight.add(game_id)
+        app = current_app._get_current_object()
+        executor.submit(self._refresh_in_context, app, game_id)
+
+    @staticmethod
+    def _refresh(game_id: int) -> None:
+        priority = _igdb_priority.set(IGDBPriority.BACKGROUND)
+        try:
+            refresh_game(game_id)
+        except (IGDBError, requests.RequestException) as e:
+            # The stored row is still served, and the next lookup tries again
+            db.session.rollback()
+            current_app.logger.warning(f'Failed to refresh IGDB game {game_id}: {e}')
+        finally:
+            _igdb_priority.reset(priority)
+
+    def _refresh_in_context(self, app, game_id: int) -> None:
+        # Runs on the executor's threads, where exceptions would be silently dropped with the future
+        try:
+            with app.app_context():
+                try:
+                    self._refresh(game_id)
+                except Exception:
+                    db.session.rollback()
+                    app.logger.exception(f'Failed to refresh IGDB game {game_id}')
+        finally:
+            with self._lock:
+                self._in_flight.discard(game_id)
+
+    def shutdown(self) -> None:
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+game_refresher = GameRefresher()
+
+
+def get_cached_game(game_id: int) -> IgdbGame:
+    """
+    Read-through lookup of a game in the `igbd_game` table. Games that aren't stored yet are fetched from IGDB and
+    stored. Stored games are returned right away, and refreshed in the background once they are older than
+    `IGDB_GAME_CACHE_TTL`.
+    :param game_id: IGDB ID of the game
+    :return: The stored game, attached to the current session
+    :raises IGDBError: If the game isn't stored and couldn't be fetched from IGDB
+    """
+    igdb_game = db.session.get(IgdbGame, game_id)
+    if igdb_game is not None:
+        if _is_stale(igdb_game):
+            game_refresher.submit(game_id)
+        return igdb_game
+
+    igdb_game = _store_game(get_game(game_id))
+    db.session.commit()
+    return igdb_game
+
+
+def get_cached_games(game_ids: list[int]) -> list[IgdbGame]:
+    """
+    Read-through lookup of several games like `get_cached_game`, with all the games that aren't stored yet fetched in
+    one IGDB request. More than `IGDB_BATCH_LIMIT` missing games are fetched in batches sent concurrently.
+    :param game_ids: IGDB IDs of the games
+    :return: The games in the order they were requested, without IDs IGDB doesn't know
+    :raises IGDBError: If some games aren't stored and couldn't be fetched from IGDB
+    """
+    game_ids = list(dict.fromkeys(game_ids))
+    games = {igdb_game.id: igdb_game
+             for igdb_game in db.session.execute(db.select(IgdbGame).where(IgdbGame.id.in_(game_ids))).scalars()}
+    for igdb_game in games.values():
+        if _is_stale(igdb_game):
+            game_refresher.submit(igdb_game.id)
+
+    missing_ids = [game_id for game_id in game_ids if game_id not in games]
+    if missing_ids:
+        if len(missing_ids) > current_app.config['IGDB_BATCH_LIMIT']:
+            fetched_games = run_async(get_games_async(missing_ids))
+        else:
+            fetched_games = get_games(missing_ids)
+        for game in fetched_games:
+            igdb_game = _store_game(game)
+            games[igdb_game.id] = igdb_game
+        db.session.commit()
+    return [games[game_id] for game_id in game_ids if game_id in games]
+
+
+def _store_game(game) -> IgdbGame:
+    """Add a game from an IGDB response to the `igbd_game` table. Doesn't commit."""
+    igdb_game = api_response_to_model(game)
+    igdb_game.fetched_at = datetime.now(timezone.utc)
+    try:
+        with db.session.begin_nested():
+            db.session.add(igdb_game)
+    except IntegrityError:
+        # Another request stored the game first
+        return db.session.get(IgdbGame, igdb_game.id)
+    return igdb_game
+
+
+def _read_catalog(path: str):
+    """
+    Yield the records of an IGDB catalog dump. CSV files need a header row, JSON files are either an array of games
+    or one game per line. The latter is streamed, so use it for large dumps.
+    """
+    if path.lower().endswith('.csv'):
+        with open(path, newline='', encoding='utf-8') as catalog_file:
+            yield from csv.DictReader(catalog_file)
+        return
+
+    with open(path, encoding='utf-8') as catalog_file:
+        first_char = catalog_file.read(1)
+        while first_char.isspace():
+            first_char = catalog_file.read(1)
+        catalog_file.seek(0)
+        if first_char == '[':
+            yield from json.load(catalog_file)
+        else:
+            for line in catalog_file:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _catalog_values(record: dict) -> dict | None:
+    """
+    Column values for a catalog record, or None if it has no ID or name. Records can either be shaped like IGDB API
+    responses, with `cover.url` and `artworks.url` expanded, or flat with `cover` and `artwork` URL columns.
+    """
+    if not record.get('id') or not record.get('name'):
+        return None
+
+    if isinstance(record.get('cover'), dict) or isinstance(record.get('artworks'), list):
+        igdb_game = api_response_to_model(_update_image_urls(dict(record)))
+        cover, artwork, first_release_date = igdb_game.cover, igdb_game.artwork, igdb_game.first_release_date
+    else:
+        cover, artwork = record.get('cover') or None, record.get('artwork') or None
+        first_release_date = record.get('first_release_date')
+        first_release_date = datetime.fromtimestamp(int(first_release_date)) if first_release_date else None
+
+    return {
+        'id': int(record['id']),
+        'name': record['name'][:IgdbGame.name.type.length],
+        'cover': cover,
+        'artwork': artwork,
+        'summary': (record.get('summary') or '')[:IgdbGame.summary.type.length],
+        'first_release_date': first_release_date,
+        # Unknown age, so each game is refreshed from IGDB the first time it's looked up by ID
+        'fetched_at': None,
+        'imported': True,
+    }
+
+
+def _upsert_games(rows: list[dict]) -> None:
+    dialect = {'sqlite': sqlite, 'postgresql': postgresql}.get(db.engine.dialect.name)
+    if dialect is None:
+        for row in rows:
+            db.session.merge(IgdbGame(**row))
+        return
+    statement = dialect.insert(IgdbGame)
+    statement = statement.on_conflict_do_update(
+        index_elements=[IgdbGame.id],
+        set_={column: statement.excluded[column] for column in rows[0] if column != 'id'})
+    db.session.execute(statement, rows)
+
+
+def import_catalog(path: str, batch_size: int = 1000) -> int:
+    """
+    Insert or update every game in an IGDB catalog dump, committing in batches. Games are added to the local search
+    index as they are written.
+    :param path: CSV or JSON file, see `_read_catalog`
+    :return: Number of games imported
+    """
+    imported = 0
+    batch = []
+    for record in _read_catalog(path):
+        values = _catalog_values(record)
+        if values is None:
+            continue
+        batch.append(values)
+        if len(batch) >= batch_size:
+            _upsert_games(batch)
+            db.session.commit()
+            imported += len(batch)
+            batch = []
+
+    if batch:
+        _upsert_games(batch)
+        db.session.commit()
+        imported += len(batch)
+    return imported
@@ -0,0 +1,139 @@
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from flask import current_app
+from requests.adapters import HTTPAdapter
+
+# Methods that are safe to send again if the first attempt may or may not have reached the upstream
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+# Responses worth retrying, since the upstream didn't handle the request
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+
+def backoff_delay(attempt: int, retry_after: str = None) -> float:
+    """Seconds to wait before retrying, honouring a numeric Retry-After header up to `HTTP_RETRY_MAX_BACKOFF`"""
+    cap = current_app.config['HTTP_RETRY_MAX_BACKOFF']
+    if retry_after is not None and retry_after.isdigit():
+        return min(int(retry_after), cap)
+    # Full jitter, so workers that failed together don't retry together
+    return random.uniform(0, min(cap, current_app.config['HTTP_RETRY_BACKOFF'] * 2 ** attempt))
+
+
+class UpstreamStats:
+    """Latency and error counts for calls to one upstream"""
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def serialize(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'average_seconds': self.total_seconds / self.requests if self.requests else 0.0,
+            'max_seconds': self.max_seconds,
+        }
+
+
+class HttpClient:
+    """
+    Shared client for outbound API calls. Keeps one pooled keep-alive session per host so calls reuse connections
+    instead of paying a new TLS handshake, applies `HTTP_CONNECT_TIMEOUT`/`HTTP_READ_TIMEOUT` to every request, and
+    retries idempotent requests up to `HTTP_MAX_RETRIES` times with jittered exponential backoff.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._sessions_pid = None
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _get_session(self, host: str) -> requests.Session:
+        with self._lock:
+            # Pooled connections can't be shared with forked worker processes
+            if self._sessions_pid != os.getpid():
+                self._sessions = {}
+                self._sessions_pid = os.getpid()
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=current_app.config['HTTP_POOL_SIZE'])
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                self._sessions[host] = session
+            return session
+
+    def record(self, upstream: str, seconds: float, error: bool, retried: bool) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(upstream, UpstreamStats())
+            stats.requests += 1
+            stats.errors += error
+            stats.retries += retried
+            stats.total_seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+
+    def request(self, method: str, url: str, upstream: str = None, idempotent: bool = None,
+                **kwargs) -> requests.Response:
+        """
+        Send a request through the pooled session for its host.
+        :param upstream: Name to record metrics under, defaults to the host
+        :param idempotent: Whether the request may be retried, defaults to whether the method is idempotent. POSTs
+        that only read, like IGDB queries, can pass True.
+        :param kwargs: Passed to `requests.Session.request`. `timeout` defaults to the configured timeouts.
+        :raises requests.RequestException: If the request failed on every attempt
+        """
+        host = urlsplit(url).netloc
+        upstream = upstream or host
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', (current_app.config['HTTP_CONNECT_TIMEOUT'],
+                                      current_app.config['HTTP_READ_TIMEOUT']))
+        retries = current_app.config['HTTP_MAX_RETRIES'] if idempotent else 0
+        session = self._get_session(host)
+
+        for attempt in range(retries + 1):
+            start = time.monotonic()
+            try:
+                response = session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self.record(upstream, time.monotonic() - start, error=True, retried=attempt > 0)
+                if attempt == retries:
+                    raise
+                time.sleep(backoff_delay(attempt))
+                continue
+
+            failed = response.status_code >= 500 or response.status_code == 429
+            self.record(upstream, time.monotonic() - start, error=failed, retried=attempt > 0)
+            if response.status_code not in RETRY_STATUS_CODES or attempt == retries:
+                return response
+            time.sleep(backoff_delay(attempt, response.headers.get('Retry-After')))
+
+    def stats(self) -> dict:
+        """Metrics for each upstream called by this process"""
+        with self._lock:
+            return {upstream: stats.serialize() for upstream, stats in self._stats.items()}
+
+    def close(self) -> None:
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions = {}
+
+
+http_client = HttpClient()
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return http_client.request('GET', url, **kwargs)
+
+
+def post(url: str, **kwargs) -> requests.Response:
+    return http_client.request('POST', url, **kwargs)
@@ -1,37 +1,725 @@
+import base64
+import hashlib
+import io
+import math
+import multiprocessing
 import os
+import shutil
+import threading
+import time
 import uuid
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timedelta, timezone
 
-from PIL import Image
+from PIL import Image, ImageOps, UnidentifiedImageError
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
 
-from server.models import User
+from server import db
+from server.models import Post, UserProfile, ImageStatus, ImageBlob
+from server.services.file_lock import file_lock, slot_lock
+from server.services.user_service import invalidate_cached_user
 
+DEFAULT_IMAGE_SIZE = 'full'
+DEFAULT_IMAGE_FORMAT = 'jpeg'
+# Resizes first reduce by an integer factor until the image is within this factor of the target size
+RESIZE_REDUCING_GAP = 3.0
+# Maximum width/height of the placeholder clients show while the image loads
+PLACEHOLDER_SIZE = 8
 
-def save_image(image, max_size: int = 1024) -> str:
-    pfp_uuid = str(uuid.uuid4())
-    filename = pfp_uuid + '.jpg'
-    filepath = os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'], filename))
-    os.makedirs(os.path.dirname(filepath), exist_ok=True)
 
-    pfp = Image.open(image)
-    width, height = pfp.size
+class ImageFormat:
+    """An output encoding for stored images"""
+    def __init__(self, name: str, pil_format: str, extension: str, mimetype: str):
+        self.name = name
+        self.pil_format = pil_format
+        self.extension = extension
+        self.mimetype = mimetype
 
+
+# Keyed by the names used in the `IMAGE_FORMATS` config
+IMAGE_FORMATS = {
+    'avif': ImageFormat('avif', 'AVIF', 'avif', 'image/avif'),
+    'webp': ImageFormat('webp', 'WEBP', 'webp', 'image/webp'),
+    'jpeg': ImageFormat('jpeg', 'JPEG', 'jpg', 'image/jpeg'),
+}
+
+
+class StoredImage:
+    """What clients need to lay out an image before loading it, returned from the image processing workers"""
+    def __init__(self, image_id: str, width: int, height: int, placeholder: str):
+        self.id = image_id
+        self.width = width
+        self.height = height
+        self.placeholder = placeholder
+
+
+class ImageSizeError(ValueError):
+    def __init__(self, value):
+        super(ImageSizeError, self).__init__(value)
+
+
+class InvalidImageError(ValueError):
+    def __init__(self, value):
+        super(InvalidImageError, self).__init__(value)
+
+
+class ImageTooLargeError(InvalidImageError):
+    def __init__(self, value):
+        super(ImageTooLargeError, self).__init__(value)
+
+
+def _image_sizes() -> dict[str, int]:
+    """Configured variant names mapped to their maximum width/height, largest first"""
+    sizes = current_app.config['IMAGE_SIZES']
+    return dict(sorted(sizes.items(), key=lambda item: item[1], reverse=True))
+
+
+def _format_supported(image_format: ImageFormat) -> bool:
+    """Whether the installed Pillow can encode this format, e.g. AVIF needs Pillow 11.2+ or pillow-avif-plugin"""
+    Image.init()
+    return image_format.pil_format in Image.SAVE
+
+
+def _output_formats() -> list[ImageFormat]:
+    """Configured formats this server can encode, most preferred first. JPEG is always included as the fallback."""
+    formats = [IMAGE_FORMATS[name] for name in current_app.config['IMAGE_FORMATS']]
+    if IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT] not in formats:
+        formats.append(IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT])
+    return [image_format for image_format in formats if _format_supported(image_format)]
+
+
+def _variant_filename(image_id: str, size: str, image_format: ImageFormat = IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT]) -> str:
+    # The full size JPEG keeps the original naming so older uploads still resolve
+    if size == DEFAULT_IMAGE_SIZE:
+        return f'{image_id}.{image_format.extension}'
+    return f'{image_id}_{size}.{image_format.extension}'
+
+
+def _shard_directory(image_id: str) -> str:
+    """
+    Two-level fan-out directory an image's files are stored in, e.g. `3f/a2`, so no directory grows past a few hundred
+    entries per 65536 images. The ID is hashed first since older IDs are UUIDs rather than content hashes.
+    """
+    digest = hashlib.sha256(image_id.encode()).hexdigest()
+    return os.path.join(digest[:2], digest[2:4])
+
+
+def _variant_relpath(image_id: str, size: str, image_format: ImageFormat = IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT]) -> str:
+    return os.path.join(_shard_directory(image_id), _variant_filename(image_id, size, image_format))
+
+
+def _variant_path(image_id: str, size: str, image_format: ImageFormat = IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT]) -> str:
+    return os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'],
+                                        _variant_relpath(image_id, size, image_format)))
+
+
+def _flat_variant_path(image_id: str, size: str,
+                       image_format: ImageFormat = IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT]) -> str:
+    """Where a variant was stored before the sharded layout, until `migrate_upload_layout` has moved it"""
+    return os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'],
+                                        _variant_filename(image_id, size, image_format)))
+
+
+def _find_variant(image_id: str, size: str,
+                  image_format: ImageFormat = IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT]) -> str | None:
+    """Path of a stored variant in either layout, or None if it doesn't exist"""
+    for filepath in (_variant_path(image_id, size, image_format), _flat_variant_path(image_id, size, image_format)):
+        if os.path.exists(filepath):
+            return filepath
+    return None
+
+
+def validate_image_size(size: str | None) -> str:
+    """
+    :param size: Requested variant name, or None for the default
+    :return: The variant name to serve
+    :raises ImageSizeError: If the size is not configured
+    """
+    if size is None:
+        return DEFAULT_IMAGE_SIZE
+    if size not in current_app.config['IMAGE_SIZES']:
+        raise ImageSizeError(f'size must be one of {list(current_app.config["IMAGE_SIZES"])}')
+    return size
+
+
+def get_image_path(image_id: str, size: str = DEFAULT_IMAGE_SIZE) -> str:
+    """
+    Resolve the JPEG file for a size variant of an image. Falls back to the full size file for images uploaded before
+    the variant existed.
+    """
+    return (_find_variant(image_id, size)
+            or _find_variant(image_id, DEFAULT_IMAGE_SIZE)
+            or _variant_path(image_id, DEFAULT_IMAGE_SIZE))
+
+
+def negotiate_image_formats(accept_mimetypes=None) -> list[ImageFormat]:
+    """
+    Formats a client can be served, most preferred first. Only formats the client lists explicitly with a non-zero
+    quality count, since many clients send `*/*` without supporting newer formats and `q=0` refuses a format. JPEG is
+    always acceptable.
+    :param accept_mimetypes: The request's parsed `Accept` header, or None to only consider JPEG
+    """
+    accepted = set()
+    if accept_mimetypes is not None:
+        accepted = {mimetype.lower() for mimetype, quality in accept_mimetypes if quality > 0}
+    return [image_format for image_format in _output_formats()
+            if image_format.name == DEFAULT_IMAGE_FORMAT or image_format.mimetype in accepted]
+
+
+def resolve_image(image_id: str, size: str = DEFAULT_IMAGE_SIZE,
+                  accept_mimetypes=None) -> tuple[str, ImageFormat] | None:
+    """
+    Pick the stored file to serve for an image, preferring the smallest format the client accepts.
+    :param image_id: ID of the image
+    :param size: Size variant name
+    :param accept_mimetypes: The request's parsed `Accept` header, or None to only consider JPEG
+    :return: Path and format of the file, or None if the image doesn't exist
+    """
+    for image_format in negotiate_image_formats(accept_mimetypes):
+        filepath = _find_variant(image_id, size, image_format)
+        if filepath is not None:
+            return filepath, image_format
+
+    filepath = get_image_path(image_id, size)
+    if os.path.exists(filepath):
+        return filepath, IMAGE_FORMATS[DEFAULT_IMAGE_FORMAT]
+    return None
+
+
+def _content_hash(img: Image.Image) -> str:
+    """Hash of an image's decoded pixels, so identical images map to the same ID however they were encoded"""
+    digest = hashlib.sha256(f'{img.mode}:{img.width}x{img.height}:'.encode())
+    digest.update(img.tobytes())
+    return digest.hexdigest()
+
+
+def _placeholder(img: Image.Image) -> str:
+    """Tiny PNG data URI of an image for clients to stretch and blur while the real image loads"""
+    thumbnail = img.resize(_scaled_size(img.size, PLACEHOLDER_SIZE), Image.BOX, reducing_gap=RESIZE_REDUCING_GAP)
+    png = io.BytesIO()
+    thumbnail.save(png, 'PNG', optimize=True)
+    return 'data:image/png;base64,' + base64.b64encode(png.getvalue()).decode('ascii')
+
+
+def _scaled_size(size: tuple[int, int], max_size: int) -> tuple[int, int]:
+    """Fit `size` within a `max_size` square, keeping the aspect ratio. Sizes that already fit are returned as-is."""
+    width, height = size
     ratio = min(max_size / width, max_size / height)
-    new_width = int(width * ratio)
-    new_height = int(height * ratio)
+    if ratio >= 1:
+        return size
+    return max(1, int(width * ratio)), max(1, int(height * ratio))
+
+
+def _check_image_limits(image) -> Image.Image:
+    """
+    Enforce `IMAGE_MAX_BYTES` and `IMAGE_MAX_PIXELS` using only the file size and image header, before anything is
+    decoded.
+    :param image: File-like object containing the image, left at the start of the file
+    :return: The opened, not yet decoded image
+    :raises InvalidImageError: If the upload isn't an image format Pillow can read
+    :raises ImageTooLargeError: If the file or its dimensions exceed the configured limits
+    """
+    image.seek(0, os.SEEK_END)
+    if image.tell() > current_app.config['IMAGE_MAX_BYTES']:
+        raise ImageTooLargeError('Image file is too large')
+    image.seek(0)
+
+    try:
+        img = Image.open(image)
+    except Image.DecompressionBombError:
+        raise ImageTooLargeError('Image dimensions are too large')
+    except (UnidentifiedImageError, OSError):
+        raise InvalidImageError('Unsupported image format')
+    image.seek(0)
+
+    width, height = img.size
+    if width * height > current_app.config['IMAGE_MAX_PIXELS']:
+        raise ImageTooLargeError('Image dimensions are too large')
+    return img
+
+
+def _encode_variants(source, upload_directory: str, sizes: dict[str, int], formats: list) -> StoredImage:
+    """
+    Decode an image once and write every size variant in every format, named by the content hash of the normalized
+    largest variant. Encoding is skipped if an identical image is already stored. Metadata like EXIF and GPS tags is
+    dropped after its orientation is applied. Runs in the image processing workers, so it only takes plain values and
+    never touches the app or the database.
+    :param source: Path or file-like object of the original image
+    :param upload_directory: Absolute path of the upload directory, variants are written to their shard within it
+    :param sizes: Variant names mapped to their maximum width/height, largest first
+    :param formats: (ImageFormat, Pillow save options) pairs to encode each variant with
+    :return: The stored image's ID, the dimensions of its largest variant and its placeholder
+    """
+    img = Image.open(source)
+    # Let the JPEG decoder downscale by up to 8x while decoding, so the full resolution image is never held in memory.
+    # The draft is never smaller than the largest variant, which is scaled the same way whether or not it's rotated.
+    largest_width, largest_height = _scaled_size(img.size, max(sizes.values()))
+    img.draft('RGB', (largest_width, largest_height))
+    img = ImageOps.exif_transpose(img)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    stored_image = None
+    # Each variant is downscaled from the previous, larger one instead of the original
+    for size, max_size in sizes.items():
+        scaled_size = _scaled_size(img.size, max_size)
+        if scaled_size != img.size:
+            # Cheap integer-factor reduction first, then LANCZOS over the remaining factor
+            img = img.resize(scaled_size, Image.LANCZOS, reducing_gap=RESIZE_REDUCING_GAP)
+
+        if stored_image is None:
+            image_id = _content_hash(img)
+            stored_image = StoredImage(image_id, img.width, img.height, _placeholder(img))
+            # The smallest variant in the last format is written last, so if it exists the image is complete
+            last_relpath = _variant_relpath(image_id, list(sizes)[-1], formats[-1][0])
+            if os.path.exists(os.path.join(upload_directory, last_relpath)):
+                break
+            os.makedirs(os.path.join(upload_directory, _shard_directory(image_id)), exist_ok=True)
+
+        for image_format, options in formats:
+            # Encoder options never include exif/icc_profile, so no metadata is written
+            filepath = os.path.join(upload_directory, _variant_relpath(image_id, size, image_format))
+            # Write then rename, since identical uploads may be processed at the same time
+            temp_filepath = f'{filepath}.{uuid.uuid4().hex}.tmp'
+            img.save(temp_filepath, image_format.pil_format, **options)
+            os.replace(temp_filepath, filepath)
+
+    return stored_image
+
+
+def _process_staged_image(staged_path: str, upload_directory: str, sizes: dict[str, int], formats: list,
+                          slot_directory: str, slots: int) -> StoredImage:
+    """
+    Encode a staged upload once one of the machine's `slots` encoding slots is free. The staged file is kept until the
+    result has been recorded, so an upload whose worker died can be requeued by `recover_staged_uploads`.
+    """
+    with slot_lock(slot_directory, slots, timeout=math.inf):
+        return _encode_variants(staged_path, upload_directory, sizes, formats)
+
+
+def _encoding_args() -> tuple[str, dict[str, int], list]:
+    upload_directory = os.path.abspath(current_app.config['UPLOAD_DIRECTORY'])
+    os.makedirs(upload_directory, exist_ok=True)
+    formats = [(image_format, current_app.config['IMAGE_FORMATS'].get(image_format.name, {}))
+               for image_format in _output_formats()]
+    return upload_directory, _image_sizes(), formats
 
-    if ratio < 1:
-        pfp = pfp.resize((new_width, new_height))
 
-    if pfp.mode != 'RGB':
-        pfp = pfp.convert('RGB')
+def _staging_path(image_id: str) -> str:
+    return os.path.abspath(os.path.join(current_app.config['UPLOAD_STAGING_DIRECTORY'], image_id))
 
-    pfp.save(filepath, 'JPEG')
-    return pfp_uuid
+
+def _lock_directory() -> str:
+    return (current_app.config.get('IMAGE_PROCESSING_LOCK_DIRECTORY')
+            or os.path.join(current_app.instance_path, 'image-processing'))
+
+
+def _blob_lock(image_id: str):
+    """
+    Lock shared by every process on this machine, held while an image's blob is retained or collected. Images are
+    spread over 256 lock files by the first characters of their ID.
+    """
+    return file_lock(os.path.join(_lock_directory(), 'blobs', f'{image_id[:2]}.lock'))
+
+
+def _is_stored(image_id: str) -> bool:
+    """Whether every variant of an image has been written, checked the same way `_encode_variants` does"""
+    return _find_variant(image_id, list(_image_sizes())[-1], _output_formats()[-1]) is not None
+
+
+def _record_stored_image(stored_image: StoredImage, source, count: int = 0) -> None:
+    """
+    Retain an encoded image's blob and commit, then make sure its files are still there. Encoding is skipped when an
+    identical image is already stored, and `collect_unreferenced_images` may have deleted that image before its blob
+    was retained again, in which case it is encoded again from `source`.
+    :param source: Path or file-like object at the start of the original image
+    :param count: Number of posts and profiles that started using the image
+    """
+    with _blob_lock(stored_image.id):
+        retain_image(stored_image.id, count)
+        db.session.commit()
+        if not _is_stored(stored_image.id):
+            _encode_variants(source, *_encoding_args())
+
+
+def save_image(image) -> StoredImage:
+    """
+    Store every size in `IMAGE_SIZES` in every format in `IMAGE_FORMATS`, processing the image in the calling worker.
+    Its blob is committed without references, so the caller has `IMAGE_GC_GRACE_PERIOD` to record its reference with
+    `retain_image`.
+    :param image: File-like object containing the image
+    :return: The saved image, with its content-addressed ID
+    """
+    _check_image_limits(image)
+    upload_directory, sizes, formats = _encoding_args()
+    stored_image = _encode_variants(image, upload_directory, sizes, formats)
+    image.seek(0)
+    _record_stored_image(stored_image, image)
+    return stored_image
+
+
+def stage_upload(image) -> str:
+    """
+    Write an upload to the staging directory as-is, to be processed by `image_processor`. Only the image header is
+    parsed, so this is cheap even for large uploads.
+    :param image: File-like object containing the uploaded image
+    :return: Temporary ID of the upload, replaced with the content-addressed ID once it has been processed
+    :raises InvalidImageError: If the upload isn't an image format Pillow can read
+    :raises ImageTooLargeError: If the upload exceeds `IMAGE_MAX_BYTES` or `IMAGE_MAX_PIXELS`
+    """
+    _check_image_limits(image)
+
+    image_id = str(uuid.uuid4())
+    staged_path = _staging_path(image_id)
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    with open(staged_path, 'wb') as staged_file:
+        shutil.copyfileobj(image, staged_file)
+    return image_id
+
+
+def discard_staged_upload(image_id: str) -> None:
+    staged_path = _staging_path(image_id)
+    if os.path.exists(staged_path):
+        os.remove(staged_path)
+
+
+def _set_image_status(staged_id: str, status: ImageStatus, stored_image: StoredImage = None) -> int:
+    """
+    Update the status of every post and profile that uses a staged upload, pointing them at the processed image if
+    there is one. The profiles' users are dropped from this process's current user cache.
+    :return: Number of posts and profiles updated
+    """
+    post_values = {'image_status': status}
+    profile_values = {'profile_picture_status': status}
+    if stored_image is not None:
+        post_values.update(image_id=stored_image.id, image_width=stored_image.width,
+                           image_height=stored_image.height, image_placeholder=stored_image.placeholder)
+        profile_values.update(profile_picture_id=stored_image.id, profile_picture_width=stored_image.width,
+                              profile_picture_height=stored_image.height,
+                              profile_picture_placeholder=stored_image.placeholder)
+
+    updated = db.session.execute(db.update(Post)
+                                 .where(Post.image_id == staged_id)
+                                 .values(**post_values)).rowcount
+    user_ids = db.session.execute(db.select(UserProfile.user_id)
+                                  .where(UserProfile.profile_picture_id == staged_id)).scalars().all()
+    updated += db.session.execute(db.update(UserProfile)
+                                  .where(UserProfile.profile_picture_id == staged_id)
+                                  .values(**profile_values)).rowcount
+    for user_id in user_ids:
+        invalidate_cached_user(user_id)
+    return updated
+
+
+def retain_image(image_id: str, count: int = 1) -> None:
+    """
+    Record new references to a stored image, creating its blob row if needed. Doesn't commit.
+    :param image_id: Content-addressed ID of the image
+    :param count: Number of posts and profiles that started using it, may be 0 to only track the blob
+    """
+    updated = db.session.execute(db.update(ImageBlob)
+                                 .where(ImageBlob.id == image_id)
+                                 .values(ref_count=ImageBlob.ref_count + count,
+                                         updated_at=datetime.now(timezone.utc))).rowcount
+    if updated:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(ImageBlob(id=image_id, ref_count=count))
+    except IntegrityError:
+        # Another worker created the row first
+        retain_image(image_id, count)
+
+
+def release_image(image_id: str | None) -> None:
+    """
+    Drop a post's or profile's reference to an image. Images nothing references any more are removed by
+    `collect_unreferenced_images`. Uploads from before content addressing have no blob row and are deleted right
+    away. Doesn't commit.
+    """
+    if image_id is None:
+        return
+    updated = db.session.execute(db.update(ImageBlob)
+                                 .where(ImageBlob.id == image_id, ImageBlob.ref_count > 0)
+                                 .values(ref_count=ImageBlob.ref_count - 1,
+                                         updated_at=datetime.now(timezone.utc))).rowcount
+    if not updated and db.session.get(ImageBlob, image_id) is None:
+        delete_image(image_id)
+
+
+def collect_unreferenced_images(grace_period: timedelta = None) -> int:
+    """
+    Delete the files and blob rows of images that nothing has referenced for at least `grace_period`. The grace period
+    covers uploads that are still being processed and will reference an existing blob once they finish.
+    :param grace_period: Defaults to the `IMAGE_GC_GRACE_PERIOD` config
+    :return: Number of images deleted
+    """
+    if grace_period is None:
+        grace_period = current_app.config['IMAGE_GC_GRACE_PERIOD']
+    cutoff = datetime.now(timezone.utc) - grace_period
+
+    deleted = 0
+    blob_ids = db.session.execute(db.select(ImageBlob.id)
+                                  .where(ImageBlob.ref_count <= 0, ImageBlob.updated_at < cutoff)).scalars().all()
+    for blob_id in blob_ids:
+        # Uploads deduplicated against this image retain it under the same lock, so they either keep it from being
+        # deleted or see that its files are gone
+        with _blob_lock(blob_id):
+            # Re-check in the delete itself in case the image was retained again since the select
+            removed = db.session.execute(db.delete(ImageBlob)
+                                         .where(ImageBlob.id == blob_id, ImageBlob.ref_count <= 0,
+                                                ImageBlob.updated_at < cutoff)).rowcount
+            db.session.commit()
+            if removed:
+                delete_image(blob_id)
+                deleted += 1
+    return deleted
+
+
+class ImageProcessor:
+    """
+    Encodes staged uploads in a pool of worker processes, then marks the posts and profiles using them as ready, or as
+    failed if the image couldn't be processed. At most `IMAGE_PROCESSING_WORKERS` images are encoded at once across
+    every app process on the machine.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self, workers: int) -> ProcessPoolExecutor:
+        with self._lock:
+            # Pools don't survive a fork, so each worker process creates its own
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def submit(self, image_id: str) -> None:
+        """Process a staged upload. Must be called after the rows referencing `image_id` are committed."""
+        upload_directory, sizes, formats = _encoding_args()
+        workers = current_app.config['IMAGE_PROCESSING_WORKERS']
+        if workers <= 0:
+            future = Future()
+            try:
+                future.set_result(_encode_variants(_staging_path(image_id), upload_directory, sizes, formats))
+            except Exception as e:
+                future.set_exception(e)
+            self._finish(image_id, future)
+            return
+
+        app = current_app._get_current_object()
+        future = self._get_executor(workers).submit(_process_staged_image, _staging_path(image_id), upload_directory,
+                                                    sizes, formats, _lock_directory(), workers)
+        future.add_done_callback(lambda done: self._finish_in_context(app, image_id, done))
+
+    @staticmethod
+    def _finish(staged_id: str, future: Future) -> None:
+        if future.exception() is not None:
+            current_app.logger.error(f'Failed to process image {staged_id}: {future.exception()}')
+            _set_image_status(staged_id, ImageStatus.FAILED)
+        else:
+            stored_image = future.result()
+            # Posts deleted while their image was processing leave an unreferenced blob for the collector
+            _record_stored_image(stored_image, _staging_path(staged_id),
+                                 _set_image_status(staged_id, ImageStatus.READY, stored_image))
+        db.session.commit()
+        discard_staged_upload(staged_id)
+
+    @classmethod
+    def _finish_in_context(cls, app, image_id: str, future: Future) -> None:
+        # Runs on the executor's result thread, outside of any request, where exceptions would be silently dropped
+        with app.app_context():
+            try:
+                cls._finish(image_id, future)
+            except Exception:
+                db.session.rollback()
+                # The staged file is kept, so `recover_staged_uploads` retries the upload
+                app.logger.exception(f'Failed to record processed image {image_id}')
+
+    def shutdown(self) -> None:
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(wait=True)
+        self._executor = None
+
+
+image_processor = ImageProcessor()
+
+
+def recover_staged_uploads(stale_after: timedelta = None) -> tuple[int, int, int]:
+    """
+    Clean up after image processing workers that died, e.g. in a restart, before recording their result. Staged
+    uploads that posts or profiles are still waiting on are processed again, those nothing uses any more are deleted,
+    and posts and profiles whose staged upload is gone are marked as failed.
+    :param stale_after: Staged uploads last modified less than this long ago are assumed to still be processing.
+    Defaults to the `IMAGE_PROCESSING_TIMEOUT` config
+    :return: Number of uploads requeued, posts and profiles marked as failed, and staged files deleted
+    """
+    if stale_after is None:
+        stale_after = current_app.config['IMAGE_PROCESSING_TIMEOUT']
+    cutoff = time.time() - stale_after.total_seconds()
+    staging_directory = os.path.abspath(current_app.config['UPLOAD_STAGING_DIRECTORY'])
+
+    waiting = set(db.session.execute(db.select(Post.image_id)
+                                     .where(Post.image_status == ImageStatus.PROCESSING)).scalars())
+    waiting.update(db.session.execute(db.select(UserProfile.profile_picture_id)
+                                      .where(UserProfile.profile_picture_status == ImageStatus.PROCESSING)).scalars())
+
+    requeued = []
+    deleted = 0
+    if os.path.isdir(staging_directory):
+        with os.scandir(staging_directory) as entries:
+            for entry in entries:
+                if not entry.is_file(follow_symlinks=False) or entry.stat().st_mtime >= cutoff:
+                    continue
+                if entry.name in waiting:
+                    # Touched so the upload isn't requeued again while it is being processed
+                    os.utime(entry.path)
+                    requeued.append(entry.name)
+                else:
+                    os.remove(entry.path)
+                    deleted += 1
+
+    failed = 0
+    for staged_id in waiting:
+        if not os.path.exists(_staging_path(staged_id)):
+            failed += _set_image_status(staged_id, ImageStatus.FAILED)
+    db.session.commit()
+
+    for staged_id in requeued:
+        image_processor.submit(staged_id)
+    return len(requeued), failed, deleted
 
 
 def delete_image(image_id: str) -> None:
-    """Delete a profile picture"""
-    filepath = os.path.abspath(os.path.join(current_app.config['UPLOAD_DIRECTORY'], f'{image_id}.jpg'))
-    if os.path.exists(filepath):
-        os.remove(filepath)
+    """Delete every size and format variant of an image"""
+    if image_id is None:
+        return
+    for size in current_app.config['IMAGE_SIZES']:
+        for image_format in IMAGE_FORMATS.values():
+            filepath = _find_variant(image_id, size, image_format)
+            if filepath is not None:
+                os.remove(filepath)
+
+
+def _parse_variant_filename(filename: str) -> str | None:
+    """ID of the image a stored variant belongs to, or None if the file isn't an image variant"""
+    stem, _, extension = filename.rpartition('.')
+    if not stem or extension not in {image_format.extension for image_format in IMAGE_FORMATS.values()}:
+        return None
+    for size in current_app.config['IMAGE_SIZES']:
+        if size != DEFAULT_IMAGE_SIZE and stem.endswith(f'_{size}'):
+            return stem[:-len(size) - 1]
+    return stem
+
+
+def migrate_upload_layout() -> int:
+    """
+    Move image variants from the top level of `UPLOAD_DIRECTORY` into their shard directories. The directory is read
+    as a stream and each file is moved atomically, so an interrupted migration can simply be run again. Files that
+    aren't image variants, such as the default profile picture, and subdirectories like the staging directory are left
+    alone. Images are still served from the old layout until they have been moved.
+    :return: Number of files moved
+    """
+    upload_directory = os.path.abspath(current_app.config['UPLOAD_DIRECTORY'])
+    moved = 0
+    with os.scandir(upload_directory) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            image_id = _parse_variant_filename(entry.name)
+            if image_id is None:
+                continue
+
+            shard_directory = os.path.join(upload_directory, _shard_directory(image_id))
+            os.makedirs(shard_directory, exist_ok=True)
+            target_path = os.path.join(shard_directory, entry.name)
+            if os.path.exists(target_path):
+                # Already written in the new layout, e.g. by an identical upload since the migration started
+                os.remove(entry.path)
+            else:
+                os.replace(entry.path, target_path)
+            moved += 1
+    return moved
+
+
+def _scan_files(directory: str, skip_directory: str):
+    """Yield every file below `directory` except those in `skip_directory`, without listing whole directories"""
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if os.path.abspath(entry.path) != skip_directory:
+                    yield from _scan_files(entry.path, skip_directory)
+            elif entry.is_file(follow_symlinks=False):
+                yield entry
+
+
+def _delete_unreferenced_files(files: dict[str, list[str]]) -> int:
+    """
+    Delete the files of images that no post, profile or blob row references.
+    :param files: Image IDs mapped to the paths of their files
+    :return: Number of files deleted
+    """
+    image_ids = list(files)
+    referenced = set(db.session.execute(db.select(Post.image_id).where(Post.image_id.in_(image_ids))).scalars())
+    referenced.update(db.session.execute(db.select(UserProfile.profile_picture_id)
+                                         .where(UserProfile.profile_picture_id.in_(image_ids))).scalars())
+    # Blobs nothing references any more are left to `collect_unreferenced_images`
+    referenced.update(db.session.execute(db.select(ImageBlob.id).where(ImageBlob.id.in_(image_ids))).scalars())
+
+    deleted = 0
+    for image_id, filepaths in files.items():
+        if image_id in referenced:
+            continue
+        for filepath in filepaths:
+            try:
+                os.remove(filepath)
+                deleted += 1
+            except FileNotFoundError:
+                pass
+    return deleted
+
+
+def sweep_orphaned_files(grace_period: timedelta = None, batch_size: int = None) -> int:
+    """
+    Delete image files that nothing in the database references, e.g. from before reference counting or from workers
+    that crashed before recording their image. The upload directory is streamed and IDs are checked against the
+    database in batches, so memory use doesn't grow with the number of files. The staging directory is skipped.
+    :param grace_period: Only files last modified at least this long ago are deleted, so images still being
+    processed are kept. Defaults to the `IMAGE_GC_GRACE_PERIOD` config
+    :param batch_size: Image IDs checked per query, defaults to the `IMAGE_SWEEP_BATCH_SIZE` config
+    :return: Number of files deleted
+    """
+    if grace_period is None:
+        grace_period = current_app.config['IMAGE_GC_GRACE_PERIOD']
+    if batch_size is None:
+        batch_size = current_app.config['IMAGE_SWEEP_BATCH_SIZE']
+    cutoff = time.time() - grace_period.total_seconds()
+    upload_directory = os.path.abspath(current_app.config['UPLOAD_DIRECTORY'])
+    staging_directory = os.path.abspath(current_app.config['UPLOAD_STAGING_DIRECTORY'])
+
+    deleted = 0
+    batch = {}
+    for entry in _scan_files(upload_directory, staging_directory):
+        if entry.stat(follow_symlinks=False).st_mtime >= cutoff:
+            continue
+        if entry.name.endswith('.tmp'):
+            # Left behind by a worker that died while writing a variant
+            os.remove(entry.path)
+            deleted += 1
+            continue
+
+        image_id = _parse_variant_filename(entry.name)
+        if image_id is None:
+            continue
+        batch.setdefault(image_id, []).append(entry.path)
+        if len(batch) >= batch_size:
+            deleted += _delete_unreferenced_files(batch)
+            batch = {}
+
+    if batch:
+        deleted += _delete_unreferenced_files(batch)
+    return deleted
@@ -0,0 +1,67 @@
+import json
+import os
+import random
+import time
+
+from server.services.file_lock import file_lock
+
+
+class RateLimitExceededError(Exception):
+    """Raised when a request couldn't get through the rate limiter within its maximum wait"""
+    def __init__(self, value):
+        super(RateLimitExceededError, self).__init__(value)
+
+
+class RateLimiter:
+    """
+    Token bucket shared by every worker process on this machine through a small state file guarded by `file_lock`.
+    Callers that find the bucket empty sleep until a token should be available, up to their maximum wait. Callers can
+    leave `reserve` tokens in the bucket, so lower priority work backs off first and leaves headroom for the rest.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def _read_state(self, burst: int) -> tuple[float, float]:
+        try:
+            with open(self.path) as state_file:
+                state = json.load(state_file)
+            return state['tokens'], state['updated']
+        except (OSError, ValueError, KeyError):
+            return burst, time.time()
+
+    def _write_state(self, tokens: float, updated: float) -> None:
+        temp_path = f'{self.path}.{os.getpid()}.tmp'
+        with open(temp_path, 'w') as state_file:
+            json.dump({'tokens': tokens, 'updated': updated}, state_file)
+        os.replace(temp_path, self.path)
+
+    def _try_acquire(self, rate: float, burst: int, reserve: int) -> float:
+        """:return: 0 if a token was taken, otherwise seconds until enough tokens should be available"""
+        with file_lock(f'{self.path}.lock'):
+            tokens, updated = self._read_state(burst)
+            now = time.time()
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            if tokens >= 1 + reserve:
+                self._write_state(tokens - 1, now)
+                return 0
+            return (1 + reserve - tokens) / rate
+
+    def acquire(self, rate: float, burst: int, max_wait: float, reserve: int = 0) -> None:
+        """
+        Take a token, waiting for one if the bucket is empty.
+        :param rate: Tokens added per second
+        :param burst: Bucket size
+        :param max_wait: Seconds to wait at most
+        :param reserve: Tokens to leave for higher priority callers, less than `burst`
+        :raises RateLimitExceededError: If no token would be available within `max_wait`
+        """
+        deadline = time.monotonic() + max_wait
+        while True:
+            wait = self._try_acquire(rate, burst, reserve)
+            if wait == 0:
+                return
+            if time.monotonic() + wait > deadline:
+                raise RateLimitExceededError(f'No request slot available within {max_wait} seconds')
+            # Jitter so waiting workers don't all retry at the same moment
+            time.sleep(wait + random.uniform(0, 1 / rate))
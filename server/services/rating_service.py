@@ -0,0 +1,134 @@
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
+
+from server import db
+from server.models import Rating, RatingField, RatingFieldName, RatingSummary, RatingSummaryField, User
+
+# Most ratings returned per page of `get_ratings_page`
+MAX_RATINGS_PAGE_SIZE = 100
+
+
+def _rating_load_options() -> list:
+    """Load what `Rating.serialize` uses up front, in a fixed number of queries however many ratings are loaded"""
+    rater = selectinload(Rating.rating_user)
+    return [
+        selectinload(Rating.fields),
+        rater.joinedload(User.profile),
+        rater.selectinload(User.followers),
+        rater.selectinload(User.following),
+        rater.selectinload(User.communities),
+        rater.selectinload(User.connected_accounts),
+    ]
+
+
+def get_rating(giver_id: int, receiver_id: int) -> Rating | None:
+    """:return: The rating one user gave another, ready to serialize, or None if there is none"""
+    return db.session.execute(
+        db.select(Rating)
+        .options(*_rating_load_options())
+        .where(Rating.rating_user_id == giver_id, Rating.rated_user_id == receiver_id)
+    ).scalars().first()
+
+
+def get_ratings_page(giver_id: int = None, receiver_id: int = None, cursor: int = None,
+                     limit: int = 20) -> tuple[list[Rating], int | None]:
+    """
+    A page of the ratings a user gave or received, newest first, ready to serialize.
+    :param cursor: The `next_cursor` returned with the previous page, or None for the first page
+    :param limit: Ratings per page, at most `MAX_RATINGS_PAGE_SIZE`
+    :return: The ratings, and the cursor of the next page or None if this is the last page
+    """
+    limit = max(1, min(limit, MAX_RATINGS_PAGE_SIZE))
+    query = db.select(Rating).options(*_rating_load_options()).order_by(Rating.id.desc())
+    if giver_id is not None:
+        query = query.where(Rating.rating_user_id == giver_id)
+    if receiver_id is not None:
+        query = query.where(Rating.rated_user_id == receiver_id)
+    if cursor is not None:
+        query = query.where(Rating.id < cursor)
+
+    # One extra row tells whether there is another page
+    ratings = db.session.execute(query.limit(limit + 1)).scalars().all()
+    if len(ratings) > limit:
+        return ratings[:limit], ratings[limit - 1].id
+    return ratings, None
+
+
+def _adjust_row(model, key: dict, deltas: dict) -> None:
+    """Add `deltas` to the columns of the row identified by `key`, creating the row if needed. Doesn't commit."""
+    updated = db.session.execute(db.update(model)
+                                 .where(*(getattr(model, column) == value for column, value in key.items()))
+                                 .values({column: getattr(model, column) + delta
+                                          for column, delta in deltas.items()})).rowcount
+    if updated:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.add(model(**key, **deltas))
+    except IntegrityError:
+        # Another worker created the row first
+        _adjust_row(model, key, deltas)
+
+
+def _adjust_summary(rating: Rating, sign: int) -> None:
+    _adjust_row(RatingSummary, {'user_id': rating.rated_user_id}, {'rating_count': sign})
+    # The stored fields are read back, so the summary matches what is in the database
+    field_values = db.session.execute(db.select(RatingField.name, RatingField.value)
+                                      .where(RatingField.rating_id == rating.id)).all()
+    for name, value in field_values:
+        _adjust_row(RatingSummaryField, {'user_id': rating.rated_user_id, 'name': name},
+                    {'value_sum': sign * value, 'value_count': sign})
+
+
+def add_to_rating_summary(rating: Rating) -> None:
+    """
+    Count a rating in its user's summary. Call once the rating and its fields have been flushed, in the same
+    transaction. Doesn't commit.
+    """
+    _adjust_summary(rating, 1)
+
+
+def remove_from_rating_summary(rating: Rating) -> None:
+    """
+    Take a rating out of its user's summary. Call before the rating is deleted or its fields are replaced, in the same
+    transaction. Doesn't commit.
+    """
+    _adjust_summary(rating, -1)
+
+
+def get_rating_summary(user_id: int) -> dict | None:
+    """
+    Average value of each rating field a user has received, and how many ratings they have received. Read from the
+    user's `rating_summary` row, so no ratings are loaded or aggregated.
+    :return: The summary, or None if the user hasn't been rated
+    """
+    summary = db.session.get(RatingSummary, user_id)
+    if summary is None or summary.rating_count <= 0:
+        return None
+
+    averages = {field.name: field.value_sum / field.value_count for field in summary.fields if field.value_count > 0}
+    return {
+        'fields': [{'name': field.name, 'value': averages.get(field, 0)} for field in RatingFieldName],
+        'count': summary.rating_count,
+    }
+
+
+def rebuild_rating_summaries() -> int:
+    """
+    Recompute every rating summary from the stored ratings in a single transaction, e.g. after ratings were changed
+    without going through this module.
+    :return: Number of users with a summary
+    """
+    db.session.execute(db.delete(RatingSummaryField))
+    db.session.execute(db.delete(RatingSummary))
+    db.session.execute(db.insert(RatingSummary).from_select(
+        ['user_id', 'rating_count'],
+        db.select(Rating.rated_user_id, func.count(Rating.id)).group_by(Rating.rated_user_id)))
+    db.session.execute(db.insert(RatingSummaryField).from_select(
+        ['user_id', 'name', 'value_sum', 'value_count'],
+        db.select(Rating.rated_user_id, RatingField.name, func.sum(RatingField.value), func.count(RatingField.id))
+        .join(Rating, RatingField.rating_id == Rating.id)
+        .group_by(Rating.rated_user_id, RatingField.name)))
+    db.session.commit()
+    return db.session.scalar(db.select(func.count()).select_from(RatingSummary))
@@ -1,3 +1,80 @@
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+
+from flask import current_app
+from werkzeug.security import generate_password_hash, check_password_hash
+
+from server.services.file_lock import slot_lock
+
+
+class PasswordHasherBusyError(Exception):
+    """Raised when too many password hashing jobs are already queued"""
+    def __init__(self, value):
+        super(PasswordHasherBusyError, self).__init__(value)
+
+
+class PasswordHasher:
+    """
+    Runs password hashing in worker processes so CPU-heavy hashing doesn't hold the request worker's interpreter.
+    Both limits are shared by every app process on the machine through `slot_lock`: at most `PASSWORD_HASH_WORKERS`
+    hashes run at once, and requests past `PASSWORD_HASH_MAX_PENDING` waiting or running hashes are rejected instead of
+    queueing indefinitely.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+
+    def _get_executor(self, workers: int) -> ProcessPoolExecutor:
+        # Pools don't survive a fork, so each worker process creates its own. Processes are only started when a
+        # hash is submitted, and the machine-wide slots keep at most `workers` of them busy across all pools.
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                # Spawned children only import werkzeug, not the whole app
+                self._executor = ProcessPoolExecutor(max_workers=workers,
+                                                     mp_context=multiprocessing.get_context('spawn'))
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    @staticmethod
+    def _slot_directory(name: str) -> str:
+        directory = current_app.config.get('PASSWORD_HASH_LOCK_DIRECTORY') or os.path.join(current_app.instance_path,
+                                                                                         'password-hash')
+        return os.path.join(directory, name)
+
+    def run(self, fn, *args):
+        config = current_app.config
+        workers = config['PASSWORD_HASH_WORKERS']
+        if workers <= 0:
+            return fn(*args)
+
+        timeout = config['PASSWORD_HASH_TIMEOUT']
+        deadline = time.monotonic() + timeout
+        with slot_lock(self._slot_directory('pending'), config['PASSWORD_HASH_MAX_PENDING']) as pending:
+            if not pending:
+                raise PasswordHasherBusyError('Too many pending password hashing jobs')
+            with slot_lock(self._slot_directory('running'), workers, timeout=timeout) as running:
+                if not running:
+                    raise PasswordHasherBusyError('Timed out waiting for password hashing')
+                try:
+                    return self._get_executor(workers).submit(fn, *args).result(
+                        timeout=max(0.0, deadline - time.monotonic()))
+                except TimeoutError:
+                    raise PasswordHasherBusyError('Timed out waiting for password hashing')
+
+    def shutdown(self) -> None:
+        if self._executor is not None and self._executor_pid == os.getpid():
+            self._executor.shutdown(cancel_futures=True)
+        self._executor = None
+
+
+password_hasher = PasswordHasher()
+
+
 def validate_password(password: str) -> bool:
     """
     Checks if the password is valid.
@@ -8,3 +85,21 @@ def validate_password(password: str) -> bool:
         return False
 
     return True
+
+
+def hash_password(password: str) -> str:
+    """Hash a password with the configured `PASSWORD_HASH_METHOD`"""
+    return password_hasher.run(generate_password_hash, password, current_app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(password_hash: str, password: str) -> bool:
+    return password_hasher.run(check_password_hash, password_hash, password)
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    """
+    Checks if a hash was created with different parameters than the configured `PASSWORD_HASH_METHOD`.
+    :param password_hash: Stored hash in werkzeug's `method$salt$hash` format
+    """
+    method = password_hash.split('$', 1)[0]
+    return method != current_app.config['PASSWORD_HASH_METHOD']
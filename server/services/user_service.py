@@ -0,0 +1,61 @@
+from flask import current_app
+from sqlalchemy import inspect
+from sqlalchemy.orm import joinedload, make_transient_to_detached
+
+from server import db
+from server.models import User
+from server.services.cache import TTLCache
+
+# Detached snapshots of recently authenticated users, keyed by user ID. Only used when CURRENT_USER_CACHE_TTL > 0.
+_user_cache = TTLCache(ttl=0, maxsize=1024)
+
+
+def _detached_copy(instance):
+    """Copy the loaded column values of `instance` into a new detached instance that no session owns"""
+    mapper = inspect(instance).mapper
+    copy = mapper.class_manager.new_instance()
+    for attr in mapper.column_attrs:
+        setattr(copy, attr.key, getattr(instance, attr.key))
+    return copy
+
+
+def _snapshot(user: User) -> User:
+    user_copy = _detached_copy(user)
+    if user.profile is not None:
+        user_copy.profile = _detached_copy(user.profile)
+        make_transient_to_detached(user_copy.profile)
+    make_transient_to_detached(user_copy)
+    return user_copy
+
+
+def load_user(user_id) -> User | None:
+    """
+    Load a user along with their profile in a single query. When `CURRENT_USER_CACHE_TTL` is set, recently loaded users
+    are served from an in-process cache and attached to the current session without querying the database.
+    :param user_id: ID of the user to load
+    :return: The user attached to the current session, or None if no such user exists
+    """
+    user_id = int(user_id)
+    ttl = current_app.config.get('CURRENT_USER_CACHE_TTL', 0)
+
+    if ttl > 0:
+        cached_user = _user_cache.get(user_id)
+        if cached_user is not None:
+            return db.session.merge(cached_user, load=False)
+
+    user = db.session.execute(
+        db.select(User).options(joinedload(User.profile)).filter_by(id=user_id)
+    ).scalar_one_or_none()
+
+    if user is not None and ttl > 0:
+        _user_cache.set(user_id, _snapshot(user), ttl=ttl)
+    return user
+
+
+def invalidate_cached_user(user_id) -> None:
+    """Drop a user from the current user cache, e.g. after their account or profile was changed"""
+    _user_cache.delete(int(user_id))
+
+
+def clear_user_cache() -> None:
+    _user_cache.clear()
@@ -9,7 +9,8 @@ from dotenv import load_dotenv
 from flask_jwt_extended import create_access_token
 
 from server import create_app, db
-from server.models import User, IgdbGame, Community, Post, Comment
+from server.models import User, IgdbGame, Community, Post, Comment, Rating, RatingField, RatingFieldName
+from server.services.rating_service import rebuild_rating_summaries
 
 TEST_USERNAME = 'test_user'
 TEST_PASSWORD = '<PASSWORD>'
@@ -19,13 +20,25 @@ load_dotenv('../.flaskenv')
 
 
 @pytest.fixture(scope='session')
-def app():
+def app(tmp_path_factory):
     """Create application for the tests."""
+    # Images are written to a temporary directory, so the sweep and migration tests never touch the real uploads
+    upload_directory = tmp_path_factory.mktemp('uploads')
+    shutil.copy(os.path.join(os.path.dirname(__file__), '..', 'uploads', 'default-profile.png'), upload_directory)
     test_config = {
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:',
         'TESTING': True,
         'DEBUG': True,
-        'PROPAGATE_EXCEPTIONS': True
+        'PROPAGATE_EXCEPTIONS': True,
+        # Process uploads synchronously so tests can check the results right away
+        'IMAGE_PROCESSING_WORKERS': 0,
+        'IGDB_REFRESH_WORKERS': 0,
+        'DISCORD_REFRESH_WORKERS': 0,
+        'PASSWORD_HASH_LOCK_DIRECTORY': str(tmp_path_factory.mktemp('password-hash')),
+        'UPLOAD_DIRECTORY': str(upload_directory),
+        'UPLOAD_STAGING_DIRECTORY': str(upload_directory / 'staging'),
+        'IGDB_RATE_LIMIT_FILE': str(tmp_path_factory.mktemp('igdb') / 'igdb_rate_limit.json'),
+        'IMAGE_PROCESSING_LOCK_DIRECTORY': str(tmp_path_factory.mktemp('image-processing')),
     }
 
     _app = create_app(test_config)
@@ -35,9 +48,6 @@ def app():
         yield _app
         db.drop_all()
 
-        # if os.path.exists(_app.config['UPLOAD_DIRECTORY']):
-        #     shutil.rmtree(_app.config['UPLOAD_DIRECTORY'])
-
 
 @pytest.fixture(autouse=True)
 def db_transaction(app):
@@ -217,6 +227,21 @@ def test_post_with_comments(app, test_user, test_post):
     return test_post
 
 
+@pytest.fixture
+def test_ratings(app, test_user):
+    """Create ratings of the test user by three other users, the last one only rating attitude."""
+    ratings = []
+    for i, values in enumerate([{'attitude': 5, 'teamwork': 4}, {'attitude': 3, 'teamwork': 2}, {'attitude': 4}]):
+        rater = User(username=f'rater_{i}', password=TEST_PASSWORD)
+        rating = Rating(rating_user=rater, rated_user=test_user, description=f'Rating {i}')
+        rating.fields.extend(RatingField(name=RatingFieldName[name], value=value) for name, value in values.items())
+        db.session.add(rating)
+        ratings.append(rating)
+    db.session.commit()
+    rebuild_rating_summaries()
+    return ratings
+
+
 @pytest.fixture
 def mock_igdb_game_data():
     return {
@@ -1,12 +1,36 @@
+import asyncio
+import base64
+import io
+import json
 import os
-from unittest.mock import patch
-
+import threading
+import time
+from datetime import datetime, timedelta
+from unittest.mock import patch, Mock, AsyncMock
+
+import httpx
+import flask_migrate
+import pytest
+import requests
+from PIL import Image
 from flask_jwt_extended import decode_token
 from flask_jwt_extended.exceptions import InvalidHeaderError
-
-from server import routes, db
-from server.models import User, Community, ConnectedAccount, ConnectedService, InvalidatedToken, Comment
-from server.services.games_service import IGDBError
+from sqlalchemy import event
+from werkzeug.security import generate_password_hash
+
+from server import create_app, routes, db
+from server.models import User, Community, ConnectedAccount, ConnectedService, InvalidatedToken, Comment, Post, \
+    ImageStatus, ImageBlob, IgdbGame, RatingSummary
+from server.services import games_service, http_client, async_http_client, media_processing, discord_services
+from server.services.async_http_client import run_async
+from server.services.discord_services import refresh_discord_accounts, refresh_due_discord_accounts, \
+    cache_discord_avatar
+from server.services.games_service import IGDBError, IGDBRateLimitError
+from server.services.media_processing import get_image_path, delete_image, image_processor, migrate_upload_layout, \
+    collect_unreferenced_images, sweep_orphaned_files, recover_staged_uploads, retain_image
+from server.services.file_lock import slot_lock
+from server.services.rate_limiter import RateLimiter, RateLimitExceededError
+from server.services.user_service import clear_user_cache
 from tests.conftest import TEST_USERNAME, TEST_PASSWORD, create_test_image
 
 
@@ -94,6 +118,58 @@ def test_login_wrong_password(client, test_user):
     assert 'Invalid username or password' in response.json.get('msg')
 
 
+def test_login_rehashes_outdated_password(client, test_user, app):
+    """Test that logging in upgrades a password hash created with old parameters"""
+    test_user.password_hash = generate_password_hash(TEST_PASSWORD, 'pbkdf2:sha256:1000')
+    db.session.commit()
+
+    response = client.post('/api/login', json={
+        'username': TEST_USERNAME,
+        'password': TEST_PASSWORD
+    })
+
+    assert response.status_code == 200
+    user = db.session.get(User, test_user.id)
+    db.session.refresh(user)
+    assert user.password_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$')
+    assert user.check_password(TEST_PASSWORD)
+
+
+def test_login_hasher_busy(client, test_user, app, monkeypatch):
+    """Test that logins are rejected when the password hashing queue is full"""
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_MAX_PENDING', 0)
+    response = client.post('/api/login', json={
+        'username': TEST_USERNAME,
+        'password': TEST_PASSWORD
+    })
+
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+
+
+def test_login_hasher_busy_in_other_process(client, test_user, app, monkeypatch):
+    """Test that hashing slots held elsewhere on the machine count towards the limits"""
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_MAX_PENDING', 2)
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_WORKERS', 1)
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_TIMEOUT', 0.1)
+    lock_directory = app.config['PASSWORD_HASH_LOCK_DIRECTORY']
+
+    # The only hashing slot is taken, so the login waits and gives up
+    with slot_lock(os.path.join(lock_directory, 'running'), 1) as acquired:
+        assert acquired
+        response = client.post('/api/login', json={'username': TEST_USERNAME, 'password': TEST_PASSWORD})
+    assert response.status_code == 503
+
+    # Every pending slot is taken, so the login is rejected right away
+    with slot_lock(os.path.join(lock_directory, 'pending'), 2), slot_lock(os.path.join(lock_directory, 'pending'), 2):
+        response = client.post('/api/login', json={'username': TEST_USERNAME, 'password': TEST_PASSWORD})
+    assert response.status_code == 503
+
+    monkeypatch.setitem(app.config, 'PASSWORD_HASH_TIMEOUT', 10)
+    response = client.post('/api/login', json={'username': TEST_USERNAME, 'password': TEST_PASSWORD})
+    assert response.status_code == 200
+
+
 def test_login_missing_username(client, test_user):
     """Test logging in with missing username"""
     response = client.post('/api/login', json={
@@ -160,6 +236,42 @@ def test_me_unauthorized(client, auth_headers):
     assert response.status_code == 401
 
 
+def test_me_deleted_user(client, auth_headers, test_user):
+    """Test getting the current user after their account was deleted"""
+    db.session.delete(test_user.profile)
+    db.session.delete(test_user)
+    db.session.commit()
+
+    response = client.get('/api/me', headers=auth_headers)
+    assert response.status_code == 401
+    assert response.json['msg'] == 'User not found'
+
+
+def test_me_cached_user(client, auth_headers, app, monkeypatch):
+    """Test that the current user is only loaded from the database on a cache miss"""
+    monkeypatch.setitem(app.config, 'CURRENT_USER_CACHE_TTL', 60)
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record_statement)
+    try:
+        first_response = client.get('/api/me', headers=auth_headers)
+        user_lookups = sum('JOIN user_profile' in statement for statement in statements)
+        statements.clear()
+        second_response = client.get('/api/me', headers=auth_headers)
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record_statement)
+        clear_user_cache()
+
+    assert first_response.status_code == 200
+    assert second_response.status_code == 200
+    assert second_response.json['user']['username'] == TEST_USERNAME
+    assert user_lookups == 1
+    assert not any('JOIN user_profile' in statement for statement in statements)
+
+
 def test_edit_profile(client, auth_headers, app):
     """Test updating user profile"""
     new_bio = 'A new bio.'
@@ -176,8 +288,37 @@ def test_edit_profile(client, auth_headers, app):
 
     # Clean up image
     user = db.session.get(User, response.json['user']['id'])
-    if os.path.exists(os.path.join(app.config['UPLOAD_DIRECTORY'], f'{user.profile.profile_picture_id}.jpg')):
-        os.remove(os.path.join(app.config['UPLOAD_DIRECTORY'], f'{user.profile.profile_picture_id}.jpg'))
+    delete_image(user.profile.profile_picture_id)
+
+
+def test_edit_profile_cached_user_releases_processed_picture(client, auth_headers, app, test_user, monkeypatch):
+    """Test that replacing a picture processed after the current user was cached releases the processed image"""
+    monkeypatch.setitem(app.config, 'CURRENT_USER_CACHE_TTL', 60)
+    try:
+        with patch.object(image_processor, 'submit') as mock_submit:
+            client.put('/api/me', content_type='multipart/form-data', headers=auth_headers,
+                       data={'profile_picture': (create_test_image(), 'first.jpg', 'image/jpg')})
+        staged_id = mock_submit.call_args.args[0]
+        # Cached while the picture is still processing
+        assert client.get('/api/me', headers=auth_headers).status_code == 200
+
+        # Processed by another worker process, whose cache is the one invalidated
+        with patch.object(media_processing, 'invalidate_cached_user') as mock_invalidate:
+            image_processor.submit(staged_id)
+        mock_invalidate.assert_called_once_with(test_user.id)
+        image_id = db.session.get(User, test_user.id).profile.profile_picture_id
+        assert db.session.get(ImageBlob, image_id).ref_count == 1
+
+        response = client.put('/api/me', content_type='multipart/form-data', headers=auth_headers,
+                              data={'profile_picture': (create_test_image(50), 'second.jpg', 'image/jpg')})
+        assert response.status_code == 200
+    finally:
+        clear_user_cache()
+
+    db.session.expire_all()
+    assert db.session.get(ImageBlob, image_id).ref_count == 0
+    delete_image(image_id)
+    delete_image(db.session.get(User, test_user.id).profile.profile_picture_id)
 
 
 def test_edit_profile_duplicate_username(client, auth_headers):
@@ -517,7 +658,7 @@ def test_unfollow_community_invalid_community(client, auth_headers):
 def test_game_info(client, mock_igdb_game_data):
     """Test getting game info from IGDB"""
 
-    with patch.object(routes, 'get_game') as mock_get_game:
+    with patch.object(games_service, 'get_game') as mock_get_game:
         mock_get_game.return_value = mock_igdb_game_data
         response = client.get(f'/api/game-info/{mock_igdb_game_data["id"]}')
 
@@ -528,11 +669,95 @@ def test_game_info(client, mock_igdb_game_data):
         assert response.json['game']['summary'] == 'A test game'
 
 
+def test_game_info_cached(client, mock_igdb_game_data):
+    """Test that stored games are served without calling IGDB"""
+    with patch.object(games_service, 'get_game') as mock_get_game:
+        mock_get_game.return_value = mock_igdb_game_data
+        client.get(f'/api/game-info/{mock_igdb_game_data["id"]}')
+        response = client.get(f'/api/game-info/{mock_igdb_game_data["id"]}')
+
+        assert response.status_code == 200
+        assert response.json['game']['name'] == 'Test Game'
+        assert mock_get_game.call_count == 1
+
+
+def test_game_info_stale(client, mock_igdb_game_data):
+    """Test that stale games are served and refreshed from IGDB"""
+    game = IgdbGame(id=mock_igdb_game_data['id'], name='Old Name', fetched_at=datetime.now() - timedelta(days=30))
+    db.session.add(game)
+    db.session.commit()
+
+    with patch.object(games_service, 'get_game') as mock_get_game:
+        mock_get_game.return_value = mock_igdb_game_data
+        response = client.get(f'/api/game-info/{mock_igdb_game_data["id"]}')
+
+        assert response.status_code == 200
+        mock_get_game.assert_called_once_with(mock_igdb_game_data['id'])
+    assert db.session.get(IgdbGame, mock_igdb_game_data['id']).name == 'Test Game'
+
+
+def test_game_refresher_logs_unexpected_errors(app):
+    """Test that background game refreshes that fail unexpectedly are logged rather than dropped with their future"""
+    with patch.object(games_service, 'refresh_game', side_effect=RuntimeError('boom')), \
+            patch.object(app.logger, 'exception') as mock_log:
+        games_service.game_refresher._refresh_in_context(app, 123)
+
+    mock_log.assert_called_once_with('Failed to refresh IGDB game 123')
+
+
+def test_get_games(client, test_game, mock_igdb_game_data):
+    """Test that games are served from the database, with all missing games fetched in one IGDB request"""
+    other_game = dict(mock_igdb_game_data, id=456, name='Other Game')
+    with patch.object(games_service, 'get_games', return_value=[mock_igdb_game_data, other_game]) as mock_get_games, \
+            patch.object(games_service.game_refresher, 'submit') as mock_refresh:
+        response = client.get(f'/api/games?ids=456,{test_game.id},123,999')
+
+        assert response.status_code == 200
+        assert [game['name'] for game in response.json['games']] == ['Other Game', 'Test Game', 'Test Game']
+        mock_get_games.assert_called_once_with([456, 123, 999])
+        # Stored before caching, so it's served and refreshed in the background
+        mock_refresh.assert_called_once_with(test_game.id)
+
+        client.get('/api/games?ids=123,456')
+        assert mock_get_games.call_count == 1
+
+
+@patch('server.services.async_http_client.post', new_callable=AsyncMock)
+def test_get_games_in_concurrent_batches(mock_post, app, client, mock_igdb_game_data, monkeypatch):
+    """Test that more missing games than fit in one IGDB request are fetched in batches on the event loop"""
+    monkeypatch.setitem(app.config, 'IGDB_BATCH_LIMIT', 2)
+
+    async def igdb_response(url, data, **kwargs):
+        ids = data.split('where id = (')[1].split(')')[0].split(',')
+        return Mock(status_code=200, json=Mock(return_value=[dict(mock_igdb_game_data, id=int(game_id))
+                                                             for game_id in ids]))
+
+    mock_post.side_effect = igdb_response
+    with patch.object(games_service.igdb_token_handler, 'get_headers', return_value={}), \
+            patch.object(games_service, 'get_games') as mock_get_games:
+        response = client.get('/api/games?ids=1,2,3,4,5')
+
+    assert response.status_code == 200
+    assert [game['id'] for game in response.json['games']] == [1, 2, 3, 4, 5]
+    assert mock_post.call_count == 3
+    mock_get_games.assert_not_called()
+    assert db.session.get(IgdbGame, 5) is not None
+
+    monkeypatch.setitem(app.config, 'IGDB_LOOKUP_LIMIT', 4)
+    assert client.get('/api/games?ids=1,2,3,4,5').status_code == 400
+
+
+def test_get_games_invalid_ids(client):
+    """Test requesting games with malformed IDs"""
+    assert client.get('/api/games?ids=1,abc').status_code == 400
+    assert client.get('/api/games').status_code == 400
+
+
 def test_game_info_not_found(client):
     """Test getting info for a non-existent game"""
     game_id = 999
 
-    with patch.object(routes, 'get_game') as mock_get_game:
+    with patch.object(games_service, 'get_game') as mock_get_game:
         mock_get_game.side_effect = IGDBError('Game not found')
         response = client.get(f'/api/game-info/{game_id}')
 
@@ -544,7 +769,7 @@ def test_create_community(client, auth_headers, mock_igdb_game_data):
     """Test creating a new community"""
     community_name = "Test Gaming Community"
 
-    with patch.object(routes, 'get_game') as mock_get_game:
+    with patch.object(games_service, 'get_game') as mock_get_game:
         mock_get_game.return_value = mock_igdb_game_data
         response = client.post('/api/communities',
                                json={
@@ -728,11 +953,277 @@ def test_create_post_with_image(client, auth_headers, test_community, app):
     assert response.status_code == 201
     assert response.json['post']['title'] == 'Post with Image'
     assert response.json['post']['media'] == 'image'
+    assert response.json['post']['media_status'] == 'ready'
+
+    # Every size variant is stored
+    post = db.session.get(Post, response.json['post']['id'])
+    for size in app.config['IMAGE_SIZES']:
+        assert os.path.exists(get_image_path(post.image_id, size))
 
     # Clean up image
+    delete_image(post.image_id)
+
+
+def test_create_post_with_image_async(client, auth_headers, test_community, app, monkeypatch):
+    """Test that post images are processed by the worker pool after the post is created"""
+    monkeypatch.setitem(app.config, 'IMAGE_PROCESSING_WORKERS', 1)
+    try:
+        response = client.post('/api/posts',
+                               headers=auth_headers,
+                               data={
+                                   'title': 'Post with Image',
+                                   'content': 'Content with image',
+                                   'community_id': test_community.id,
+                                   'image': (create_test_image(), 'test.jpg', 'image/jpeg')
+                               }
+                               )
+        assert response.status_code == 201
+        assert response.json['post']['media_status'] in ('processing', 'ready')
+        post_id = response.json['post']['id']
+
+        deadline = time.monotonic() + 30
+        while db.session.get(Post, post_id).image_status == ImageStatus.PROCESSING and time.monotonic() < deadline:
+            time.sleep(0.1)
+            db.session.expire_all()
+    finally:
+        image_processor.shutdown()
+
+    post = db.session.get(Post, post_id)
+    assert post.image_status == ImageStatus.READY
+    assert os.path.exists(get_image_path(post.image_id))
+    assert not os.listdir(app.config['UPLOAD_STAGING_DIRECTORY'])
+
+    delete_image(post.image_id)
+
+
+def test_post_images_deduplicated(client, auth_headers, test_community):
+    """Test that identical images are stored once and removed when no post uses them"""
+    post_ids = []
+    for _ in range(2):
+        response = client.post('/api/posts',
+                               headers=auth_headers,
+                               data={
+                                   'title': 'Post with Image',
+                                   'content': 'Content with image',
+                                   'community_id': test_community.id,
+                                   'image': (create_test_image(), 'test.jpg', 'image/jpeg')
+                               }
+                               )
+        post_ids.append(response.json['post']['id'])
+
+    image_id = db.session.get(Post, post_ids[0]).image_id
+    assert db.session.get(Post, post_ids[1]).image_id == image_id
+    assert db.session.get(ImageBlob, image_id).ref_count == 2
+
+    client.delete(f'/api/posts/{post_ids[0]}', headers=auth_headers)
+    db.session.expire_all()
+    assert db.session.get(ImageBlob, image_id).ref_count == 1
+    assert collect_unreferenced_images(timedelta(0)) == 0
+
+    client.delete(f'/api/posts/{post_ids[1]}', headers=auth_headers)
+    db.session.expire_all()
+    assert db.session.get(ImageBlob, image_id).ref_count == 0
+    assert collect_unreferenced_images(timedelta(0)) == 1
+    assert db.session.get(ImageBlob, image_id) is None
+    assert not os.path.exists(get_image_path(image_id))
+
+
+def test_identical_upload_survives_collection(client, auth_headers, test_community, monkeypatch):
+    """Test that an upload deduplicated against an image the collector deletes stores the image again"""
+    def create_post():
+        response = client.post('/api/posts',
+                               headers=auth_headers,
+                               data={
+                                   'title': 'Post with Image',
+                                   'content': 'Content with image',
+                                   'community_id': test_community.id,
+                                   'image': (create_test_image(), 'test.jpg', 'image/jpeg')
+                               }
+                               )
+        return response.json['post']['id']
+
+    first_post_id = create_post()
+    image_id = db.session.get(Post, first_post_id).image_id
+    client.delete(f'/api/posts/{first_post_id}', headers=auth_headers)
+
+    encode_variants = media_processing._encode_variants
+    collected = []
+
+    def encode_then_collect(*args):
+        stored_image = encode_variants(*args)
+        if not collected:
+            # The collector runs after encoding was skipped for the existing files, before they are retained
+            collected.append(collect_unreferenced_images(timedelta(0)))
+        return stored_image
+
+    monkeypatch.setattr(media_processing, '_encode_variants', encode_then_collect)
+    post_id = create_post()
+    assert collected == [1]
+
+    post = db.session.get(Post, post_id)
+    assert post.image_id == image_id
+    assert post.image_status == ImageStatus.READY
+    assert db.session.get(ImageBlob, image_id).ref_count == 1
+    for size in client.application.config['IMAGE_SIZES']:
+        assert os.path.exists(get_image_path(image_id, size))
+    delete_image(image_id)
+
+
+def test_migrate_upload_layout(app, client, test_post_with_image):
+    """Test moving images from the flat upload directory into the sharded layout"""
+    image_id = test_post_with_image.image_id
+    flat_path = os.path.join(app.config['UPLOAD_DIRECTORY'], f'{image_id}.jpg')
+    response = client.get(f'/api/posts/{test_post_with_image.id}/image')
+    assert response.status_code == 200
+
+    migrate_upload_layout()
+    assert not os.path.exists(flat_path)
+    assert os.path.dirname(get_image_path(image_id)) != os.path.abspath(app.config['UPLOAD_DIRECTORY'])
+    assert os.path.exists(os.path.join(app.config['UPLOAD_DIRECTORY'], 'default-profile.png'))
+    assert migrate_upload_layout() == 0
+
+    migrated_response = client.get(f'/api/posts/{test_post_with_image.id}/image')
+    assert migrated_response.status_code == 200
+    assert migrated_response.data == response.data
+    delete_image(image_id)
+
+
+def test_sweep_orphaned_files(app, test_post, tmp_path, monkeypatch):
+    """Test that only old image files nothing references are swept"""
+    # A directory of its own, so files other tests leave behind don't count
+    upload_directory = tmp_path / 'uploads'
+    staging_directory = upload_directory / 'staging'
+    staging_directory.mkdir(parents=True)
+    monkeypatch.setitem(app.config, 'UPLOAD_DIRECTORY', str(upload_directory))
+    monkeypatch.setitem(app.config, 'UPLOAD_STAGING_DIRECTORY', str(staging_directory))
+    test_post.image_id = 'referenced'
+    db.session.commit()
+
+    old = time.time() - timedelta(days=1).total_seconds()
+    orphan_path = upload_directory / 'orphan.jpg'
+    recent_orphan_path = upload_directory / 'recent-orphan.jpg'
+    referenced_path = upload_directory / 'referenced.jpg'
+    staged_path = staging_directory / 'staged.jpg'
+    for filepath in (orphan_path, recent_orphan_path, referenced_path, staged_path):
+        Image.new('RGB', (10, 10)).save(filepath)
+    for filepath in (orphan_path, referenced_path, staged_path):
+        os.utime(filepath, (old, old))
+
+    assert sweep_orphaned_files(batch_size=1) == 1
+    assert not orphan_path.exists()
+    assert recent_orphan_path.exists()
+    assert referenced_path.exists()
+    assert staged_path.exists()
+
+
+def test_recover_staged_uploads(app, test_user, test_post, tmp_path, monkeypatch):
+    """Test that uploads left behind by a dead worker are requeued, failed or deleted"""
+    staging_directory = tmp_path / 'staging'
+    staging_directory.mkdir()
+    monkeypatch.setitem(app.config, 'UPLOAD_STAGING_DIRECTORY', str(staging_directory))
+    old = time.time() - timedelta(days=1).total_seconds()
+    for name in ('stuck-upload', 'abandoned-upload', 'recent-upload'):
+        (staging_directory / name).write_bytes(create_test_image().getvalue())
+        if name != 'recent-upload':
+            os.utime(staging_directory / name, (old, old))
+
+    test_post.image_id = 'stuck-upload'
+    test_post.image_status = ImageStatus.PROCESSING
+    test_user.profile.profile_picture_id = 'lost-upload'
+    test_user.profile.profile_picture_status = ImageStatus.PROCESSING
+    db.session.commit()
+
+    assert recover_staged_uploads() == (1, 1, 1)
+    db.session.expire_all()
+    post = db.session.get(Post, test_post.id)
+    assert post.image_status == ImageStatus.READY
+    assert os.path.exists(get_image_path(post.image_id))
+    assert db.session.get(User, test_user.id).profile.profile_picture_status == ImageStatus.FAILED
+    assert sorted(os.listdir(staging_directory)) == ['recent-upload']
+    delete_image(post.image_id)
+
+
+def test_create_post_invalid_image(client, auth_headers, test_community):
+    """Test creating a post with an upload that isn't an image"""
+    response = client.post('/api/posts',
+                           headers=auth_headers,
+                           data={
+                               'title': 'Post with Image',
+                               'content': 'Content with image',
+                               'community_id': test_community.id,
+                               'image': (io.BytesIO(b'not an image'), 'test.jpg', 'image/jpeg')
+                           }
+                           )
+    assert response.status_code == 400
+    assert 'Invalid image' in response.json['msg']
+
+
+def test_create_post_large_image(app, client, auth_headers, test_community):
+    """Test that large photos are downscaled while decoding to the configured variant sizes"""
+    image_bytes = io.BytesIO()
+    Image.new('RGB', (4000, 3000), color='green').save(image_bytes, 'JPEG')
+    image_bytes.seek(0)
+
+    response = client.post('/api/posts',
+                           headers=auth_headers,
+                           data={
+                               'title': 'Post with Image',
+                               'content': 'Content with image',
+                               'community_id': test_community.id,
+                               'image': (image_bytes, 'test.jpg', 'image/jpeg')
+                           }
+                           )
+    assert response.status_code == 201
+
     post = db.session.get(Post, response.json['post']['id'])
-    if os.path.exists(os.path.join(app.config['UPLOAD_DIRECTORY'], f'{post.image_id}.jpg')):
-        os.remove(os.path.join(app.config['UPLOAD_DIRECTORY'], f'{post.image_id}.jpg'))
+    with Image.open(get_image_path(post.image_id)) as full:
+        assert full.size == (1024, 768)
+
+    post_response = client.get(f'/api/posts/{post.id}', headers=auth_headers)
+    assert post_response.json['post']['image_width'] == 1024
+    assert post_response.json['post']['image_height'] == 768
+    placeholder = post_response.json['post']['image_placeholder']
+    assert placeholder.startswith('data:image/png;base64,')
+    with Image.open(io.BytesIO(base64.b64decode(placeholder.split(',', 1)[1]))) as placeholder_image:
+        assert placeholder_image.size == (8, 6)
+    with Image.open(get_image_path(post.image_id, 'thumb')) as thumb:
+        assert thumb.size == (256, 192)
+    delete_image(post.image_id)
+
+
+def test_create_post_image_too_many_pixels(app, client, auth_headers, test_community, monkeypatch):
+    """Test that images with too many pixels are rejected before they are decoded"""
+    monkeypatch.setitem(app.config, 'IMAGE_MAX_PIXELS', 100 * 100)
+    image_bytes = io.BytesIO()
+    Image.new('RGB', (101, 100)).save(image_bytes, 'PNG')
+    image_bytes.seek(0)
+
+    response = client.post('/api/posts',
+                           headers=auth_headers,
+                           data={
+                               'title': 'Post with Image',
+                               'content': 'Content with image',
+                               'community_id': test_community.id,
+                               'image': (image_bytes, 'test.png', 'image/png')
+                           }
+                           )
+    assert response.status_code == 413
+    assert Post.query.count() == 0
+
+
+def test_create_post_request_too_large(app, client, auth_headers, test_community, monkeypatch):
+    """Test that request bodies over MAX_CONTENT_LENGTH are rejected"""
+    monkeypatch.setitem(app.config, 'MAX_CONTENT_LENGTH', 1024)
+    response = client.post('/api/posts',
+                           headers=auth_headers,
+                           data={
+                               'title': 'Post with Image',
+                               'content': 'Content with image',
+                               'community_id': test_community.id,
+                               'image': (io.BytesIO(b'\0' * 2048), 'test.jpg', 'image/jpeg')
+                           }
+                           )
+    assert response.status_code == 413
 
 
 def test_create_post_missing_fields(client, auth_headers):
@@ -767,6 +1258,127 @@ def test_get_post_image(client, test_post_with_image):
     assert response.content_type == 'image/jpeg'
 
 
+def test_get_post_image_size(client, auth_headers, test_community, app):
+    """Test getting a smaller size variant of a post's image"""
+    response = client.post('/api/posts',
+                           headers=auth_headers,
+                           data={
+                               'title': 'Post with Image',
+                               'content': 'Content with image',
+                               'community_id': test_community.id,
+                               'image': (create_test_image(size=2000), 'test.jpg', 'image/jpeg')
+                           }
+                           )
+    post_id = response.json['post']['id']
+
+    thumb_response = client.get(f'/api/posts/{post_id}/image?size=thumb')
+    full_response = client.get(f'/api/posts/{post_id}/image')
+    assert thumb_response.status_code == 200
+    assert full_response.status_code == 200
+    assert Image.open(io.BytesIO(thumb_response.data)).size == (app.config['IMAGE_SIZES']['thumb'],) * 2
+    assert Image.open(io.BytesIO(full_response.data)).size == (app.config['IMAGE_SIZES']['full'],) * 2
+
+    delete_image(db.session.get(Post, post_id).image_id)
+
+
+def test_get_post_image_webp(client, auth_headers, test_community):
+    """Test that clients accepting WebP are served the WebP variant"""
+    response = client.post('/api/posts',
+                           headers=auth_headers,
+                           data={
+                               'title': 'Post with Image',
+                               'content': 'Content with image',
+                               'community_id': test_community.id,
+                               'image': (create_test_image(), 'test.jpg', 'image/jpeg')
+                           }
+                           )
+    post_id = response.json['post']['id']
+
+    webp_response = client.get(f'/api/posts/{post_id}/image', headers={'Accept': 'image/webp,*/*;q=0.8'})
+    jpeg_response = client.get(f'/api/posts/{post_id}/image', headers={'Accept': '*/*'})
+    refused_response = client.get(f'/api/posts/{post_id}/image', headers={'Accept': 'image/webp;q=0, image/*'})
+    assert webp_response.content_type == 'image/webp'
+    assert Image.open(io.BytesIO(webp_response.data)).format == 'WEBP'
+    assert jpeg_response.content_type == 'image/jpeg'
+    assert refused_response.content_type == 'image/jpeg'
+    assert 'Accept' in webp_response.headers['Vary']
+
+    delete_image(db.session.get(Post, post_id).image_id)
+
+
+def test_get_post_image_legacy_size(client, test_post_with_image):
+    """Test that images stored before size variants existed fall back to the full size"""
+    response = client.get(f'/api/posts/{test_post_with_image.id}/image?size=thumb')
+    assert response.status_code == 200
+    assert response.content_type == 'image/jpeg'
+
+
+def test_get_post_image_invalid_size(client, test_post_with_image):
+    """Test getting a post's image with an unknown size"""
+    response = client.get(f'/api/posts/{test_post_with_image.id}/image?size=huge')
+    assert response.status_code == 400
+    assert 'size must be one of' in response.json['msg']
+
+
+def test_get_post_image_conditional(client, test_post_with_image):
+    """Test that post images can be revalidated with their ETag"""
+    response = client.get(f'/api/posts/{test_post_with_image.id}/image')
+    assert response.headers['ETag']
+    assert response.cache_control.no_cache
+
+    cached_response = client.get(f'/api/posts/{test_post_with_image.id}/image',
+                                 headers={'If-None-Match': response.headers['ETag']})
+    assert cached_response.status_code == 304
+    assert cached_response.data == b''
+
+
+def test_get_image_by_id(client, test_post_with_image):
+    """Test that images fetched by ID are cacheable forever and support conditional and Range requests"""
+    response = client.get(f'/api/images/{test_post_with_image.image_id}')
+    assert response.status_code == 200
+    assert response.content_type == 'image/jpeg'
+    assert response.cache_control.immutable
+    assert response.cache_control.max_age > 0
+
+    range_response = client.get(f'/api/images/{test_post_with_image.image_id}', headers={'Range': 'bytes=0-9'})
+    assert range_response.status_code == 206
+    assert range_response.data == response.data[:10]
+
+    # Revalidation doesn't need the file to exist
+    os.remove(get_image_path(test_post_with_image.image_id))
+    cached_response = client.get(f'/api/images/{test_post_with_image.image_id}',
+                                 headers={'If-None-Match': response.headers['ETag']})
+    assert cached_response.status_code == 304
+    assert cached_response.headers['ETag'] == response.headers['ETag']
+
+
+def test_get_image_accel_redirect(app, client, test_post_with_image, monkeypatch):
+    """Test that image delivery can be handed to nginx"""
+    monkeypatch.setitem(app.config, 'IMAGE_DELIVERY', 'x-accel-redirect')
+    response = client.get(f'/api/images/{test_post_with_image.image_id}')
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.headers['X-Accel-Redirect'] == f'/protected-uploads/{test_post_with_image.image_id}.jpg'
+    assert response.content_type == 'image/jpeg'
+    assert response.headers['ETag']
+
+
+def test_get_profile_picture_x_sendfile(app, client, test_user, monkeypatch):
+    """Test that image delivery can be handed to a server supporting X-Sendfile"""
+    monkeypatch.setitem(app.config, 'IMAGE_DELIVERY', 'x-sendfile')
+    response = client.get(f'/api/users/{test_user.id}/profile-picture')
+    assert response.status_code == 200
+    assert response.data == b''
+    assert response.headers['X-Sendfile'] == os.path.abspath(os.path.join(app.config['UPLOAD_DIRECTORY'],
+                                                                           'default-profile.png'))
+
+
+def test_get_image_by_id_not_found(client):
+    """Test getting an image that doesn't exist"""
+    response = client.get('/api/images/does-not-exist')
+    assert response.status_code == 404
+
+
 def test_get_post_image_no_image(client, test_post):
     """Test getting image for post without an image"""
     response = client.get(f'/api/posts/{test_post.id}/image')
@@ -873,6 +1485,169 @@ def test_search_games(client, mock_igdb_search_response):
         assert response.json['games'][0]['name'] == 'Test Game'
 
 
+def test_search_games_cached(client, mock_igdb_search_response):
+    """Test that repeated searches for the same normalized term only call IGDB once"""
+    games_service.clear_search_cache()
+    stats = games_service.search_cache_stats()
+    with patch.object(games_service, '_fetch_search_results', return_value=mock_igdb_search_response) as mock_fetch:
+        first_response = client.get('/api/search/games?q=Test Game')
+        second_response = client.get('/api/search/games?q=  test   GAME')
+
+    assert first_response.json == second_response.json
+    mock_fetch.assert_called_once_with('test game')
+    assert games_service.search_cache_stats()['hits'] == stats['hits'] + 1
+
+
+def test_search_games_single_flight(app, mock_igdb_search_response, monkeypatch):
+    """Test that concurrent identical searches share one IGDB request"""
+    monkeypatch.setitem(app.config, 'IGDB_CATALOG_SEARCH', False)
+    games_service.clear_search_cache()
+    release = threading.Event()
+    results = []
+
+    def slow_fetch(game_name):
+        release.wait(timeout=5)
+        return mock_igdb_search_response
+
+    def search():
+        with app.app_context():
+            results.append(games_service.search_igdb_games('test'))
+
+    with patch.object(games_service, '_fetch_search_results', side_effect=slow_fetch) as mock_fetch:
+        threads = [threading.Thread(target=search) for _ in range(5)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+    assert mock_fetch.call_count == 1
+    assert results == [mock_igdb_search_response] * 5
+
+
+def test_igdb_token_shared_between_workers(app, tmp_path, monkeypatch):
+    """Test that the IGDB token fetched by one worker is reused by the others"""
+    monkeypatch.setitem(app.config, 'IGDB_TOKEN_FILE', str(tmp_path / 'igdb_token.json'))
+    token_response = Mock(status_code=200)
+    token_response.json.return_value = {'access_token': 'shared_token', 'expires_in': 5000000}
+
+    with patch.object(http_client, 'post', return_value=token_response) as mock_post:
+        assert games_service.IGDBTokenHandler().get_token() == 'shared_token'
+        assert games_service.IGDBTokenHandler().get_token() == 'shared_token'
+    assert mock_post.call_count == 1
+
+
+def test_igdb_token_refreshed_before_expiry(app, tmp_path, monkeypatch):
+    """Test that a token close to expiring is replaced"""
+    token_path = tmp_path / 'igdb_token.json'
+    monkeypatch.setitem(app.config, 'IGDB_TOKEN_FILE', str(token_path))
+    token_path.write_text(json.dumps({'access_token': 'old_token',
+                                      'expires_at': time.time() + app.config['IGDB_TOKEN_REFRESH_MARGIN'] / 2}))
+    token_response = Mock(status_code=200)
+    token_response.json.return_value = {'access_token': 'new_token', 'expires_in': 5000000}
+
+    with patch.object(http_client, 'post', return_value=token_response):
+        assert games_service.IGDBTokenHandler().get_token() == 'new_token'
+    assert json.loads(token_path.read_text())['access_token'] == 'new_token'
+
+
+def test_search_games_rate_limited(client):
+    """Test that searches that can't get an IGDB request slot in time are rejected as temporarily unavailable"""
+    with patch('server.routes.search_igdb_games', side_effect=IGDBRateLimitError('Rate limited')):
+        response = client.get('/api/search/games?q=test')
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+
+def test_game_lookups_rate_limited(client, auth_headers):
+    """Test that game lookups that can't get an IGDB request slot in time are rejected as temporarily unavailable"""
+    rate_limited = IGDBRateLimitError('Rate limited')
+    with patch('server.routes.get_cached_game', side_effect=rate_limited), \
+            patch('server.routes.get_cached_games', side_effect=rate_limited):
+        responses = [
+            client.get('/api/game-info/123'),
+            client.get('/api/games?ids=123'),
+            client.post('/api/communities', json={'game_id': 123, 'community_name': 'Test'}, headers=auth_headers),
+        ]
+    for response in responses:
+        assert response.status_code == 503
+        assert response.headers['Retry-After'] == '1'
+
+
+def test_rate_limiter_reserves_tokens(tmp_path):
+    """Test that the shared token bucket limits requests and keeps reserved tokens for higher priority callers"""
+    limiter = RateLimiter(str(tmp_path / 'rate_limit.json'))
+    limiter.acquire(rate=0.01, burst=3, max_wait=0)
+    limiter.acquire(rate=0.01, burst=3, max_wait=0, reserve=1)
+    with pytest.raises(RateLimitExceededError):
+        limiter.acquire(rate=0.01, burst=3, max_wait=0, reserve=1)
+
+    # Another worker process shares the same bucket
+    other_limiter = RateLimiter(str(tmp_path / 'rate_limit.json'))
+    other_limiter.acquire(rate=0.01, burst=3, max_wait=0)
+    with pytest.raises(RateLimitExceededError):
+        other_limiter.acquire(rate=0.01, burst=3, max_wait=0)
+
+
+def test_search_imported_catalog_after_migrations(app, tmp_path):
+    """Test that a database built by the migrations keeps the local search index in sync with imported games"""
+    migrated_app = create_app({**app.config, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{tmp_path / "migrated.db"}'})
+    migrations_directory = os.path.join(os.path.dirname(__file__), '..', 'migrations')
+    catalog_path = tmp_path / 'games.jsonl'
+    catalog_path.write_text(json.dumps({'id': 1, 'name': 'Halo Infinite'}))
+
+    with migrated_app.app_context():
+        flask_migrate.upgrade(directory=migrations_directory)
+        assert games_service.import_catalog(str(catalog_path)) == 1
+        assert [igdb_game.name for igdb_game in games_service.search_local_catalog('halo')] == ['Halo Infinite']
+
+        flask_migrate.downgrade(directory=migrations_directory, revision='base')
+        db.session.remove()
+        db.engine.dispose()
+
+
+def test_import_catalog_and_search_locally(app, client, tmp_path):
+    """Test importing an IGDB catalog dump and answering searches from it without calling IGDB"""
+    catalog_path = tmp_path / 'games.jsonl'
+    catalog_path.write_text('\n'.join(json.dumps(game) for game in [
+        {'id': 1025, 'name': 'The Legend of Zelda: Breath of the Wild', 'summary': 'Zelda',
+         'cover': {'url': '//images.igdb.com/igdb/image/upload/t_thumb/zelda.jpg'}, 'first_release_date': 1488499200},
+        {'id': 1026, 'name': 'Hollow Knight'},
+        {'name': 'Missing ID'},
+    ]))
+    assert games_service.import_catalog(str(catalog_path)) == 2
+
+    csv_path = tmp_path / 'games.csv'
+    csv_path.write_text('id,name,summary,cover,artwork,first_release_date\n'
+                        '1026,Hollow Knight: Silksong,Bugs,,,\n')
+    assert games_service.import_catalog(str(csv_path)) == 1
+
+    with patch.object(games_service, '_fetch_search_results') as mock_fetch:
+        response = client.get('/api/search/games?q=zel breath')
+        assert response.status_code == 200
+        assert [game['name'] for game in response.json['games']] == ['The Legend of Zelda: Breath of the Wild']
+        assert response.json['games'][0]['cover'] == 'https://images.igdb.com/igdb/image/upload/t_cover_big/zelda.jpg'
+
+        response = client.get('/api/search/games?q=silksong')
+        assert [game['name'] for game in response.json['games']] == ['Hollow Knight: Silksong']
+        mock_fetch.assert_not_called()
+
+        games_service.clear_search_cache()
+        mock_fetch.return_value = []
+        client.get('/api/search/games?q=celeste')
+        mock_fetch.assert_called_once_with('celeste')
+
+
+def test_search_games_ignores_cached_games(client, test_game, mock_igdb_search_response):
+    """Test that games only cached after a lookup don't stop searches from reaching IGDB"""
+    games_service.clear_search_cache()
+    with patch.object(games_service, '_fetch_search_results', return_value=mock_igdb_search_response) as mock_fetch:
+        response = client.get('/api/search/games?q=Test Game')
+    assert response.status_code == 200
+    mock_fetch.assert_called_once_with('test game')
+
+
 def test_search_games_no_query(client):
     """Test searching games without a query parameter"""
     response = client.get('/api/search/games')
@@ -906,44 +1681,53 @@ def test_discord_connect_unauthorized(client):
     assert response.status_code == 401
 
 
-@patch('requests.post')
-def test_discord_callback_success(mock_token_request, client, auth_headers, test_user, app):
+DISCORD_PROFILE = {'id': '1234', 'username': 'discord_user', 'avatar': 'avatar_hash'}
+
+
+def mock_discord_response(json_data, status_code=200):
+    return Mock(status_code=status_code, json=Mock(return_value=json_data))
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+@patch('server.services.async_http_client.post', new_callable=AsyncMock)
+def test_discord_callback_success(mock_token_request, mock_profile_request, client, auth_headers, test_user, app):
     """Test successful Discord OAuth callback"""
     # Mock Discord's token response
-    mock_token_response = {
+    mock_token_request.return_value = mock_discord_response({
         'access_token': 'mock_access_token',
         'refresh_token': 'mock_refresh_token',
         'expires_in': 604800  # 1 week in seconds
-    }
-    mock_token_request.return_value.json.return_value = mock_token_response
-    mock_token_request.return_value.status_code = 200
+    })
+    mock_profile_request.return_value = mock_discord_response(DISCORD_PROFILE)
 
-    # Mock the Discord account data fetching
-    with patch.object(routes, 'fetch_discord_account_data') as mock_fetch:
-        response = client.get(
-            '/api/discord/callback?code=mock_code',
-            headers=auth_headers
-        )
+    response = client.get(
+        '/api/discord/callback?code=mock_code',
+        headers=auth_headers
+    )
 
-        # Should redirect to user profile page
-        assert response.status_code == 302
-        assert f'/users/{test_user.id}' in response.location
+    # Should redirect to user profile page
+    assert response.status_code == 302
+    assert f'/users/{test_user.id}' in response.location
 
-        # Verify Discord account was created
-        discord_account = ConnectedAccount.query.filter_by(
-            user_id=test_user.id,
-            provider=ConnectedService.DISCORD
-        ).first()
+    # Verify Discord account was created with the fetched profile
+    discord_account = ConnectedAccount.query.filter_by(
+        user_id=test_user.id,
+        provider=ConnectedService.DISCORD
+    ).first()
 
-        assert discord_account is not None
-        assert discord_account.access_token == 'mock_access_token'
-        assert discord_account.refresh_token == 'mock_refresh_token'
-        assert mock_fetch.called
+    assert discord_account is not None
+    assert discord_account.access_token == 'mock_access_token'
+    assert discord_account.refresh_token == 'mock_refresh_token'
+    assert discord_account.username == 'discord_user'
+    assert discord_account.discord_user_id == '1234'
+    assert discord_account.profile_picture == 'avatar_hash'
+    assert mock_profile_request.call_args.kwargs['headers']['Authorization'] == 'Bearer mock_access_token'
 
 
-@patch('requests.post')
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+@patch('server.services.async_http_client.post', new_callable=AsyncMock)
 def test_discord_callback_existing_connection(
-    mock_token_request, client, auth_headers, test_user, app
+    mock_token_request, mock_profile_request, client, auth_headers, test_user, app
 ):
     """Test Discord callback with existing connection updates tokens"""
     # Create existing Discord connection
@@ -958,43 +1742,40 @@ def test_discord_callback_existing_connection(
     db.session.commit()
 
     # Mock Discord's token response
-    mock_token_response = {
+    mock_token_request.return_value = mock_discord_response({
         'access_token': 'new_access_token',
         'refresh_token': 'new_refresh_token',
         'expires_in': 604800
-    }
-    mock_token_request.return_value.json.return_value = mock_token_response
-    mock_token_request.return_value.status_code = 200
+    })
+    mock_profile_request.return_value = mock_discord_response(DISCORD_PROFILE)
 
-    # Mock the Discord account data fetching
-    with patch.object(routes, 'fetch_discord_account_data') as mock_fetch:
-        response = client.get(
-            '/api/discord/callback?code=mock_code',
-            headers=auth_headers
-        )
+    response = client.get(
+        '/api/discord/callback?code=mock_code',
+        headers=auth_headers
+    )
 
-        assert response.status_code == 302
+    assert response.status_code == 302
 
-        # Verify tokens were updated
-        updated_account = ConnectedAccount.query.filter_by(
-            user_id=test_user.id,
-            provider=ConnectedService.DISCORD
-        ).first()
+    # Verify tokens were updated
+    updated_account = ConnectedAccount.query.filter_by(
+        user_id=test_user.id,
+        provider=ConnectedService.DISCORD
+    ).first()
 
-        assert updated_account.access_token == 'new_access_token'
-        assert updated_account.refresh_token == 'new_refresh_token'
-        assert mock_fetch.called
+    assert updated_account.access_token == 'new_access_token'
+    assert updated_account.refresh_token == 'new_refresh_token'
+    assert updated_account.username == 'discord_user'
 
 
-@patch('requests.post')
-def test_discord_callback_invalid_code(mock_token_request, client, auth_headers):
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+@patch('server.services.async_http_client.post', new_callable=AsyncMock)
+def test_discord_callback_invalid_code(mock_token_request, mock_profile_request, client, auth_headers):
     """Test Discord callback with invalid code"""
     # Mock Discord's error response
-    mock_token_request.return_value.status_code = 400
-    mock_token_request.return_value.json.return_value = {
+    mock_token_request.return_value = mock_discord_response({
         'error': 'invalid_grant',
         'error_description': 'Invalid authorization code'
-    }
+    }, status_code=400)
 
     response = client.get(
         '/api/discord/callback?code=invalid_code',
@@ -1003,6 +1784,307 @@ def test_discord_callback_invalid_code(mock_token_request, client, auth_headers)
 
     assert response.status_code == 400
     assert 'Invalid authorization code' in response.json['msg']
+    assert not mock_profile_request.called
+
+
+def create_discord_account(user_id, access_token='token', expires_in=timedelta(days=7), refreshed_at=None):
+    account = ConnectedAccount(user_id=user_id, username='old_username', provider=ConnectedService.DISCORD,
+                               access_token=access_token, refresh_token=f'refresh_{access_token}',
+                               expires_at=datetime.now() + expires_in, refreshed_at=refreshed_at)
+    db.session.add(account)
+    db.session.commit()
+    return account
+
+
+def test_discord_profiles_refreshed_concurrently(app, test_user):
+    """Test that a batch of Discord profiles is fetched with all requests in flight at the same time"""
+    accounts = [create_discord_account(test_user.id, access_token=f'token{i}') for i in range(3)]
+    in_flight = 0
+    max_in_flight = 0
+
+    async def slow_get(url, **kwargs):
+        nonlocal in_flight, max_in_flight
+        in_flight += 1
+        max_in_flight = max(max_in_flight, in_flight)
+        await asyncio.sleep(0.05)
+        in_flight -= 1
+        token = kwargs['headers']['Authorization'].removeprefix('Bearer ')
+        return mock_discord_response({'id': token, 'username': f'user_{token}', 'avatar': None})
+
+    with patch('server.services.async_http_client.get', side_effect=slow_get):
+        assert refresh_discord_accounts(accounts) == 3
+
+    assert max_in_flight == 3
+    assert [account.username for account in accounts] == ['user_token0', 'user_token1', 'user_token2']
+    assert all(account.refreshed_at is not None for account in accounts)
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+@patch('server.services.async_http_client.post', new_callable=AsyncMock)
+def test_refresh_due_discord_accounts(mock_token_request, mock_profile_request, app, test_user):
+    """Test that tokens nearing expiry are renewed and only outdated profiles are fetched again"""
+    expiring = create_discord_account(test_user.id, access_token='expiring', expires_in=timedelta(hours=1),
+                                      refreshed_at=datetime.now())
+    outdated = create_discord_account(test_user.id, access_token='outdated',
+                                      refreshed_at=datetime.now() - timedelta(days=2))
+    current = create_discord_account(test_user.id, access_token='current', refreshed_at=datetime.now())
+    mock_token_request.return_value = mock_discord_response({
+        'access_token': 'renewed', 'refresh_token': 'refresh_renewed', 'expires_in': 604800})
+    mock_profile_request.return_value = mock_discord_response(DISCORD_PROFILE)
+
+    assert refresh_due_discord_accounts(batch_size=1) == 2
+
+    assert mock_token_request.call_count == 1
+    assert mock_token_request.call_args.kwargs['data']['refresh_token'] == 'refresh_expiring'
+    assert expiring.access_token == 'renewed'
+    assert expiring.refresh_token == 'refresh_renewed'
+    assert expiring.expires_at > datetime.now() + timedelta(days=6)
+    assert expiring.username == outdated.username == 'discord_user'
+    assert current.username == 'old_username'
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+def test_refresh_discord_accounts_keeps_failed_accounts(mock_profile_request, app, test_user):
+    """Test that accounts Discord rejects are left as they were"""
+    account = create_discord_account(test_user.id)
+    mock_profile_request.return_value = mock_discord_response({'message': '401: Unauthorized'}, status_code=401)
+
+    assert refresh_discord_accounts([account]) == 0
+    assert account.username == 'old_username'
+    assert account.refreshed_at is None
+
+
+def test_refresh_discord_accounts_keeps_renewed_tokens(app, test_user):
+    """Test that renewed tokens are stored even if fetching a profile fails unexpectedly"""
+    accounts = [create_discord_account(test_user.id, access_token=name, expires_in=timedelta(hours=1))
+                for name in ('first', 'second')]
+
+    async def renew(url, data, **kwargs):
+        name = data['refresh_token'].removeprefix('refresh_')
+        return mock_discord_response({
+            'access_token': f'renewed_{name}', 'refresh_token': f'refresh_renewed_{name}', 'expires_in': 604800})
+
+    async def fetch_profile(url, **kwargs):
+        if kwargs['headers']['Authorization'] == 'Bearer renewed_second':
+            return Mock(status_code=200, json=Mock(side_effect=json.JSONDecodeError('Expecting value', '', 0)))
+        return mock_discord_response(DISCORD_PROFILE)
+
+    with patch('server.services.async_http_client.post', side_effect=renew), \
+            patch('server.services.async_http_client.get', side_effect=fetch_profile):
+        assert refresh_discord_accounts(accounts) == 1
+
+    db.session.expire_all()
+    first, second = (db.session.get(ConnectedAccount, account.id) for account in accounts)
+    assert (first.refresh_token, second.refresh_token) == ('refresh_renewed_first', 'refresh_renewed_second')
+    assert first.username == 'discord_user'
+    assert second.username == 'old_username'
+    assert second.refreshed_at is None
+
+
+def test_discord_refresher_logs_unexpected_errors(app, test_user):
+    """Test that background refreshes that fail unexpectedly are logged rather than dropped with their future"""
+    account = create_discord_account(test_user.id)
+    with patch.object(discord_services, 'refresh_discord_accounts', side_effect=RuntimeError('boom')), \
+            patch.object(app.logger, 'exception') as mock_log:
+        discord_services.discord_refresher._refresh_in_context(app, account.id)
+
+    mock_log.assert_called_once_with(f'Failed to refresh connected account {account.id}')
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+def test_get_linked_accounts(mock_profile_request, client, auth_headers, test_user):
+    """Test that linked accounts are served as stored, without calling Discord"""
+    create_discord_account(test_user.id)
+
+    response = client.get('/api/linked-accounts', headers=auth_headers)
+
+    assert response.status_code == 200
+    assert response.json['discord']['username'] == 'old_username'
+    assert response.json['steam'] is None
+    assert not mock_profile_request.called
+
+
+def test_get_linked_accounts_none_connected(client, auth_headers, test_user):
+    """Test linked accounts for a user without connected accounts"""
+    response = client.get(f'/api/linked-accounts/{test_user.id}', headers=auth_headers)
+    assert response.status_code == 200
+    assert response.json['discord'] is None
+
+
+def create_avatar(color='blue'):
+    file = io.BytesIO()
+    Image.new('RGB', (64, 64), color=color).save(file, 'PNG')
+    return file.getvalue()
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+def test_discord_avatar_proxied_once(mock_cdn_request, client, test_user):
+    """Test that a Discord avatar is fetched once, stored, and served with long-lived cache headers"""
+    account = create_discord_account(test_user.id)
+    account.discord_user_id = '1234'
+    account.profile_picture = 'hash1'
+    db.session.commit()
+    mock_cdn_request.return_value = Mock(status_code=200, content=create_avatar())
+
+    with client.application.test_request_context():
+        avatar_url = account.serialize()['profile_picture_url']
+    assert avatar_url == f'http://localhost/api/users/{test_user.id}/discord-avatar/hash1'
+    response = client.get(avatar_url)
+    assert response.status_code == 200
+    assert response.mimetype == 'image/jpeg'
+    assert response.cache_control.immutable
+    assert mock_cdn_request.call_args.args[0] == 'https://cdn.discordapp.com/avatars/1234/hash1.png'
+
+    response = client.get(f'{avatar_url}?size=thumb')
+    assert response.status_code == 200
+    assert mock_cdn_request.call_count == 1
+    assert db.session.get(ImageBlob, account.avatar_image_id).ref_count == 1
+    delete_image(account.avatar_image_id)
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+def test_discord_avatar_refetched_when_hash_changes(mock_cdn_request, client, test_user):
+    """Test that a changed avatar hash is fetched again, and links to the old avatar redirect to the new one"""
+    account = create_discord_account(test_user.id)
+    account.discord_user_id = '1234'
+    account.profile_picture = 'hash1'
+    db.session.commit()
+    mock_cdn_request.return_value = Mock(status_code=200, content=create_avatar('blue'))
+    client.get(f'/api/users/{test_user.id}/discord-avatar/hash1')
+    old_image_id = account.avatar_image_id
+
+    account.profile_picture = 'hash2'
+    db.session.commit()
+    mock_cdn_request.return_value = Mock(status_code=200, content=create_avatar('green'))
+    response = client.get(f'/api/users/{test_user.id}/discord-avatar/hash1?size=thumb')
+    assert response.status_code == 302
+    assert response.location.endswith(f'/api/users/{test_user.id}/discord-avatar/hash2?size=thumb')
+
+    response = client.get(response.location)
+    assert response.status_code == 200
+    assert mock_cdn_request.call_count == 2
+    assert account.avatar_image_id != old_image_id
+    assert account.avatar_hash == 'hash2'
+    assert db.session.get(ImageBlob, old_image_id).ref_count == 0
+    delete_image(old_image_id)
+    delete_image(account.avatar_image_id)
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+def test_discord_avatar_cached_concurrently(mock_cdn_request, app, test_user):
+    """Test that an avatar stored by two requests at once is only referenced once"""
+    account = create_discord_account(test_user.id)
+    account.discord_user_id = '1234'
+    account.profile_picture = 'hash1'
+    db.session.commit()
+    mock_cdn_request.return_value = Mock(status_code=200, content=create_avatar())
+    save_image = discord_services.save_image
+
+    def save_image_while_other_request_stores_it(image):
+        stored_image = save_image(image)
+        # Loaded before the other request's update, which this request's session doesn't see
+        assert account.avatar_image_id is None
+        db.session.execute(db.update(ConnectedAccount)
+                           .where(ConnectedAccount.id == account.id)
+                           .values(avatar_image_id=stored_image.id, avatar_hash='hash1')
+                           .execution_options(synchronize_session=False))
+        retain_image(stored_image.id)
+        return stored_image
+
+    with patch.object(discord_services, 'save_image', side_effect=save_image_while_other_request_stores_it):
+        image_id = cache_discord_avatar(account)
+
+    assert image_id == account.avatar_image_id
+    assert account.avatar_hash == 'hash1'
+    assert db.session.get(ImageBlob, image_id).ref_count == 1
+    delete_image(image_id)
+
+
+@patch('server.services.async_http_client.get', new_callable=AsyncMock)
+def test_discord_avatar_unavailable(mock_cdn_request, client, test_user):
+    """Test that the default profile picture is served, and not cached, when Discord doesn't have the avatar"""
+    account = create_discord_account(test_user.id)
+    account.discord_user_id = '1234'
+    account.profile_picture = 'missing'
+    db.session.commit()
+    mock_cdn_request.return_value = Mock(status_code=404, content=b'')
+
+    response = client.get(f'/api/users/{test_user.id}/discord-avatar/missing')
+    assert response.status_code == 200
+    assert response.mimetype == 'image/png'
+    assert not response.cache_control.immutable
+    assert account.avatar_image_id is None
+
+
+def test_discord_avatar_not_connected(client, test_user):
+    """Test the avatar of a user without a Discord account"""
+    response = client.get(f'/api/users/{test_user.id}/discord-avatar/hash1')
+    assert response.status_code == 404
+
+
+def test_async_http_client_retries_idempotent_requests(app, monkeypatch):
+    """Test that the async client retries idempotent requests and records them with the sync client's metrics"""
+    monkeypatch.setitem(app.config, 'HTTP_RETRY_BACKOFF', 0)
+    responses = iter([httpx.Response(503), httpx.Response(200, json={'ok': True})])
+
+    def handler(request):
+        return next(responses)
+
+    async def get_with_mock_transport():
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as mock_client:
+            with patch.object(async_http_client.async_http_client, '_get_client', return_value=mock_client):
+                return await async_http_client.get('https://example.com/async-retry', upstream='async-retry-test')
+
+    with app.app_context():
+        response = run_async(get_with_mock_transport())
+
+    assert response.json() == {'ok': True}
+    stats = http_client.http_client.stats()['async-retry-test']
+    assert stats['requests'] == 2
+    assert stats['retries'] == 1
+
+
+def test_http_client_retries_idempotent_requests(app, monkeypatch):
+    """Test that idempotent outbound requests are retried on upstream errors, and recorded per upstream"""
+    monkeypatch.setitem(app.config, 'HTTP_RETRY_BACKOFF', 0)
+    unavailable = Mock(status_code=503, headers={})
+    ok = Mock(status_code=200, headers={})
+    with patch('requests.Session.request', side_effect=[unavailable, ok]) as mock_request:
+        response = http_client.get('https://example.com/retry', upstream='retry-test')
+
+    assert response is ok
+    assert mock_request.call_count == 2
+    assert mock_request.call_args.kwargs['timeout'] == (app.config['HTTP_CONNECT_TIMEOUT'],
+                                                        app.config['HTTP_READ_TIMEOUT'])
+    stats = http_client.http_client.stats()['retry-test']
+    assert stats['requests'] == 2
+    assert stats['errors'] == 1
+    assert stats['retries'] == 1
+
+
+def test_http_client_does_not_retry_post(app, monkeypatch):
+    """Test that non-idempotent outbound requests are only sent once"""
+    monkeypatch.setitem(app.config, 'HTTP_RETRY_BACKOFF', 0)
+    with patch('requests.Session.request', side_effect=requests.ConnectionError) as mock_request:
+        with pytest.raises(requests.ConnectionError):
+            http_client.post('https://example.com/token')
+    assert mock_request.call_count == 1
+
+
+def test_metrics(client, app, monkeypatch):
+    """Test that upstream metrics are served to scrapers holding the metrics token"""
+    with patch('requests.Session.request', return_value=Mock(status_code=200, headers={})):
+        http_client.get('https://example.com/metrics', upstream='metrics-test')
+
+    assert client.get('/api/metrics').status_code == 404
+    monkeypatch.setitem(app.config, 'METRICS_TOKEN', 'metrics-token')
+    assert client.get('/api/metrics', headers={'Authorization': 'Bearer wrong-token'}).status_code == 404
+
+    response = client.get('/api/metrics', headers={'Authorization': 'Bearer metrics-token'})
+    assert response.status_code == 200
+    assert response.json['pid'] == os.getpid()
+    assert response.json['upstreams']['metrics-test']['requests'] >= 1
+    assert response.json['search_cache'] == games_service.search_cache_stats()
 
 
 def test_discord_callback_unauthorized(client):
@@ -1045,3 +2127,151 @@ def test_discord_disconnect_no_connection(client, auth_headers, test_user):
     """Test disconnecting when no Discord account is connected"""
     response = client.post('/api/discord/disconnect', headers=auth_headers)
     assert response.status_code == 200  # Should still succeed
+
+
+def test_get_user_ratings_summary(client, test_user, test_ratings):
+    """Test that the summary averages each field over the ratings that include it"""
+    response = client.get(f'/api/ratings/{test_user.id}/summary')
+    assert response.status_code == 200
+    summary = response.json['summary']
+    assert summary['count'] == 3
+    assert {field['name']: field['value'] for field in summary['fields']} == {
+        'attitude': 4.0,
+        'communication': 0,
+        'reliability': 0,
+        'teamwork': 3.0,
+    }
+
+
+def test_get_user_ratings_summary_query_count(client, test_user, test_ratings):
+    """Test that the summary is a single lookup of the summary tables, without reading any ratings"""
+    statements = []
+
+    def record_statement(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', record_statement)
+    try:
+        client.get(f'/api/ratings/{test_user.id}/summary')
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', record_statement)
+
+    summary_statements = [statement for statement in statements if 'rating_summary' in statement]
+    assert len(summary_statements) == 1
+    assert not any('FROM rating ' in statement or 'FROM rating_field' in statement for statement in statements)
+
+
+def get_summary_fields(client, user_id):
+    summary = client.get(f'/api/ratings/{user_id}/summary').json['summary']
+    if summary is None:
+        return None
+    return summary['count'], {field['name']: field['value'] for field in summary['fields']}
+
+
+def test_rating_summary_updated_on_create_overwrite_and_delete(client, auth_headers, test_user):
+    """Test that creating, overwriting and deleting a rating keep the summary up to date"""
+    rated_user = User(username='rated_user', password=TEST_PASSWORD)
+    db.session.add(rated_user)
+    db.session.commit()
+
+    response = client.post(f'/api/ratings/{rated_user.id}', headers=auth_headers, json={
+        'description': 'Good teammate',
+        'fields': [{'name': 'attitude', 'value': 5}, {'name': 'teamwork', 'value': 3}],
+    })
+    assert response.status_code == 200
+    count, fields = get_summary_fields(client, rated_user.id)
+    assert count == 1
+    assert fields['attitude'] == 5
+    assert fields['teamwork'] == 3
+
+    response = client.post(f'/api/ratings/{rated_user.id}', headers=auth_headers, json={
+        'description': 'Changed my mind',
+        'fields': [{'name': 'attitude', 'value': 1}],
+    })
+    assert response.status_code == 200
+    count, fields = get_summary_fields(client, rated_user.id)
+    assert count == 1
+    assert fields['attitude'] == 1
+    assert fields['teamwork'] == 0
+
+    response = client.delete(f'/api/ratings/{rated_user.id}', headers=auth_headers)
+    assert response.status_code == 200
+    assert get_summary_fields(client, rated_user.id) is None
+
+
+def test_rebuild_rating_summaries(app, client, test_user, test_ratings):
+    """Test that the rebuild command recomputes summaries that drifted from the ratings"""
+    db.session.execute(db.update(RatingSummary).values(rating_count=99))
+    db.session.commit()
+
+    result = app.test_cli_runner().invoke(args=['ratings', 'rebuild-summaries'])
+    assert 'Rebuilt rating summaries for 1 users.' in result.output
+    count, fields = get_summary_fields(client, test_user.id)
+    assert count == 3
+    assert fields['attitude'] == 4.0
+
+
+def test_get_user_ratings_summary_no_ratings(client, test_user):
+    """Test the summary of a user nobody has rated"""
+    response = client.get(f'/api/ratings/{test_user.id}/summary')
+    assert response.status_code == 200
+    assert response.json['summary'] is None
+
+
+def test_get_user_ratings_paginated(client, test_user, test_ratings):
+    """Test that received ratings are returned newest first, a page at a time"""
+    response = client.get(f'/api/ratings?receiver={test_user.id}&limit=2')
+    assert response.status_code == 200
+    assert [rating['description'] for rating in response.json['ratings']] == ['Rating 2', 'Rating 1']
+    assert response.json['ratings'][0]['rating_user']['username'] == 'rater_2'
+    next_cursor = response.json['next_cursor']
+    assert next_cursor is not None
+
+    response = client.get(f'/api/ratings?receiver={test_user.id}&limit=2&cursor={next_cursor}')
+    assert [rating['description'] for rating in response.json['ratings']] == ['Rating 0']
+    assert response.json['next_cursor'] is None
+
+
+def test_get_user_ratings_query_count(client, test_user, test_ratings):
+    """Test that a page of ratings takes the same number of queries however many ratings it has"""
+    def count_statements(limit):
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_statement)
+        try:
+            response = client.get(f'/api/ratings?receiver={test_user.id}&limit={limit}')
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_statement)
+        assert len(response.json['ratings']) == limit
+        return len(statements)
+
+    # The first request also looks up the user
+    count_statements(1)
+    assert count_statements(1) == count_statements(3)
+
+
+def test_get_user_ratings_given(client, test_user, test_ratings):
+    """Test listing the ratings a user gave, and looking up a single rating"""
+    rater_id = test_ratings[0].rating_user_id
+    response = client.get(f'/api/ratings?giver={rater_id}')
+    assert [rating['rated_user_id'] for rating in response.json['ratings']] == [test_user.id]
+
+    response = client.get(f'/api/ratings?giver={rater_id}&receiver={test_user.id}')
+    assert response.json['rating']['description'] == 'Rating 0'
+
+
+def test_create_user_rating_returns_rating(client, auth_headers, test_user, test_ratings):
+    """Test that creating a rating only returns the created rating"""
+    rater = test_ratings[0].rating_user
+    response = client.post(f'/api/ratings/{rater.id}', headers=auth_headers, json={
+        'description': 'Rated back',
+        'fields': [{'name': 'attitude', 'value': 4}],
+    })
+    assert response.status_code == 200
+    assert 'ratings' not in response.json
+    assert response.json['rating']['description'] == 'Rated back'
+    assert response.json['rating']['rating_user']['id'] == test_user.id
+    assert response.json['rating']['fields'][0]['name'] == 'attitude'